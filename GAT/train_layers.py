@@ -102,7 +102,7 @@ def train(model, optimizer, epoch):
               'loss_val: {:.4f}'.format(loss_val.item()),
               'acc_val: {:.4f}'.format(acc_val.item()),
               'time: {:.4f}s'.format(time.time() - t))
-    return loss_val.item(), acc_val.item()
+    return loss_val.detach(), acc_val.detach()
 
 
 def test(model, optimizer):
@@ -159,15 +159,22 @@ for m in model_dict:
             if args.cuda:
                 model.cuda()
             
+            # The validation history stays on the device, only the convergence check is read every epoch
+            val_loss = torch.zeros(args.epochs, dtype=torch.float64, device=features.device)
+            val_acc = torch.zeros(args.epochs, dtype=torch.float64, device=features.device)
+            converged = None
             for epoch in range(args.epochs):
-                epoch_val_loss, epoch_val_acc = train(model, optimizer, epoch)
-                model_data[m]["layer_val_loss"][nlayers,run,epoch] = epoch_val_loss
-                model_data[m]["layer_val_acc"][nlayers,run,epoch] = epoch_val_acc
-                if epoch_val_acc > acc_threshold and epoch_val_loss < loss_threshold:
-                    model_data[m]["layer_convergence"][nlayers,run] = epoch
-                    model_data[m]["layer_val_loss"][nlayers,run,epoch:] = model_data[m]["layer_val_loss"][nlayers,run,epoch-1]
-                    model_data[m]["layer_val_acc"][nlayers,run,epoch:] = model_data[m]["layer_val_acc"][nlayers,run,epoch-1]
+                val_loss[epoch], val_acc[epoch] = train(model, optimizer, epoch)
+                if ((val_acc[epoch] > acc_threshold) & (val_loss[epoch] < loss_threshold)).item():
+                    converged = epoch
                     break
+            model_data[m]["layer_val_loss"][nlayers,run] = val_loss.cpu().numpy()
+            model_data[m]["layer_val_acc"][nlayers,run] = val_acc.cpu().numpy()
+            if converged is not None:
+                epoch = converged
+                model_data[m]["layer_convergence"][nlayers,run] = epoch
+                model_data[m]["layer_val_loss"][nlayers,run,epoch:] = model_data[m]["layer_val_loss"][nlayers,run,epoch-1]
+                model_data[m]["layer_val_acc"][nlayers,run,epoch:] = model_data[m]["layer_val_acc"][nlayers,run,epoch-1]
             
             run_test_loss, run_test_acc = test(model, optimizer)
             model_data[m]["layer_test_loss"][nlayers,run] = run_test_loss
@@ -7,6 +7,7 @@ import matplotlib.patches as mpatches
 from matplotlib.colors import colorConverter as cc
 from scipy.sparse.linalg.eigen.arpack import eigsh
 import sys
+import os
 import torch
 
 def count_params(model):
@@ -173,47 +174,107 @@ def load_data_new(dataset_str):
     tx_extended[test_idx_range-min(test_idx_range), :] = tx
     tx = tx_extended
     ty_extended = np.zeros((len(test_idx_range_full), y.shape[1]))
-        ty_extended[test_idx_range-min(test_idx_range), :] = ty
-        ty = ty_extended
+    ty_extended[test_idx_range-min(test_idx_range), :] = ty
+    ty = ty_extended
 
-    features = sp.vstack((allx, tx)).tolil()
-    features[test_idx_reorder, :] = features[test_idx_range, :]
+  features = sp.vstack((allx, tx)).tolil()
+  features[test_idx_reorder, :] = features[test_idx_range, :]
 
-    labels = np.vstack((ally, ty))
-    labels[test_idx_reorder, :] = labels[test_idx_range, :]
-    
-    features = normalize(features)
-    
-    G = nx.from_dict_of_lists(graph)
-    edges = np.array(G.edges,
-                     dtype=np.int64).reshape(-1,2)
-    
-    src = edges[:, 0]
-    tgt = edges[:, 1]
-    edge_range = np.arange(edges.shape[0])
-    Mtgt = sp.coo_matrix((np.ones(edges.shape[0]), (edges[:, 1], edge_range)),
-                        shape=(labels.shape[0], edges.shape[0]),
-                        dtype=np.float32)
-
-    idx_test = test_idx_range.tolist()
-    idx_train = range(len(y))
-    idx_val = range(len(y), len(y)+500)
-
-    features = torch.FloatTensor(np.array(features.todense()))
-    # The old code did a where
-    #labels = torch.LongTensor(np.where(labels)[1])
-    # I'm doing argmax since it is stable where all labels are zero (which happens in citesser)
-    labels = torch.LongTensor(np.argmax(labels,axis=1))
-    
-    src = torch.from_numpy(src)
-    tgt = torch.from_numpy(tgt)
-    Mtgt = sparse_mx_to_torch_sparse_tensor(Mtgt)
-    
-    idx_train = torch.LongTensor(idx_train)
-    idx_val = torch.LongTensor(idx_val)
-    idx_test = torch.LongTensor(idx_test)
+  labels = np.vstack((ally, ty))
+  labels[test_idx_reorder, :] = labels[test_idx_range, :]
+  
+  features = normalize(features)
+  
+  src, tgt, ptr = load_edge_index(dataset_str, graph, labels.shape[0])
+  Mtgt = edge_index_to_mtgt(tgt, labels.shape[0])
+
+  idx_test = test_idx_range.tolist()
+  idx_train = range(len(y))
+  idx_val = range(len(y), len(y)+500)
 
-    return src, tgt, Mtgt, features, labels, idx_train, idx_val, idx_test
+  features = torch.FloatTensor(np.array(features.todense()))
+  # The old code did a where
+  #labels = torch.LongTensor(np.where(labels)[1])
+  # I'm doing argmax since it is stable where all labels are zero (which happens in citesser)
+  labels = torch.LongTensor(np.argmax(labels,axis=1))
+  
+  src = torch.from_numpy(src.astype(np.int64))
+  tgt = torch.from_numpy(tgt.astype(np.int64))
+  
+  idx_train = torch.LongTensor(idx_train)
+  idx_val = torch.LongTensor(idx_val)
+  idx_test = torch.LongTensor(idx_test)
+
+  return src, tgt, Mtgt, features, labels, idx_train, idx_val, idx_test
+
+
+def build_edge_index(graph, num_nodes):
+  """
+  Builds a symmetric edge index with self-loops from a dict of adjacency lists.
+
+  Every undirected edge is emitted in both directions, duplicates are removed
+  and edges are sorted by target (then source), so that the edges pointing at
+  node i are the contiguous range ptr[i]:ptr[i+1].
+
+  :param graph: dict in the format {index: [index_of_neighbor_nodes]}
+  :param num_nodes: Number of nodes N in the graph
+  :return: src (E,) int32, tgt (E,) int32 and the CSR pointer ptr (N+1,) int64
+  """
+  degrees = [len(v) for v in graph.values()]
+  a = np.repeat(np.fromiter(graph.keys(), dtype=np.int64, count=len(graph)), degrees)
+  b = np.fromiter((n for v in graph.values() for n in v), dtype=np.int64, count=sum(degrees))
+  loops = np.arange(num_nodes, dtype=np.int64)
+  src = np.concatenate([a, b, loops])
+  tgt = np.concatenate([b, a, loops])
+  # Sort by target then source and drop repeated edges through the flat key
+  key = np.unique(tgt * num_nodes + src)
+  src = (key % num_nodes).astype(np.int32)
+  tgt = (key // num_nodes).astype(np.int32)
+  ptr = np.zeros(num_nodes+1, dtype=np.int64)
+  ptr[1:] = np.cumsum(np.bincount(tgt, minlength=num_nodes))
+  return src, tgt, ptr
+
+
+def load_edge_index(dataset_str, graph, num_nodes, cache_dir="data/cache"):
+  """
+  Loads the edge index built by build_edge_index for a dataset, building and
+  caching it as .npy files on the first call.
+
+  Cached arrays are opened memory-mapped, so every process shares the same pages.
+
+  :param dataset_str: Dataset name, used as the cache key
+  :param graph: dict in the format {index: [index_of_neighbor_nodes]}
+  :param num_nodes: Number of nodes N in the graph
+  :param cache_dir: Directory holding the cached arrays
+  :return: src (E,) int32, tgt (E,) int32 and the CSR pointer ptr (N+1,) int64
+  """
+  names = ['src', 'tgt', 'ptr']
+  paths = [os.path.join(cache_dir, "gat.{}.{}.npy".format(dataset_str, name)) for name in names]
+  if all(os.path.isfile(path) for path in paths):
+    src, tgt, ptr = [np.load(path, mmap_mode='r') for path in paths]
+    if ptr.shape[0] == num_nodes+1:
+      return src, tgt, ptr
+  #end if
+  src, tgt, ptr = build_edge_index(graph, num_nodes)
+  if not os.path.isdir(cache_dir):
+    os.makedirs(cache_dir)
+  for path, arr in zip(paths, (src, tgt, ptr)):
+    # Write to a temporary file first so that concurrent runs never read a partial array
+    tmp_path = "{}.{}.tmp".format(path, os.getpid())
+    with open(tmp_path, 'wb') as f:
+      np.save(f, arr)
+    os.replace(tmp_path, path)
+  #end for
+  return src, tgt, ptr
+
+
+def edge_index_to_mtgt(tgt, num_nodes):
+  """Builds the N,E target incidence matrix as a torch sparse tensor from a target-sorted edge index."""
+  tgt = torch.from_numpy(np.asarray(tgt, dtype=np.int64))
+  edge_range = torch.arange(tgt.shape[0], dtype=torch.int64)
+  return torch.sparse.FloatTensor(torch.stack([tgt, edge_range]),
+                  torch.ones(tgt.shape[0]),
+                  torch.Size([num_nodes, tgt.shape[0]]))
 
 
 def normalize(mx):
@@ -15,10 +15,13 @@ import random
 import argparse
 
 from rdkit import Chem
-from rdkit.Chem import ChemicalFeatures
+from rdkit.Chem import AllChem, ChemicalFeatures
 from rdkit import RDConfig
 
+import io
 import os
+import tarfile
+import threading
 
 from os import listdir
 from os.path import isfile, join
@@ -416,73 +419,263 @@ def init_graph(prop):
           lumo=g_lumo, gap=g_gap, r2=g_r2, zpve=g_zpve, U0=g_U0, U=g_U, H=g_H, G=g_G, Cv=g_Cv), labels
 
 
-# XYZ file reader for QM9 dataset
-def xyz_graph_reader(graph_file):
+# Target labels of a QM9 molecule, same order as init_graph
+def init_labels(prop):
+  return [float(p) for p in prop.split()[5:17]]
 
-  with open(graph_file,'r') as f:
-    # Number of atoms
-    na = int(f.readline())
 
-    # Graph properties
-    properties = f.readline()
-    g, l = init_graph(properties)
-    
-    atom_properties = []
-    # Atoms properties
-    for i in range(na):
-      a_properties = f.readline()
-      a_properties = a_properties.replace('.*^', 'e')
-      a_properties = a_properties.replace('*^', 'e')
-      a_properties = a_properties.split()
-      atom_properties.append(a_properties)
-
-    # Frequencies
-    f.readline()
-
-    # SMILES
-    smiles = f.readline()
-    smiles = smiles.split()
-    smiles = smiles[0]
-    
-    m = Chem.MolFromSmiles(smiles)
-    m = Chem.AddHs(m)
+_feature_factory = None
 
+# RDKit feature factory, built once per process
+def get_feature_factory():
+  global _feature_factory
+  if _feature_factory is None:
     fdef_name = os.path.join(RDConfig.RDDataDir, 'BaseFeatures.fdef')
-    factory = ChemicalFeatures.BuildFeatureFactory(fdef_name)
-    feats = factory.GetFeaturesForMol(m)
-
-    # Create nodes
-    for i in range(0, m.GetNumAtoms()):
-      atom_i = m.GetAtomWithIdx(i)
-
-      g.add_node(i, a_type=atom_i.GetSymbol(), a_num=atom_i.GetAtomicNum(), acceptor=0, donor=0,
-             aromatic=atom_i.GetIsAromatic(), hybridization=atom_i.GetHybridization(),
-             num_h=atom_i.GetTotalNumHs(), coord=np.array(atom_properties[i][1:4]).astype(np.float),
-             pc=float(atom_properties[i][4]))
-
-    for i in range(0, len(feats)):
-      if feats[i].GetFamily() == 'Donor':
-        node_list = feats[i].GetAtomIds()
-        for i in node_list:
-          g.node[i]['donor'] = 1
-      elif feats[i].GetFamily() == 'Acceptor':
-        node_list = feats[i].GetAtomIds()
-        for i in node_list:
-          g.node[i]['acceptor'] = 1
-
-    # Read Edges
-    for i in range(0, m.GetNumAtoms()):
-      for j in range(0, m.GetNumAtoms()):
-        e_ij = m.GetBondBetweenAtoms(i, j)
-        if e_ij is not None:
-          g.add_edge(i, j, b_type=e_ij.GetBondType(),
-                 distance=np.linalg.norm(g.node[i]['coord']-g.node[j]['coord']))
-        else:
-          # Unbonded
-          g.add_edge(i, j, b_type=None,
-                 distance=np.linalg.norm(g.node[i]['coord'] - g.node[j]['coord']))
+    _feature_factory = ChemicalFeatures.BuildFeatureFactory(fdef_name)
+  return _feature_factory
+
+
+# XYZ file reader for QM9 dataset, graph_file is a path or an open text file
+def xyz_graph_reader(graph_file, factory=None):
+
+  if hasattr(graph_file, 'readline'):
+    return xyz_graph_parse(graph_file, factory)
+  with open(graph_file,'r') as f:
+    return xyz_graph_parse(f, factory)
+
+
+def xyz_graph_parse(f, factory=None):
+  # Number of atoms
+  na = int(f.readline())
+
+  # Graph properties
+  properties = f.readline()
+  g, l = init_graph(properties)
+  
+  atom_properties = []
+  # Atoms properties
+  for i in range(na):
+    a_properties = f.readline()
+    a_properties = a_properties.replace('.*^', 'e')
+    a_properties = a_properties.replace('*^', 'e')
+    a_properties = a_properties.split()
+    atom_properties.append(a_properties)
+
+  # Frequencies
+  f.readline()
+
+  # SMILES
+  smiles = f.readline()
+  smiles = smiles.split()
+  smiles = smiles[0]
+  
+  m = Chem.MolFromSmiles(smiles)
+  m = Chem.AddHs(m)
+
+  if factory is None:
+    factory = get_feature_factory()
+  feats = factory.GetFeaturesForMol(m)
+
+  # Create nodes
+  for i in range(0, m.GetNumAtoms()):
+    atom_i = m.GetAtomWithIdx(i)
+
+    g.add_node(i, a_type=atom_i.GetSymbol(), a_num=atom_i.GetAtomicNum(), acceptor=0, donor=0,
+           aromatic=atom_i.GetIsAromatic(), hybridization=atom_i.GetHybridization(),
+           num_h=atom_i.GetTotalNumHs(), coord=np.array(atom_properties[i][1:4]).astype(np.float),
+           pc=float(atom_properties[i][4]))
+
+  for i in range(0, len(feats)):
+    if feats[i].GetFamily() == 'Donor':
+      node_list = feats[i].GetAtomIds()
+      for i in node_list:
+        g.node[i]['donor'] = 1
+    elif feats[i].GetFamily() == 'Acceptor':
+      node_list = feats[i].GetAtomIds()
+      for i in node_list:
+        g.node[i]['acceptor'] = 1
+
+  # Read Edges
+  for i in range(0, m.GetNumAtoms()):
+    for j in range(0, m.GetNumAtoms()):
+      e_ij = m.GetBondBetweenAtoms(i, j)
+      if e_ij is not None:
+        g.add_edge(i, j, b_type=e_ij.GetBondType(),
+               distance=np.linalg.norm(g.node[i]['coord']-g.node[j]['coord']))
+      else:
+        # Unbonded
+        g.add_edge(i, j, b_type=None,
+               distance=np.linalg.norm(g.node[i]['coord'] - g.node[j]['coord']))
   return g , l
-  
+
+
+BOND_TYPES = [Chem.rdchem.BondType.SINGLE, Chem.rdchem.BondType.DOUBLE,
+              Chem.rdchem.BondType.TRIPLE, Chem.rdchem.BondType.AROMATIC]
+HYBRIDIZATIONS = [Chem.rdchem.HybridizationType.SP, Chem.rdchem.HybridizationType.SP2,
+                  Chem.rdchem.HybridizationType.SP3]
+
+
+# Array-native XYZ reader for QM9, same parsing as xyz_graph_reader without building a networkx graph.
+# Returns a dict of per-atom arrays (n atoms) and bond arrays (b bonds, i<j), and the target list:
+#   coord (n,3), distance (n,n), a_type (n,) str, a_num, pc, acceptor, donor, aromatic, num_h (n,),
+#   hybridization (n,) index in HYBRIDIZATIONS or -1, bonds (b,2), b_type (b,) index in BOND_TYPES or -1
+def xyz_array_reader(graph_file, factory=None):
+
+  if hasattr(graph_file, 'readline'):
+    lines = graph_file.read().splitlines()
+  else:
+    with open(graph_file,'r') as f:
+      lines = f.read().splitlines()
+  #end if
+  na = int(lines[0])
+  l = init_labels(lines[1])
+  atom_properties = [line.replace('.*^', 'e').replace('*^', 'e').split() for line in lines[2:2+na]]
+  smiles = lines[3+na].split()[0]
+
+  m = Chem.MolFromSmiles(smiles)
+  m = Chem.AddHs(m)
+  n = m.GetNumAtoms()
+
+  coord = np.array([a[1:4] for a in atom_properties[:n]], dtype=np.float64)
+  pc = np.array([a[4] for a in atom_properties[:n]], dtype=np.float64)
+  return mol_arrays(m, coord, pc, factory), l
+
+
+# Geometry and Mulliken charges are not known for a bare SMILES: the molecule is embedded with
+# ETKDG and relaxed with MMFF, and the partial charges are Gasteiger's. Same arrays as xyz_array_reader.
+def smiles_array_reader(smiles, factory=None, seed=0):
+
+  m = Chem.MolFromSmiles(smiles)
+  if m is None:
+    raise ValueError("Invalid SMILES {}".format(smiles))
+  m = Chem.AddHs(m)
+  if AllChem.EmbedMolecule(m, randomSeed=seed) < 0 and AllChem.EmbedMolecule(m, randomSeed=seed, useRandomCoords=True) < 0:
+    raise ValueError("No conformer found for {}".format(smiles))
+  if AllChem.MMFFHasAllMoleculeParams(m):
+    AllChem.MMFFOptimizeMolecule(m)
+  AllChem.ComputeGasteigerCharges(m)
+
+  coord = m.GetConformer().GetPositions()
+  pc = np.nan_to_num(np.array([a.GetDoubleProp('_GasteigerCharge') for a in m.GetAtoms()], dtype=np.float64))
+  return mol_arrays(m, coord, pc, factory)
+
+
+# Arrays of xyz_array_reader for the RDKit molecule m, hydrogens included, at coord with partial charges pc
+def mol_arrays(m, coord, pc, factory=None):
+  n = m.GetNumAtoms()
+  diff = coord[:,None,:] - coord[None,:,:]
+  distance = np.sqrt((diff*diff).sum(-1))
+
+  atoms = list(m.GetAtoms())
+  mol = {
+      'coord': coord,
+      'distance': distance,
+      'a_type': np.array([a.GetSymbol() for a in atoms]),
+      'a_num': np.array([a.GetAtomicNum() for a in atoms], dtype=np.int64),
+      'pc': pc,
+      'acceptor': np.zeros(n, dtype=np.int64),
+      'donor': np.zeros(n, dtype=np.int64),
+      'aromatic': np.array([a.GetIsAromatic() for a in atoms], dtype=np.int64),
+      'hybridization': np.array([HYBRIDIZATIONS.index(a.GetHybridization()) if a.GetHybridization() in HYBRIDIZATIONS else -1
+                                 for a in atoms], dtype=np.int64),
+      'num_h': np.array([a.GetTotalNumHs() for a in atoms], dtype=np.int64),
+  }
+
+  if factory is None:
+    factory = get_feature_factory()
+  for feat in factory.GetFeaturesForMol(m):
+    if feat.GetFamily() == 'Donor':
+      mol['donor'][list(feat.GetAtomIds())] = 1
+    elif feat.GetFamily() == 'Acceptor':
+      mol['acceptor'][list(feat.GetAtomIds())] = 1
+  #end for
+
+  bonds = sorted((min(b.GetBeginAtomIdx(), b.GetEndAtomIdx()), max(b.GetBeginAtomIdx(), b.GetEndAtomIdx()),
+                  BOND_TYPES.index(b.GetBondType()) if b.GetBondType() in BOND_TYPES else -1)
+                 for b in m.GetBonds())
+  bonds = np.array(bonds, dtype=np.int64).reshape(-1, 3)
+  mol['bonds'] = bonds[:,:2]
+  mol['b_type'] = bonds[:,2]
+  return mol
+
+
+# Streams the .xyz files of a QM9 archive (e.g. dsgdb9nsd.xyz.tar.bz2) as (name, text) pairs
+# without extracting them, in archive order
+def iter_xyz_archive(archive_file):
+  with tarfile.open(archive_file, 'r|*') as tar:
+    for member in tar:
+      if member.isfile() and member.name.endswith('.xyz'):
+        yield os.path.basename(member.name), tar.extractfile(member).read().decode('utf-8')
+      #end if
+    #end for
+  #end with
+
+
+# Repacks a QM9 archive as a single uncompressed file plus an offset index, see XyzPack
+def pack_xyz_archive(archive_file, pack_file):
+  names = []
+  offsets = [0]
+  tmp_file = '{}.tmp{}'.format(pack_file, os.getpid())
+  with open(tmp_file, 'wb') as f:
+    for name, text in iter_xyz_archive(archive_file):
+      data = text.encode('utf-8')
+      f.write(data)
+      names.append(name)
+      offsets.append(offsets[-1] + len(data))
+    #end for
+  #end with
+  order = np.argsort(names, kind='stable')
+  with open(pack_file + '.index.npz', 'wb') as f:
+    np.savez(f, names=np.asarray(names, dtype=str)[order], starts=np.asarray(offsets[:-1], dtype=np.int64)[order],
+             ends=np.asarray(offsets[1:], dtype=np.int64)[order])
+  os.replace(tmp_file, pack_file)
+  return XyzPack(pack_file)
+
+
+class XyzPack(object):
+  """
+    Random access to the molecules of a file written by pack_xyz_archive. Reads are positioned
+    (os.pread) on one handle, so several threads may read at once.
+  """
+
+  def __init__(self, pack_file):
+    self.path = pack_file
+    index = np.load(pack_file + '.index.npz')
+    self.names = index['names']
+    self.starts = index['starts']
+    self.ends = index['ends']
+    self.lookup = {name: i for i, name in enumerate(self.names)}
+    self._f = None
+    self._lock = threading.Lock()
+
+  def __getstate__(self):
+    # Every process opens its own handle
+    state = self.__dict__.copy()
+    state['_f'] = None
+    del state['_lock']
+    return state
+
+  def __setstate__(self, state):
+    self.__dict__.update(state)
+    self._lock = threading.Lock()
+
+  def __len__(self):
+    return len(self.names)
+
+  def read(self, name):
+    if self._f is None:
+      with self._lock:
+        if self._f is None:
+          self._f = open(self.path, 'rb')
+    #end if
+    i = self.lookup[name]
+    return os.pread(self._f.fileno(), int(self.ends[i] - self.starts[i]), int(self.starts[i])).decode('utf-8')
+
+  def open(self, name):
+    return io.StringIO(self.read(name))
+#end XyzPack
+
+
 if __name__ == '__main__':
 
   g1 = create_graph_grec('/home/adutta/Workspace/Datasets/Graphs/GREC/data/image1_1.gxl')
@@ -5,6 +5,8 @@
 
 import numpy as np
 import os
+import torch
+import torch.distributed as dist
 import tensorboard_logger
 from tensorboard_logger import configure, log_value
 
@@ -21,42 +23,51 @@ def error_ratio(pred, target):
   return np.mean(np.divide(np.abs(pred - target), np.abs(target)))
 
 
-class AverageMeter(object):
-  """Computes and stores the average and current value"""
-  def __init__(self):
-    self.reset()
+def _item(value):
+  return value.item() if torch.is_tensor(value) else value
 
-  def reset(self):
-    self.val = 0
-    self.avg = 0
-    self.count = 0
 
-  def update(self, val, n=1):
-    if self.count:
-      self.val = val
-      self.avg = self.avg * (self.count-n)/self.count + val * n / self.count
-      self.count += n
-    else:
-      self.val = val
-      self.avg = val
-      self.count += n
-
-class AverageMeter__UNUSED(object):
-  """Computes and stores the average and current value"""
+class AverageMeter(object):
+  """
+    Computes and stores the average and current value.
+
+    Values may be tensors: the running sum is then kept on their device and only read, with a
+    synchronization, when val or avg are.
+  """
   def __init__(self):
     self.reset()
 
   def reset(self):
-    self.val = 0
-    self.avg = 0
-    self.sum = 0
+    self._val = 0
+    self._sum = 0
     self.count = 0
 
   def update(self, val, n=1):
-    self.val = val
-    self.sum += val * n
+    if torch.is_tensor(val):
+      val = val.detach()
+    self._val = val
+    self._sum = self._sum + val * n
     self.count += n
-    self.avg = self.sum / self.count
+
+  @property
+  def val(self):
+    return _item(self._val)
+
+  @property
+  def sum(self):
+    return _item(self._sum)
+
+  @property
+  def avg(self):
+    return self.sum / self.count if self.count else 0
+
+  def all_reduce(self):
+    """Sums the meter over the ranks of a torch.distributed job, val stays that of this rank"""
+    if dist.is_available() and dist.is_initialized():
+      total = torch.tensor([float(self.sum), float(self.count)], dtype=torch.float64)
+      dist.all_reduce(total)
+      self._sum, self.count = total[0].item(), int(total[1].item())
+    return self
 
 
 class Logger(object):
@@ -90,3 +101,12 @@ class Logger(object):
     elif os.path.isdir(path):
       import shutil
       shutil.rmtree(path)  # remove dir and all contains
+
+
+class NullLogger(object):
+  """Logger that discards everything, for the ranks other than 0 of a distributed job"""
+  def log_value(self, name, value):
+    return self
+
+  def step(self):
+    pass
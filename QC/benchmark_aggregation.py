@@ -0,0 +1,124 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+  benchmark_aggregation.py: Compares the incidence-matrix and scatter message aggregation of
+  EdgeGraphConvolution and MPNN_enn_edge.
+
+  Times a forward and backward pass of one layer over collated batches, for each batch size:
+
+    dense    N x E incidence matrix with torch.spmm, as built by the old collate
+    sparse   the same incidence matrix as a sparse COO tensor
+    sum, mean, max   scatter kernels over the E_tgt index
+
+  Molecules are taken from a preprocessed store (--cache) or generated with QM9-like sizes.
+
+  Usage:
+    python benchmark_aggregation.py
+    python benchmark_aggregation.py --cache ./data/qm9/cache/raw_distance/ --batch-sizes 20 64 512
+
+"""
+
+from __future__ import print_function
+
+import argparse
+import time
+
+import numpy as np
+import torch
+
+from datasets.utils import collate_g_concat_arrays
+from layers import EdgeGraphConvolution, EdgeEncoderMLP
+from mpnn import MPNN_enn_edge
+
+__author__ = "Pedro HC Avelar"
+__email__ = "phcavelar@inf.ufrgs.br"
+
+
+def random_molecules(count, node_features=13, edge_features=5, seed=0):
+  """Random trees plus a few ring-closing edges, with 9 to 29 atoms like QM9"""
+  rng = np.random.RandomState(seed)
+  graphs = []
+  for _ in range(count):
+    n = rng.randint(9, 30)
+    edges = {(rng.randint(i), i) for i in range(1, n)}
+    for _ in range(rng.randint(0, 4)):
+      i, j = sorted(rng.choice(n, 2, replace=False))
+      edges.add((i, j))
+    #end for
+    edge_index = np.array(sorted(edges), dtype=np.int64)
+    graphs.append(((rng.rand(n, node_features).astype(np.float32), edge_index,
+                    rng.rand(len(edge_index), edge_features).astype(np.float32)), np.zeros(12, dtype=np.float32)))
+  #end for
+  return graphs
+
+
+def store_molecules(path, count, seed=0):
+  from datasets import Qm9Cached
+  from datasets.store import GraphStore
+  store = GraphStore(path)
+  idx = np.random.RandomState(seed).choice(len(store), count, replace=count > len(store))
+  data = Qm9Cached(store, idx)
+  return [data[i] for i in range(len(data))]
+
+
+def incidence(Etgt, num_nodes):
+  return torch.zeros(num_nodes, Etgt.size(0)).index_put_((Etgt, torch.arange(Etgt.size(0))), torch.ones(Etgt.size(0)))
+
+
+def time_layer(layer, x, Esrc, Etgt, ef, repeats):
+  def step():
+    x.grad = None
+    layer(x, Esrc, Etgt, ef).sum().backward()
+  step()
+  start = time.perf_counter()
+  for _ in range(repeats):
+    step()
+  return (time.perf_counter() - start) / repeats * 1e3
+
+
+def main():
+  parser = argparse.ArgumentParser(description='Benchmark incidence-matrix against scatter message aggregation.')
+  parser.add_argument('--cache', help='Preprocessed store to draw the molecules from (default: random QM9-sized molecules)')
+  parser.add_argument('--batch-sizes', type=int, nargs='+', default=[20, 32, 64, 128, 256, 512])
+  parser.add_argument('--hidden', type=int, default=73, help='Hidden units (default: 73)')
+  parser.add_argument('--repeats', type=int, default=20, help='Timed repetitions per measurement (default: 20)')
+  parser.add_argument('--threads', type=int, default=None, help='torch intra-op threads')
+  args = parser.parse_args()
+
+  if args.threads:
+    torch.set_num_threads(args.threads)
+  torch.manual_seed(0)
+  modes = ['dense', 'sparse', 'sum', 'mean', 'max']
+  molecules = store_molecules(args.cache, max(args.batch_sizes)) if args.cache else random_molecules(max(args.batch_sizes))
+
+  print('Forward + backward time per layer (ms)')
+  print('{:>6} {:>6} {:>7} {:>14} '.format('batch', 'N', 'E', 'layer') + ' '.join('{:>8}'.format(m) for m in modes), flush=True)
+  for batch_size in args.batch_sizes:
+    _, B, X, E_d, E_src, E_tgt, _ = collate_g_concat_arrays(molecules[:batch_size])
+    N = X.size(0)
+    with torch.no_grad():
+      ef = EdgeEncoderMLP(E_d.size(1), args.hidden)(E_d)
+    x = torch.randn(N, args.hidden, requires_grad=True)
+    targets = {
+        'dense': incidence(E_tgt, N),
+        'sparse': incidence(E_tgt, N).to_sparse(),
+    }
+    for name, build in (('EdgeGCN', lambda aggr: EdgeGraphConvolution(args.hidden, args.hidden, aggr=aggr)),
+                        ('MPNN_enn_edge', lambda aggr: MPNN_enn_edge(E_d.size(1), args.hidden, aggr=aggr))):
+      times = []
+      for mode in modes:
+        aggr = mode if mode in ('sum', 'mean', 'max') else 'sum'
+        layer = build(aggr)
+        if isinstance(layer, MPNN_enn_edge):
+          layer.set_T(1)
+        times.append(time_layer(layer, x, E_src, targets.get(mode, E_tgt), ef, args.repeats))
+      #end for
+      print('{:>6} {:>6} {:>7} {:>14} '.format(batch_size, N, E_src.size(0), name) +
+            ' '.join('{:>8.2f}'.format(t) for t in times), flush=True)
+    #end for
+  #end for
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,140 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+  benchmark_dense.py: Forward and backward time of the models on the padded dense layout against
+  the concatenated (sparse) one, and what dense="auto" picks.
+
+  For each model, edge mode and batch size, batches are drawn either at random or, as with
+  --bucket, from molecules sorted by size, and timed on both layouts. The optimizer step is left
+  out, it is the same for both. With --complete every pair of atoms is connected, as in the
+  fully connected distance graphs of Gilmer et al.
+
+  fill is the fraction of the B x Nmax node slots holding a node and density the fraction of the
+  B x Nmax x Nmax pairs holding an edge, which dense.use_dense decides from.
+
+  Edge modes:
+    full       hidden x hidden edge matrices
+    rank       low rank edge matrices, --rank
+    discrete   edges grouped by type, with edge features replaced by 4 random bond types
+
+  Usage:
+    python benchmark_dense.py
+    python benchmark_dense.py --cache ./data/qm9/cache/raw_distance/ --batch-sizes 20 64 --models egcnsum enns2s
+    python benchmark_dense.py --complete --edges rank discrete
+
+"""
+
+from __future__ import print_function
+
+import argparse
+import time
+
+import numpy as np
+import torch
+
+import layer_models as models
+from benchmark_aggregation import random_molecules, store_molecules
+from datasets.utils import collate_g_concat_arrays
+from dense import dense_index, use_dense
+
+__author__ = "Pedro HC Avelar"
+__email__ = "phcavelar@inf.ufrgs.br"
+
+model_dict = {
+    "egcnsum": models.EdgeGCN_K_Sum,
+    "egcns2s": models.EdgeGCN_K_Set2Set,
+    "ennsum": models.MPNN_ENN_K_Sum,
+    "enns2s": models.MPNN_ENN_K_Set2Set,
+    "eress2s": models.EdgeRES1_K_Set2Set,
+}
+
+
+def bond_types(molecules, types=4, seed=0):
+  """The molecules with each edge feature replaced by a one-hot random bond type"""
+  rng = np.random.RandomState(seed)
+  return [((x, edge_index, np.eye(types, dtype=np.float32)[rng.randint(types, size=len(edge_index))]), y)
+          for (x, edge_index, _), y in molecules]
+
+
+def complete(molecules):
+  """The molecules with every pair of atoms connected, edge features taken from the bonds or zero"""
+  graphs = []
+  for (x, edge_index, edge_attr), y in molecules:
+    n = len(x)
+    pairs = np.array([(i, j) for i in range(n) for j in range(i+1, n)], dtype=np.int64).reshape(-1, 2)
+    attr = np.zeros((n, n, edge_attr.shape[1]), dtype=np.float32)
+    attr[edge_index[:,0], edge_index[:,1]] = edge_attr
+    graphs.append(((x, pairs, attr[pairs[:,0], pairs[:,1]]), y))
+  #end for
+  return graphs
+
+
+def time_step(model, batch, repeats):
+  _, B, X, E_d, E_src, E_tgt, Y = batch
+  def step():
+    model.zero_grad(set_to_none=True)
+    output = model(node_features=X, edge_features=E_d, Esrc=E_src, Etgt=E_tgt, batch=B)
+    torch.nn.functional.mse_loss(output, Y).backward()
+  #end step
+  step()
+  start = time.perf_counter()
+  for _ in range(repeats):
+    step()
+  return (time.perf_counter() - start) / repeats * 1e3
+
+
+def main():
+  parser = argparse.ArgumentParser(description='Benchmark the padded dense layout against the concatenated one.')
+  parser.add_argument('--cache', help='Preprocessed store to draw the molecules from (default: random QM9-sized molecules)')
+  parser.add_argument('--models', nargs='+', choices=sorted(model_dict.keys()), default=['egcnsum', 'enns2s'])
+  parser.add_argument('--edges', nargs='+', choices=['full', 'rank', 'discrete'], default=['full', 'rank', 'discrete'])
+  parser.add_argument('--complete', action='store_true', default=False, help='Connect every pair of atoms')
+  parser.add_argument('--batch-sizes', type=int, nargs='+', default=[8, 20, 64])
+  parser.add_argument('--hidden', type=int, default=73, help='Hidden units (default: 73)')
+  parser.add_argument('--layers', type=int, default=3, help='Message-passing layers (default: 3)')
+  parser.add_argument('--rank', type=int, default=4, help='Rank of the "rank" edge mode (default: 4)')
+  parser.add_argument('--repeats', type=int, default=5, help='Timed training steps per measurement (default: 5)')
+  parser.add_argument('--threads', type=int, default=None, help='torch intra-op threads')
+  args = parser.parse_args()
+
+  if args.threads:
+    torch.set_num_threads(args.threads)
+  count = max(args.batch_sizes)
+  molecules = store_molecules(args.cache, 100*count) if args.cache else random_molecules(100*count)
+  if args.complete:
+    molecules = complete(molecules)
+  by_size = sorted(molecules, key=lambda g: len(g[0][0]))
+
+  print('Forward + backward time (ms)')
+  print('{:>8} {:>8} {:>6} {:>7} {:>6} {:>8} {:>9} {:>9} {:>6}'.format(
+      'model', 'edges', 'batch', 'order', 'fill', 'density', 'sparse', 'dense', 'auto'), flush=True)
+  for name in args.models:
+    for edges in args.edges:
+      for batch_size in args.batch_sizes:
+        for order, graphs in (('random', molecules[:batch_size]), ('bucket', by_size[len(by_size)//2:len(by_size)//2+batch_size])):
+          if edges == 'discrete':
+            graphs = bond_types(graphs)
+          batch = collate_g_concat_arrays(graphs)
+          _, B, X, E_d, E_src, E_tgt, Y = batch
+          index = dense_index(B)
+          padded = index.num_graphs * index.max_nodes
+          times = []
+          for dense in ('never', 'always'):
+            torch.manual_seed(0)
+            model = model_dict[name](node_features=X.size(1), edge_features=E_d.size(1), target_features=Y.size(1),
+                                     hidden_features=args.hidden, num_layers=args.layers, s2s_processing_steps=4,
+                                     rank=args.rank if edges == 'rank' else None, discrete_edges=edges == 'discrete', dense=dense)
+            times.append(time_step(model, batch, args.repeats))
+          #end for
+          print('{:>8} {:>8} {:>6} {:>7} {:>6.2f} {:>8.3f} {:>9.1f} {:>9.1f} {:>6}'.format(
+              name, edges, batch_size, order, X.size(0) / padded, E_src.size(0) / (padded * index.max_nodes),
+              times[0], times[1], 'dense' if use_dense(index, E_src.size(0), typed=edges == 'discrete') else 'sparse'), flush=True)
+        #end for
+      #end for
+    #end for
+  #end for
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,100 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+  benchmark_edge_rank.py: Memory and throughput of the low-rank edge network against the full
+  hidden x hidden edge matrices.
+
+  For each model and rank, runs training steps (forward, backward, Adam) on one collated batch
+  and reports the size of the edge encoder output, the activations saved for backward and the
+  throughput in molecules per second.
+
+  Usage:
+    python benchmark_edge_rank.py
+    python benchmark_edge_rank.py --cache ./data/qm9/cache/raw_distance/ --batch-size 512 --ranks 1 4 16
+
+"""
+
+from __future__ import print_function
+
+import argparse
+import time
+
+import torch
+import torch.optim as optim
+
+import layer_models as models
+from benchmark_aggregation import random_molecules, store_molecules
+from datasets.utils import collate_g_concat_arrays
+
+__author__ = "Pedro HC Avelar"
+__email__ = "phcavelar@inf.ufrgs.br"
+
+model_dict = {
+    "egcnsum": models.EdgeGCN_K_Sum,
+    "egcns2s": models.EdgeGCN_K_Set2Set,
+    "ennsum": models.MPNN_ENN_K_Sum,
+    "enns2s": models.MPNN_ENN_K_Set2Set,
+}
+
+
+def saved_bytes(step):
+  """Runs step() and returns its result and the bytes of the distinct tensors autograd saved for backward"""
+  seen = {}
+  def pack(t):
+    seen[(t.data_ptr(), t.numel())] = t.numel() * t.element_size()
+    return t
+  with torch.autograd.graph.saved_tensors_hooks(pack, lambda t: t):
+    out = step()
+  return out, sum(seen.values())
+
+
+def main():
+  parser = argparse.ArgumentParser(description='Benchmark low-rank against full-rank edge networks.')
+  parser.add_argument('--cache', help='Preprocessed store to draw the molecules from (default: random QM9-sized molecules)')
+  parser.add_argument('--models', nargs='+', choices=sorted(model_dict.keys()), default=['egcnsum', 'ennsum'])
+  parser.add_argument('--ranks', type=int, nargs='+', default=[1, 2, 4, 8, 16])
+  parser.add_argument('--batch-size', type=int, default=128)
+  parser.add_argument('--hidden', type=int, default=73, help='Hidden units (default: 73)')
+  parser.add_argument('--layers', type=int, default=3, help='Message-passing layers (default: 3)')
+  parser.add_argument('--repeats', type=int, default=5, help='Timed training steps per configuration (default: 5)')
+  args = parser.parse_args()
+
+  molecules = store_molecules(args.cache, args.batch_size) if args.cache else random_molecules(args.batch_size)
+  batch_size, B, X, E_d, E_src, E_tgt, Y = collate_g_concat_arrays(molecules)
+  print('Batch of {} molecules, {} nodes, {} directed edges, hidden {}'.format(batch_size, X.size(0), E_src.size(0), args.hidden))
+  print('{:>8} {:>5} {:>9} {:>12} {:>12} {:>9} {:>9}'.format('model', 'rank', 'params', 'edge MB', 'saved MB', 'ms/step', 'mol/s'), flush=True)
+  for name in args.models:
+    for rank in [None] + args.ranks:
+      torch.manual_seed(0)
+      model = model_dict[name](node_features=X.size(1), edge_features=E_d.size(1), target_features=Y.size(1),
+                               hidden_features=args.hidden, num_layers=args.layers, rank=rank)
+      optimizer = optim.Adam(model.parameters())
+      def step():
+        optimizer.zero_grad()
+        output = model(node_features=X, edge_features=E_d, Esrc=E_src, Etgt=E_tgt, batch=B)
+        loss = torch.nn.functional.mse_loss(output, Y)
+        return loss
+      #end step
+      with torch.no_grad():
+        edge_data = model.ee(E_d)
+      edge_bytes = sum(t.numel() * t.element_size() for t in (edge_data if isinstance(edge_data, tuple) else (edge_data,)))
+      loss, activation_bytes = saved_bytes(step)
+      loss.backward()
+      optimizer.step()
+      start = time.perf_counter()
+      for _ in range(args.repeats):
+        loss = step()
+        loss.backward()
+        optimizer.step()
+      #end for
+      elapsed = (time.perf_counter() - start) / args.repeats
+      print('{:>8} {:>5} {:>9} {:>12.1f} {:>12.1f} {:>9.1f} {:>9.0f}'.format(
+          name, 'full' if rank is None else rank, sum(p.numel() for p in model.parameters()),
+          edge_bytes / 2**20, activation_bytes / 2**20, elapsed * 1e3, batch_size / elapsed), flush=True)
+    #end for
+  #end for
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,98 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+  benchmark_quantize.py: Accuracy against speed of the int8 dynamic quantized models.
+
+  For each checkpoint, the float32 model and its quantize.quantize_dynamic copy predict the valid
+  split of the store the model was trained on, from the same split manifest as train_egcn.py
+  uses. Batches are collated in advance and every model is timed over --repeats passes over the
+  split, keeping the fastest, on the CPU.
+
+  Reported are the size of the state dict, the throughput, the mean absolute error over the
+  normalized targets, which is the error train_egcn.py validates with, and how far the int8
+  predictions are from the float32 ones, in the same units. With --per-target, also the error
+  of each target in its own units.
+
+  Usage:
+    python benchmark_quantize.py ./checkpoint/egcnsum-3/qm9/all/model_best.pth ./checkpoint/enns2s-3/qm9/all/model_best.pth
+    python benchmark_quantize.py model_best.pth --cache-path ./data/qm9/cache/raw_distance/ --threads 1 --per-target
+
+"""
+
+from __future__ import print_function
+
+import argparse
+import time
+
+import numpy as np
+import torch
+
+import infer
+from datasets import Qm9Cached
+from datasets.splits import split_dir, seed_of, load_or_create, qm9_split
+from datasets.utils import collate_g_concat_arrays
+from quantize import quantize_dynamic, model_size
+
+__author__ = "Pedro HC Avelar"
+__email__ = "phcavelar@inf.ufrgs.br"
+
+
+def time_predictions(predictor, batches, repeats):
+  """Predictions for the batches and the fastest time of repeats passes over them"""
+  predict = lambda: np.concatenate([predictor.predict_batch(*batch[1:6]) for batch in batches])
+  outputs = predict()
+  best = float('inf')
+  for _ in range(repeats):
+    start = time.perf_counter()
+    predict()
+    best = min(best, time.perf_counter() - start)
+  #end for
+  return outputs, best
+
+
+def main():
+  parser = argparse.ArgumentParser(description='Accuracy and speed of int8 dynamic quantized models on the validation split.')
+  parser.add_argument('checkpoints', nargs='+', help='Checkpoints written by train_egcn.py')
+  parser.add_argument('--cache-path', help='Store to validate on (default: the one the checkpoint was trained on)')
+  parser.add_argument('--split', default='default', help='Split manifest of the store (default: default)')
+  parser.add_argument('--batch-size', type=int, default=100, help='Molecules per batch (default: 100)')
+  parser.add_argument('--repeats', type=int, default=3, help='Timed passes over the split (default: 3)')
+  parser.add_argument('--threads', type=int, default=None, help='torch intra-op threads')
+  parser.add_argument('--per-target', action='store_true', default=False, help='Also report the error of each target')
+  args = parser.parse_args()
+
+  if args.threads:
+    torch.set_num_threads(args.threads)
+  print('{:>18} {:>6} {:>9} {:>9} {:>8} {:>9} {:>9}'.format('model', 'dtype', 'size(KB)', 'mol/s', 'speedup', 'norm MAE', 'vs fp32'))
+  for checkpoint in args.checkpoints:
+    infer_args = infer.parser.parse_args(['--checkpoint', checkpoint, '--no-cuda'] + (['--cache-path', args.cache_path] if args.cache_path else []))
+    predictor, names, _, store = infer.load_predictor(infer_args)
+    if store is None:
+      raise ValueError("{} was not trained on a store, give one with --cache-path".format(checkpoint))
+    split = load_or_create(split_dir(store.path), args.split, lambda: qm9_split(len(store), seed_of(args.split)))
+    data = Qm9Cached(store, split['valid'])
+    batches = [collate_g_concat_arrays([data[i] for i in range(start, min(start+args.batch_size, len(data)))])
+               for start in range(0, len(data), args.batch_size)]
+    target = np.concatenate([batch[6].numpy() for batch in batches])
+    std = predictor.target_std.numpy() if predictor.target_std is not None else np.ones(target.shape[1])
+
+    name = type(predictor.model).__name__
+    quantized = infer.Predictor(quantize_dynamic(predictor.model), predictor.target_mean, predictor.target_std)
+    results = [(dtype, p) + time_predictions(p, batches, args.repeats) for dtype, p in (('fp32', predictor), ('int8', quantized))]
+    fp32_output, fp32_time = results[0][2], results[0][3]
+    for dtype, p, output, seconds in results:
+      print('{:>18} {:>6} {:>9.1f} {:>9.1f} {:>8.2f} {:>9.4f} {:>9.4f}'.format(
+          name, dtype, model_size(p.model) / 1024., len(data) / seconds, fp32_time / seconds,
+          np.mean(np.abs(output - target) / std), np.mean(np.abs(output - fp32_output) / std)), flush=True)
+    #end for
+    if args.per_target:
+      print('\t{:>8} {:>12} {:>12}'.format('target', 'fp32 MAE', 'int8 MAE'))
+      for i, target_name in enumerate(names):
+        print('\t{:>8} {:>12.5g} {:>12.5g}'.format(target_name, *(np.mean(np.abs(output[:,i] - target[:,i])) for _, _, output, _ in results)))
+    #end if
+  #end for
+
+
+if __name__ == '__main__':
+  main()
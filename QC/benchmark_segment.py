@@ -0,0 +1,114 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+  benchmark_segment.py: Times the segment reductions of segment.py against the implementations
+  they replace.
+
+  For batches of QM9-sized graphs (9 to 29 nodes), times forward and backward of:
+
+    max       the element-by-element Python loop formerly in torch_scatter.scatter_max (1-D
+              scores only), scatter_max and the sorted segment_csr path
+    softmax   the per-graph masked softmax loop formerly in Set2Set, scatter_softmax and
+              segment_softmax_csr
+    sum, mean, min   scatter against segment_csr on N x hidden node features
+
+  Usage:
+    python benchmark_segment.py
+    python benchmark_segment.py --batch-sizes 20 512 --hidden 73
+
+"""
+
+from __future__ import print_function
+
+import argparse
+import time
+
+import torch
+import torch.nn.functional as F
+
+from segment import scatter, scatter_softmax, segment_csr, segment_softmax_csr, index_to_ptr
+
+__author__ = "Pedro HC Avelar"
+__email__ = "phcavelar@inf.ufrgs.br"
+
+
+def legacy_scatter_max(src, index, dim_size):
+  """The element-by-element loop formerly used by torch_scatter.scatter_max, for 1-D src"""
+  out = src.new_full((dim_size,), -torch.finfo(src.dtype).max)
+  arg = index.new_full((dim_size,), -1)
+  for i in range(index.size(0)):
+    idx = index[i]
+    if src[i] >= out[idx]:
+      out[idx] = src[i]
+      arg[idx] = i
+  #end for
+  return out, arg
+
+
+def legacy_softmax(src, index, dim_size):
+  """The per-graph loop formerly used by Set2Set"""
+  a = torch.zeros([src.size(0)], dtype=src.dtype, device=src.device)
+  one_t = torch.ones_like(index)
+  for i in range(dim_size):
+    mask = index.eq(one_t*i)
+    a[mask] += F.softmax(torch.masked_select(src, mask), dim=0)
+  #end for
+  return a
+
+
+def timed(f, x, repeats):
+  """Milliseconds per forward (and backward, if x requires grad) of f(x)"""
+  def step():
+    x.grad = None
+    out = f(x)
+    out = out[0] if isinstance(out, tuple) else out
+    if x.requires_grad:
+      out.sum().backward()
+  step()
+  start = time.perf_counter()
+  for _ in range(repeats):
+    step()
+  return (time.perf_counter() - start) / repeats * 1e3
+
+
+def main():
+  parser = argparse.ArgumentParser(description='Benchmark the segment reductions.')
+  parser.add_argument('--batch-sizes', type=int, nargs='+', default=[20, 128, 512])
+  parser.add_argument('--hidden', type=int, default=73, help='Feature width of the sum/mean/min reductions (default: 73)')
+  parser.add_argument('--repeats', type=int, default=10, help='Timed repetitions per measurement (default: 10)')
+  parser.add_argument('--skip-legacy', action='store_true', default=False, help='Do not time the Python loops.')
+  args = parser.parse_args()
+
+  torch.manual_seed(0)
+  print('{:>6} {:>6} {:>8} {:>14} {:>10}'.format('batch', 'N', 'op', 'method', 'ms'), flush=True)
+  def report(batch_size, N, op, method, ms):
+    print('{:>6} {:>6} {:>8} {:>14} {:>10.3f}'.format(batch_size, N, op, method, ms), flush=True)
+  for batch_size in args.batch_sizes:
+    n = torch.randint(9, 30, (batch_size,))
+    batch = torch.repeat_interleave(torch.arange(batch_size), n)
+    ptr = index_to_ptr(batch, batch_size)
+    N = batch.size(0)
+    scores = torch.randn(N, requires_grad=True)
+
+    if not args.skip_legacy:
+      with torch.no_grad():
+        report(batch_size, N, 'max', 'legacy loop', timed(lambda s: legacy_scatter_max(s, batch, batch_size), scores.detach(), 1))
+    report(batch_size, N, 'max', 'scatter', timed(lambda s: scatter(s, batch, 0, batch_size, 'max'), scores, args.repeats))
+    report(batch_size, N, 'max', 'csr', timed(lambda s: segment_csr(s, ptr, 0, 'max'), scores, args.repeats))
+
+    if not args.skip_legacy:
+      report(batch_size, N, 'softmax', 'legacy loop', timed(lambda s: legacy_softmax(s, batch, batch_size), scores, args.repeats))
+    report(batch_size, N, 'softmax', 'scatter', timed(lambda s: scatter_softmax(s, batch, 0, batch_size), scores, args.repeats))
+    report(batch_size, N, 'softmax', 'csr', timed(lambda s: segment_softmax_csr(s, ptr), scores, args.repeats))
+
+    x = torch.randn(N, args.hidden, requires_grad=True)
+    for reduce in ('sum', 'mean', 'min'):
+      report(batch_size, N, reduce, 'scatter', timed(lambda v: scatter(v, batch, 0, batch_size, reduce), x, args.repeats))
+      report(batch_size, N, reduce, 'csr', timed(lambda v: segment_csr(v, ptr, 0, reduce), x, args.repeats))
+    #end for
+  #end for
+
+
+if __name__ == '__main__':
+  main()
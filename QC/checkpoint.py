@@ -0,0 +1,172 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+  checkpoint.py: Checkpoints written on a background thread.
+
+  save() copies the state (model and optimizer state dicts, or anything holding tensors) to the
+  CPU and returns, a worker thread serializes it to a temporary file in the checkpoint directory
+  and renames it into place, so that a checkpoint file is always complete. Training only waits
+  for the device to CPU copy, or for the previous checkpoint when it is still being written.
+
+  Every checkpoint gets its own file. The most recent one is also linked as checkpoint.pth and
+  the best one as model_best.pth, as hard links (copies where the filesystem has no hard links).
+  Of the numbered files, only the last keep_last and the best keep_best are kept.
+
+  Usage:
+    checkpoints = CheckpointWriter(directory, keep_last=2, keep_best=3, compare=lambda x, y: x < y)
+    checkpoints.save({'epoch': epoch, 'state_dict': model.state_dict()}, is_best=is_best, metric=er1)
+    checkpoints.close()
+
+"""
+
+import atexit
+import functools
+import os
+import queue
+import shutil
+import tempfile
+import threading
+
+import torch
+
+__author__ = "Pedro HC Avelar"
+__email__ = "phcavelar@inf.ufrgs.br"
+
+
+def to_cpu(state):
+  """Copy of state with every tensor copied to the CPU, so that training can go on modifying the originals"""
+  if torch.is_tensor(state):
+    return state.detach().to('cpu', copy=True)
+  if isinstance(state, dict):
+    return type(state)((k, to_cpu(v)) for k, v in state.items())
+  if isinstance(state, (list, tuple)):
+    return type(state)(to_cpu(v) for v in state)
+  return state
+
+
+def atomic_save(state, path):
+  """torch.save to a temporary file next to path, renamed to path once written"""
+  fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix='.tmp')
+  try:
+    with os.fdopen(fd, 'wb') as f:
+      torch.save(state, f)
+      f.flush()
+      os.fsync(f.fileno())
+    os.replace(tmp, path)
+  except BaseException:
+    os.remove(tmp)
+    raise
+
+
+def atomic_link(src, dst):
+  """Points dst at the contents of src, with a hard link where possible and a copy otherwise"""
+  tmp = '{}.{}.tmp'.format(dst, os.getpid())
+  try:
+    os.link(src, tmp)
+  except OSError:
+    shutil.copyfile(src, tmp)
+  os.replace(tmp, dst)
+
+
+class CheckpointWriter(object):
+  """
+    Writes checkpoints to directory on a background thread, see the module documentation.
+
+    compare(x, y) tells if metric x is better than y, it ranks the checkpoints for keep_best.
+    keep_last=None keeps every checkpoint, latest or best set to None skips that link. At most
+    max_pending snapshots wait to be written, further saves block until one is.
+  """
+
+  def __init__(self, directory, keep_last=1, keep_best=1, compare=None, latest='checkpoint.pth', best='model_best.pth', max_pending=1):
+    if not os.path.isdir(directory):
+      os.makedirs(directory)
+    self.directory = directory
+    self.keep_last = keep_last
+    self.keep_best = keep_best
+    self.compare = compare if compare is not None else (lambda x, y: x < y)
+    self.latest = latest
+    self.best = best
+    self.count = 0
+    # (path, metric) of the checkpoints written, oldest first
+    self.written = []
+    self.error = None
+    self.queue = queue.Queue(max_pending)
+    self.thread = threading.Thread(target=self._run, daemon=True)
+    self.thread.start()
+    atexit.register(self.close)
+  #end __init__
+
+  def save(self, state, filename=None, is_best=False, metric=None):
+    """Snapshots state and queues it to be written as filename (default checkpoint_<count>.pth)"""
+    self._raise()
+    if self.thread is None:
+      raise RuntimeError("The checkpoint writer is closed")
+    self.count += 1
+    if filename is None:
+      filename = 'checkpoint_{:04d}.pth'.format(self.count)
+    self.queue.put((to_cpu(state), os.path.join(self.directory, filename), is_best, metric))
+
+  def _run(self):
+    while True:
+      item = self.queue.get()
+      try:
+        if item is None:
+          return
+        if self.error is None:
+          self._write(*item)
+      except BaseException as e:
+        self.error = e
+      finally:
+        self.queue.task_done()
+    #end while
+
+  def _write(self, state, path, is_best, metric):
+    atomic_save(state, path)
+    if self.latest is not None:
+      atomic_link(path, os.path.join(self.directory, self.latest))
+    if is_best and self.best is not None:
+      atomic_link(path, os.path.join(self.directory, self.best))
+    self.written = [w for w in self.written if w[0] != path] + [(path, metric)]
+    self._prune()
+
+  def _prune(self):
+    if self.keep_last is None:
+      return
+    keep = {path for path, _ in self.written[len(self.written)-self.keep_last:]} if self.keep_last > 0 else set()
+    if self.keep_best:
+      better = functools.cmp_to_key(lambda a, b: -1 if self.compare(a[1], b[1]) else (1 if self.compare(b[1], a[1]) else 0))
+      ranked = sorted((w for w in self.written if w[1] is not None), key=better)
+      keep.update(path for path, _ in ranked[:self.keep_best])
+    #end if
+    for path, _ in self.written:
+      if path not in keep and os.path.exists(path):
+        os.remove(path)
+    self.written = [w for w in self.written if w[0] in keep]
+
+  def _raise(self):
+    if self.error is not None:
+      error, self.error = self.error, None
+      raise error
+
+  def wait(self):
+    """Blocks until every queued checkpoint is written"""
+    if self.thread is not None:
+      self.queue.join()
+    self._raise()
+
+  def close(self):
+    """Writes the queued checkpoints and stops the worker thread"""
+    if self.thread is not None:
+      self.queue.put(None)
+      self.thread.join()
+      self.thread = None
+      atexit.unregister(self.close)
+    self._raise()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc):
+    self.close()
+#end CheckpointWriter
@@ -7,10 +7,11 @@
   download.py: Download the needed datasets.
 
   Usage:
-    download.py [-h] [-p dir] D [D ...]
+    download.py [-h] [-p dir] [--pack] D [D ...]
   Example:
     $ ./download.py qm9 mutag enzymes -p ./
     $ python download.py qm9 mutag enzymes -p ./
+    $ python download.py qm9 -p ./ --pack
 
 """
 
@@ -22,6 +23,9 @@ import os
 import wget
 import zipfile
 import tarfile
+import sys
+
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
 
 # Download file
 def download_file(url, file_ext, dir_path='./'):
@@ -57,8 +61,9 @@ def download_figshare(file_name, file_ext, dir_path='./', change_name = None):
   elif change_name is not None:
     os.rename(file_path, os.path.join(dir_path, change_name))
 
-# Download QM9 dataset
-def download_qm9(data_dir):
+# Download QM9 dataset, with pack=True the molecules are repacked in a single
+# file (dsgdb9nsd.xyz.pack) instead of being extracted as ~134k .xyz files
+def download_qm9(data_dir, pack=False):
   data_dir = os.path.join(data_dir, 'qm9')
   if os.path.exists(data_dir):
     print('Found QM9 dataset - SKIP!')
@@ -75,7 +80,12 @@ def download_qm9(data_dir):
   # Uncharacterized
   download_figshare('3195404', '.txt', data_dir, 'uncharacterized.txt')
   # dsgdb9nsd.xyz.tar.bz2
-  download_figshare('3195389', '.tar.bz2', data_dir, 'dsgdb9nsd')
+  if pack:
+    from GraphReader.graph_reader import pack_xyz_archive
+    download_figshare('3195389', '', data_dir, 'dsgdb9nsd.xyz.tar.bz2')
+    pack_xyz_archive(os.path.join(data_dir, 'dsgdb9nsd.xyz.tar.bz2'), os.path.join(data_dir, 'dsgdb9nsd.xyz.pack'))
+  else:
+    download_figshare('3195389', '.tar.bz2', data_dir, 'dsgdb9nsd')
   # dsC7O2H10nsd.xyz.tar.bz2
   download_figshare('3195398', '.tar.bz2', data_dir, 'dsC702H10nsd')
 
@@ -94,6 +104,8 @@ if __name__ == '__main__':
   # I/O
   parser.add_argument('-p', '--path', metavar='dir', type=str, nargs=1,
             help='path to store the data (default ./)')
+  parser.add_argument('--pack', action='store_true', default=False,
+            help='keep the QM9 archive and repack it as a single file instead of extracting it')
 
   args = parser.parse_args()
 
@@ -108,7 +120,7 @@ if __name__ == '__main__':
 
   # Select datasets
   if 'qm9' in args.datasets:
-    download_qm9(args.path)
+    download_qm9(args.path, pack=args.pack)
   if 'mutag' in args.datasets:
     download_figshare('3132449', '.zip', args.path)
   if 'enzymes' in args.datasets:
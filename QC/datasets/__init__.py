@@ -4,6 +4,6 @@ from .grec import GREC
 from .gwhistograph import GWHISTOGRAPH
 from .letter import LETTER
 from .mutag import MUTAG
-from .qm9 import Qm9
+from .qm9 import Qm9, Qm9Cached
 
-__all__ = ('GREC', 'GWHISTOGRAPH', 'LETTER', 'MUTAG', 'Qm9')
+__all__ = ('GREC', 'GWHISTOGRAPH', 'LETTER', 'MUTAG', 'Qm9', 'Qm9Cached')
@@ -0,0 +1,221 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+  featurize.py: Parallel, resumable builder for the preprocessed dataset stores.
+
+  The file list is split in fixed-size shards which are featurized by a process
+  pool, each worker building its RDKit feature factory once. Every shard is written
+  as a store of its own, so an interrupted build resumes from the missing shards,
+  and the shards are merged in file order at the end.
+
+  QM9 can also be read from a file written by pack_xyz_archive (--root), or streamed
+  straight out of dsgdb9nsd.xyz.tar.bz2 (--archive), in which case the main process
+  decompresses the archive and hands the molecules to the workers shard by shard.
+
+  Usage:
+    python -m datasets.featurize qm9 --root ./data/qm9/dsgdb9nsd/ --out ./data/qm9/cache/raw_distance/
+    python -m datasets.featurize qm9 --archive ./data/qm9/dsgdb9nsd.xyz.tar.bz2 --out ./data/qm9/cache/raw_distance/
+    python -m datasets.featurize mutag --root ./data/mutag/ --out ./data/mutag/cache/ --workers 4
+
+"""
+
+from __future__ import print_function
+
+import argparse
+import collections
+import itertools
+import multiprocessing
+import os
+import shutil
+import sys
+import time
+
+from datasets.store import GraphStore, store_exists, write_store, merge_stores
+
+__author__ = "Pedro HC Avelar"
+__email__ = "phcavelar@inf.ufrgs.br"
+
+
+def init_worker():
+  from GraphReader.graph_reader import get_feature_factory
+  get_feature_factory()
+
+
+_packs = {}
+
+def featurize_qm9(root, f, e_representation='raw_distance', text=None):
+  from datasets.qm9 import qm9_graph_arrays
+  from GraphReader.graph_reader import XyzPack
+  if text is None and os.path.isfile(root):
+    if root not in _packs:
+      _packs[root] = XyzPack(root)
+    root = _packs[root]
+  return qm9_graph_arrays(root, f, e_representation, text)
+
+
+def featurize_mutag(root, f, e_representation=None, text=None):
+  if text is not None:
+    raise NotImplementedError("MUTAG can only be featurized from its directory")
+  from GraphReader.graph_reader import create_graph_mutag
+  g, c = create_graph_mutag(os.path.join(root, f))
+  # Nodes are numbered from 1 in the MUTAG files
+  nodes = sorted(g.nodes())
+  x = [[g.node[n]['labels']] for n in nodes]
+  edges = sorted((min(n1, n2)-1, max(n1, n2)-1, d['weight']) for n1, n2, d in g.edges(data=True))
+  return f, x, [e[:2] for e in edges], [[e[2]] for e in edges], [c]
+
+
+featurizers = {
+    'qm9': featurize_qm9,
+    'mutag': featurize_mutag,
+}
+
+
+def list_files(root):
+  if os.path.isfile(root):
+    from GraphReader.graph_reader import XyzPack
+    return list(XyzPack(root).names)
+  return sorted(f for f in os.listdir(root) if os.path.isfile(os.path.join(root, f)))
+
+
+def iter_shards(items, shard_size):
+  items = iter(items)
+  shard = list(itertools.islice(items, shard_size))
+  while shard:
+    yield shard
+    shard = list(itertools.islice(items, shard_size))
+
+
+def shard_path(shard_dir, shard_id):
+  return os.path.join(shard_dir, 'shard_{:05d}'.format(shard_id))
+
+
+def featurize_shard(task):
+  """
+    Featurizes one shard into its own store, skipping molecules that fail to parse.
+
+    The shard holds file names, or (name, text) pairs when streaming from an archive.
+  """
+  dataset, root, items, path, e_representation = task
+  start = time.time()
+  featurize = featurizers[dataset]
+  files = [item[0] if isinstance(item, tuple) else item for item in items]
+  graphs, failed = [], []
+  for f, item in zip(files, items):
+    try:
+      graphs.append(featurize(root, f, e_representation, item[1] if isinstance(item, tuple) else None))
+    except Exception as e:
+      failed.append((f, repr(e)))
+    #end try
+  #end for
+  if graphs:
+    write_store(path, graphs, meta={'dataset': dataset, 'e_representation': e_representation,
+                                    'first': files[0], 'last': files[-1]})
+  else:
+    # Leave an empty marker so that the shard is not retried on resume
+    os.makedirs(path, exist_ok=True)
+    open(os.path.join(path, 'EMPTY'), 'w').close()
+  return path, len(graphs), failed, time.time() - start
+
+
+def shard_done(path, files):
+  if os.path.isfile(os.path.join(path, 'EMPTY')):
+    return True
+  if not store_exists(path):
+    return False
+  meta = GraphStore(path).meta
+  return meta.get('first') == files[0] and meta.get('last') == files[-1]
+
+
+def build(dataset, root, out, e_representation='raw_distance', workers=None, shard_size=2000, keep_shards=False, archive=None):
+  shard_dir = os.path.normpath(out) + '.shards'
+  if not os.path.isdir(shard_dir):
+    os.makedirs(shard_dir)
+  if archive is None:
+    files = list_files(root)
+    shards = iter_shards(files, shard_size)
+    print('{} files in {} shards'.format(len(files), (len(files)+shard_size-1)//shard_size), flush=True)
+  else:
+    from GraphReader.graph_reader import iter_xyz_archive
+    shards = iter_shards(iter_xyz_archive(archive), shard_size)
+    print('Streaming {}'.format(archive), flush=True)
+  #end if
+
+  start = time.time()
+  paths = []
+  done = 0
+  failed = []
+  skipped = 0
+  workers = workers if workers else multiprocessing.cpu_count()
+  pool = multiprocessing.Pool(workers, initializer=init_worker)
+  # Bound the shards in flight, so that streaming an archive never holds all of it in memory
+  pending = collections.deque()
+  def report(result):
+    path, n, shard_failed, shard_time = result.get()
+    elapsed = time.time() - start
+    print('\t{}: {} molecules in {:.1f}s ({:.1f} mol/s); total {} ({:.1f} mol/s)'.format(
+        os.path.basename(path), n, shard_time, n/max(shard_time, 1e-9), done+n, (done+n)/max(elapsed, 1e-9)), flush=True)
+    return n, shard_failed
+  try:
+    for shard_id, shard in enumerate(shards):
+      path = shard_path(shard_dir, shard_id)
+      paths.append(path)
+      if shard_done(path, [item[0] if isinstance(item, tuple) else item for item in shard]):
+        skipped += 1
+        continue
+      #end if
+      pending.append(pool.apply_async(featurize_shard, ((dataset, root, shard, path, e_representation),)))
+      while len(pending) >= 2*workers:
+        n, shard_failed = report(pending.popleft())
+        done += n
+        failed += shard_failed
+      #end while
+    #end for
+    while pending:
+      n, shard_failed = report(pending.popleft())
+      done += n
+      failed += shard_failed
+    #end while
+  finally:
+    pool.close()
+    pool.join()
+  #end try
+  if skipped:
+    print('\tReused {} shards from a previous run'.format(skipped))
+  for f, err in failed[:20]:
+    print('\tFailed to featurize {}: {}'.format(f, err), file=sys.stderr)
+  if len(failed) > 20:
+    print('\t... and {} more'.format(len(failed)-20), file=sys.stderr)
+
+  stores = [path for path in paths if store_exists(path)]
+  if not stores:
+    raise ValueError("No graph of {} could be featurized".format(archive if archive else root))
+  store = merge_stores(out, stores, meta={'dataset': dataset, 'e_representation': e_representation})
+  if not keep_shards:
+    shutil.rmtree(shard_dir)
+  elapsed = time.time() - start
+  print('Wrote {} graphs to {}; featurized {} molecules in {:.1f}s ({:.1f} mol/s), {} failed'.format(
+      len(store), store.path, done, elapsed, done/max(elapsed, 1e-9), len(failed)), flush=True)
+  return store
+
+
+if __name__ == '__main__':
+
+  parser = argparse.ArgumentParser(description='Featurize a dataset into a preprocessed store.')
+  parser.add_argument('dataset', choices=sorted(featurizers.keys()), help='Dataset to featurize.')
+  parser.add_argument('--root', help='Directory with the dataset files, or a QM9 file written by pack_xyz_archive.')
+  parser.add_argument('--archive', help='QM9 .tar.bz2 archive to stream the molecules from, instead of --root.')
+  parser.add_argument('--out', required=True, help='Directory to write the store to.')
+  parser.add_argument('--e-representation', default='raw_distance', choices=['raw_distance', 'chem_graph', 'distance_bin'],
+            help='QM9 edge representation (default: raw_distance)')
+  parser.add_argument('--workers', type=int, default=None, help='Worker processes (default: all cores)')
+  parser.add_argument('--shard-size', type=int, default=2000, help='Files per shard (default: 2000)')
+  parser.add_argument('--keep-shards', action='store_true', default=False, help='Keep the shard stores after merging.')
+
+  args = parser.parse_args()
+  if (args.root is None) == (args.archive is None):
+    parser.error('exactly one of --root and --archive is required')
+  if args.archive is not None and args.dataset != 'qm9':
+    parser.error('--archive is only supported for qm9')
+  build(args.dataset, args.root, args.out, args.e_representation, args.workers, args.shard_size, args.keep_shards, args.archive)
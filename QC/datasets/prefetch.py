@@ -0,0 +1,94 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+  prefetch.py: Batch loader collating in threads, with a ring buffer of prefetched batches.
+
+  A drop-in replacement for torch.utils.data.DataLoader over the preprocessed stores: the
+  graphs are read from the memory-mapped store arrays, which all threads share, and each
+  batch is fetched and collated by a thread pool, so nothing is pickled between processes.
+  Up to prefetch batches are kept in flight ahead of the training loop and handed out in
+  order. Collation is numpy and torch work that mostly releases the GIL.
+
+  Usage:
+    loader = ThreadedLoader(data, batch_size=20, shuffle=True, collate_fn=collate_fn, num_threads=4, prefetch=2)
+    for batch in loader:
+      ...
+
+"""
+
+import collections
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+from torch.utils.data import BatchSampler, RandomSampler, SequentialSampler
+
+__author__ = "Pedro HC Avelar"
+__email__ = "phcavelar@inf.ufrgs.br"
+
+
+def _pin(batch):
+  if torch.is_tensor(batch):
+    return batch.pin_memory()
+  if isinstance(batch, (list, tuple)):
+    return type(batch)(_pin(b) for b in batch)
+  return batch
+
+
+class ThreadedLoader(object):
+  """
+    Iterates over the batches of data like a DataLoader, see the module documentation.
+
+    Batches are drawn from batch_sampler if given, otherwise batch_size graphs at a time, in
+    order or shuffled. num_threads threads collate, with up to prefetch batches in flight.
+  """
+
+  def __init__(self, data, batch_size=1, shuffle=False, collate_fn=None, num_threads=2, prefetch=2,
+               batch_sampler=None, pin_memory=False, drop_last=False):
+    self.dataset = data
+    if batch_sampler is None:
+      sampler = RandomSampler(data) if shuffle else SequentialSampler(data)
+      batch_sampler = BatchSampler(sampler, batch_size, drop_last)
+    self.batch_sampler = batch_sampler
+    self.collate_fn = collate_fn if collate_fn is not None else torch.utils.data.default_collate
+    self.num_threads = max(num_threads, 1)
+    self.prefetch = max(prefetch, 1)
+    self.pin_memory = pin_memory and torch.cuda.is_available()
+    self._pool = None
+
+  def _load(self, indices):
+    batch = self.collate_fn([self.dataset[i] for i in indices])
+    return _pin(batch) if self.pin_memory else batch
+
+  def __iter__(self):
+    if self._pool is None:
+      self._pool = ThreadPoolExecutor(self.num_threads, thread_name_prefix='ThreadedLoader')
+    batches = iter(self.batch_sampler)
+    # Ring buffer of the batches in flight, oldest first
+    pending = collections.deque()
+    try:
+      for indices in batches:
+        pending.append(self._pool.submit(self._load, indices))
+        if len(pending) > self.prefetch:
+          yield pending.popleft().result()
+      #end for
+      while pending:
+        yield pending.popleft().result()
+    finally:
+      # Stopped early, e.g. by an exception in the training loop
+      for future in pending:
+        future.cancel()
+    #end try
+
+  def __len__(self):
+    return len(self.batch_sampler)
+
+  def close(self):
+    if self._pool is not None:
+      self._pool.shutdown(wait=True)
+      self._pool = None
+
+  def __del__(self):
+    if self._pool is not None:
+      self._pool.shutdown(wait=False)
+#end ThreadedLoader
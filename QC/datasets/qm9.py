@@ -19,6 +19,7 @@ import argparse
 
 import datasets.utils as utils
 import time
+import io
 import os,sys
 
 import torch
@@ -27,14 +28,15 @@ reader_folder = os.path.realpath( os.path.abspath('../GraphReader'))
 if reader_folder not in sys.path:
   sys.path.insert(1, reader_folder)
 
-from GraphReader.graph_reader import xyz_graph_reader
+from GraphReader.graph_reader import xyz_graph_reader, xyz_array_reader, smiles_array_reader, XyzPack
+from datasets.store import GraphStore, write_store
 
 __author__ = "Pau Riba, Anjan Dutta"
 __email__ = "priba@cvc.uab.cat, adutta@cvc.uab.cat"
 
 class Qm9(data.Dataset):
 
-  # Constructor
+  # Constructor, root_path is either the directory of .xyz files or an XyzPack
   def __init__(self, root_path, ids, vertex_transform=utils.qm9_nodes, edge_transform=utils.qm9_edges,
          target_transform=None, e_representation='raw_distance'):
     self.root = root_path
@@ -45,7 +47,7 @@ class Qm9(data.Dataset):
     self.e_representation = e_representation
 
   def __getitem__(self, index):
-    g, target = xyz_graph_reader(os.path.join(self.root, self.ids[index]))
+    g, target = xyz_graph_reader(open_xyz(self.root, self.ids[index]))
     if self.vertex_transform is not None:
       h = self.vertex_transform(g)
 
@@ -63,18 +65,92 @@ class Qm9(data.Dataset):
   def set_target_transform(self, target_transform):
     self.target_transform = target_transform
 
+
+class Qm9Cached(data.Dataset):
+  """
+    QM9 served from a store written by preprocess_qm9.
+
+    Items are ((x, edge_index, edge_attr), target), where the arrays are zero-copy
+    slices of the memory-mapped store, so workers never parse or featurize molecules.
+  """
+
+  # Constructor
+  def __init__(self, store, ids=None, target_transform=None):
+    self.store = store if isinstance(store, GraphStore) else GraphStore(store)
+    self.ids = np.arange(len(self.store)) if ids is None else np.asarray(ids, dtype=np.int64)
+    self.target_transform = target_transform
+    self.e_representation = self.store.meta['e_representation']
+
+  def __getitem__(self, index):
+    x, edge_index, edge_attr, target = self.store[self.ids[index]]
+
+    if self.target_transform is not None:
+      target = self.target_transform(target)
+
+    return (x, edge_index, edge_attr), target
+
+  def __len__(self):
+    return len(self.ids)
+
+  def set_target_transform(self, target_transform):
+    self.target_transform = target_transform
+
+  def num_nodes(self):
+    return self.store.num_nodes()[self.ids]
+
+  def num_edges(self):
+    """Directed edges of each graph, as collated"""
+    return 2*self.store.num_edges()[self.ids]
+
+
+def open_xyz(root, f):
+  """Path or open file of molecule f, from a directory or an XyzPack"""
+  if isinstance(root, XyzPack):
+    return root.open(f)
+  return os.path.join(root, f)
+
+
+def qm9_graph_arrays(root, f, e_representation='raw_distance', text=None):
+  """Reads and featurizes one molecule into (id, x, edge_index, edge_attr, y) store arrays."""
+  mol, target = xyz_array_reader(io.StringIO(text) if text is not None else open_xyz(root, f))
+  edge_index, edge_attr = utils.qm9_edges_array(mol, e_representation)
+  return f, utils.qm9_nodes_array(mol), edge_index, edge_attr, target
+
+
+def smiles_graph_arrays(smiles, e_representation='raw_distance'):
+  """Featurizes one molecule given as SMILES into (x, edge_index, edge_attr) store arrays, see smiles_array_reader."""
+  mol = smiles_array_reader(smiles)
+  edge_index, edge_attr = utils.qm9_edges_array(mol, e_representation)
+  return utils.qm9_nodes_array(mol), edge_index, edge_attr
+
+
+def preprocess_qm9(root, files, store_path, e_representation='raw_distance'):
+  """One-time featurization of the QM9 .xyz files into a memory-mapped store."""
+  graphs = (qm9_graph_arrays(root, f, e_representation) for f in files)
+  return write_store(store_path, graphs, meta={'dataset': 'qm9', 'e_representation': e_representation})
+
+
 if __name__ == '__main__':
 
   # Parse optios for downloading
   parser = argparse.ArgumentParser(description='QM9 Object.')
   # Optional argument
   parser.add_argument('--root', nargs=1, help='Specify the data directory.', default=['../data/qm9/dsgdb9nsd'])
+  parser.add_argument('--preprocess', nargs=1, help='Write the featurized dataset as a store in this directory and exit.')
+  parser.add_argument('--e-representation', default='raw_distance', choices=['raw_distance', 'chem_graph', 'distance_bin'],
+            help='Edge representation stored by --preprocess.')
 
   args = parser.parse_args()
   root = args.root[0]
 
   files = [f for f in os.listdir(root) if os.path.isfile(os.path.join(root, f))]
 
+  if args.preprocess is not None:
+    start = time.time()
+    store = preprocess_qm9(root, sorted(files), args.preprocess[0], args.e_representation)
+    print('Preprocessed {} molecules into {} in {:.1f}s'.format(len(store), store.path, time.time() - start))
+    sys.exit(0)
+
   idx = np.random.permutation(len(files))
   idx = idx.tolist()
 
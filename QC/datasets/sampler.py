@@ -0,0 +1,148 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+  sampler.py: Size-bucketed batch sampler for graph datasets.
+
+  Every epoch the dataset indices are shuffled, split in buckets of bucket_size graphs,
+  sorted by size within each bucket and cut into batches, and the batches are shuffled.
+  Graphs in a batch have similar sizes while the batches still change from epoch to epoch.
+
+  Batches hold batch_size graphs, or, with a node and/or edge budget, as many graphs as fit
+  in the budget, which keeps the memory of every batch about the same.
+
+  DistributedBatchSampler shares the batches of a sampler out between the ranks of a
+  data-parallel job.
+
+  Usage:
+    sampler = BucketBatchSampler(data.num_nodes(), data.num_edges(), node_budget=500)
+    loader = torch.utils.data.DataLoader(data, batch_sampler=sampler, collate_fn=collate_fn)
+
+"""
+
+import numpy as np
+from torch.utils.data import Sampler
+
+__author__ = "Pedro HC Avelar"
+__email__ = "phcavelar@inf.ufrgs.br"
+
+
+class BucketBatchSampler(Sampler):
+  """
+    Batch sampler grouping graphs of similar size, see the module documentation.
+
+    num_nodes and num_edges give the size of every graph in the dataset. A graph larger than
+    the budget is put in a batch of its own.
+  """
+
+  def __init__(self, num_nodes, num_edges=None, batch_size=20, node_budget=None, edge_budget=None,
+               bucket_size=None, shuffle=True, drop_last=False, seed=None):
+    self.num_nodes = np.asarray(num_nodes, dtype=np.int64)
+    self.num_edges = np.zeros_like(self.num_nodes) if num_edges is None else np.asarray(num_edges, dtype=np.int64)
+    if edge_budget is not None and num_edges is None:
+      raise ValueError("An edge budget needs the number of edges of every graph")
+    self.batch_size = batch_size
+    self.node_budget = node_budget
+    self.edge_budget = edge_budget
+    self.budget = node_budget is not None or edge_budget is not None
+    # Sort by whatever the batches are limited by
+    self.key = self.num_edges if node_budget is None and edge_budget is not None else self.num_nodes
+
+    if bucket_size is None:
+      per_batch = batch_size
+      if self.budget:
+        mean = max(self.key.mean(), 1) if len(self.key) else 1
+        per_batch = max(int((edge_budget if node_budget is None else node_budget) // mean), 1)
+      bucket_size = 100*per_batch
+    #end if
+    if not self.budget:
+      # Only the last bucket may end in a partial batch
+      bucket_size = max(bucket_size // batch_size, 1) * batch_size
+    self.bucket_size = bucket_size
+    self.shuffle = shuffle
+    self.drop_last = drop_last
+    self.seed = np.random.randint(2**31) if seed is None else seed
+    self.epoch = 0
+    self._current = None
+    self._next = None
+  #end __init__
+
+  def _cut(self, bucket):
+    if not self.budget:
+      return [bucket[i:i+self.batch_size] for i in range(0, len(bucket), self.batch_size)]
+    batches = []
+    current, nodes, edges = [], 0, 0
+    for i in bucket:
+      n, e = self.num_nodes[i], self.num_edges[i]
+      if current and ((self.node_budget is not None and nodes + n > self.node_budget) or
+                      (self.edge_budget is not None and edges + e > self.edge_budget)):
+        batches.append(current)
+        current, nodes, edges = [], 0, 0
+      #end if
+      current.append(i)
+      nodes += n
+      edges += e
+    #end for
+    if current:
+      batches.append(current)
+    return batches
+
+  def epoch_batches(self, epoch):
+    """The batches of an epoch, a list of lists of dataset indices"""
+    rng = np.random.RandomState((self.seed + epoch) % 2**32)
+    order = rng.permutation(len(self.num_nodes)) if self.shuffle else np.arange(len(self.num_nodes))
+    batches = []
+    for start in range(0, len(order), self.bucket_size):
+      bucket = order[start:start+self.bucket_size]
+      bucket = bucket[np.argsort(self.key[bucket], kind='stable')].tolist()
+      batches += self._cut(bucket)
+    #end for
+    if self.drop_last and not self.budget:
+      batches = [b for b in batches if len(b) == self.batch_size]
+    if self.shuffle:
+      batches = [batches[i] for i in rng.permutation(len(batches))]
+    return batches
+
+  def __iter__(self):
+    if self._next is None:
+      self._next = self.epoch_batches(self.epoch)
+    self._current, self._next = self._next, None
+    self.epoch += 1
+    return iter(self._current)
+
+  def __len__(self):
+    # Budgeted epochs have a varying number of batches: count the running epoch, or the next one
+    if self._current is not None:
+      return len(self._current)
+    if self._next is None:
+      self._next = self.epoch_batches(self.epoch)
+    return len(self._next)
+#end BucketBatchSampler
+
+
+class DistributedBatchSampler(Sampler):
+  """
+    The share of rank of the batches of batch_sampler, in a data-parallel job of world_size ranks.
+
+    Every rank must draw the same batches from its batch_sampler, i.e. seed it the same way. Rank r
+    takes batches r, r+world_size, ...; with drop_uneven the last batches, that do not go around
+    all ranks, are dropped, so that every rank takes the same number of steps.
+  """
+
+  def __init__(self, batch_sampler, rank, world_size, drop_uneven=True):
+    self.batch_sampler = batch_sampler
+    self.rank = rank
+    self.world_size = world_size
+    self.drop_uneven = drop_uneven
+
+  def __iter__(self):
+    batches = list(self.batch_sampler)
+    if self.drop_uneven:
+      batches = batches[:len(batches) - len(batches) % self.world_size]
+    return iter(batches[self.rank::self.world_size])
+
+  def __len__(self):
+    if self.drop_uneven:
+      return len(self.batch_sampler) // self.world_size
+    return len(range(self.rank, len(self.batch_sampler), self.world_size))
+#end DistributedBatchSampler
@@ -0,0 +1,96 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+  splits.py: Persistent train/valid/test split manifests.
+
+  A manifest is a small .npz file holding the train, valid and test index arrays and, for
+  datasets read from a directory, the file names (ids) they index and the class labels of
+  the files, so that opening a split lists and parses nothing. Manifests are written once,
+  atomically, under a name; the split of a name is seeded from the name, so jobs building
+  the same manifest at the same time write the same one.
+
+  Manifests of a store live in its splits/ directory and index its graphs, those of a
+  dataset directory live next to it, in <root>.splits/.
+
+  Usage:
+    split = load_or_create(split_dir(store.path), 'default', lambda: qm9_split(len(store), seed_of('default')))
+    data_train = Qm9Cached(store, split['train'])
+
+"""
+
+import os
+import zlib
+
+import numpy as np
+
+__author__ = "Pedro HC Avelar"
+__email__ = "phcavelar@inf.ufrgs.br"
+
+SPLITS = ('train', 'valid', 'test')
+
+
+def split_dir(path):
+  """Where the manifests of a store, or of a dataset directory or file, are kept"""
+  path = os.path.normpath(path)
+  if os.path.isfile(os.path.join(path, 'meta.json')):
+    return os.path.join(path, 'splits')
+  return path + '.splits'
+
+
+def seed_of(name):
+  return zlib.crc32(name.encode('utf-8'))
+
+
+def save_split(directory, name, split):
+  """Writes the arrays of split as the manifest name in directory, replacing it atomically"""
+  if not os.path.isdir(directory):
+    os.makedirs(directory, exist_ok=True)
+  path = os.path.join(directory, name + '.npz')
+  tmp_path = '{}.tmp{}.npz'.format(path[:-4], os.getpid())
+  np.savez(tmp_path, **split)
+  os.replace(tmp_path, path)
+  return path
+
+
+def load_split(directory, name):
+  with np.load(os.path.join(directory, name + '.npz')) as f:
+    return {key: f[key] for key in f.files}
+
+
+def load_or_create(directory, name, create):
+  """The manifest name in directory, written with the arrays returned by create() if missing"""
+  if not os.path.isfile(os.path.join(directory, name + '.npz')):
+    print('\tCreating split {} in {}'.format(name, directory))
+    save_split(directory, name, create())
+  return load_split(directory, name)
+
+
+def qm9_split(num_graphs, seed, valid_size=10000, test_size=10000):
+  """Random split, valid and test of up to valid_size and test_size graphs and a tenth of the dataset each"""
+  rng = np.random.RandomState(seed)
+  idx = rng.permutation(num_graphs)
+  valid_size = min(valid_size, num_graphs // 10)
+  test_size = min(test_size, num_graphs // 10)
+  return {
+      'valid': idx[:valid_size],
+      'test': idx[valid_size:valid_size+test_size],
+      'train': idx[valid_size+test_size:],
+  }
+
+
+def stratified_split(labels, seed, fractions=(0.8, 0.1, 0.1)):
+  """Split keeping the class proportions, as GraphReader.divide_datasets"""
+  rng = np.random.RandomState(seed)
+  labels = np.asarray(labels)
+  split = {name: [] for name in SPLITS}
+  for c in np.unique(labels):
+    idx = rng.permutation(np.flatnonzero(labels == c))
+    counts = [int(f*len(idx)) for f in fractions]
+    start = 0
+    for name, count in zip(SPLITS, counts):
+      split[name].append(np.sort(idx[start:start+count]))
+      start += count
+    #end for
+  #end for
+  return {name: np.concatenate(split[name]).astype(np.int64) for name in SPLITS}
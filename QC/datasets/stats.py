@@ -0,0 +1,158 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+  stats.py: Streaming statistics of a graph dataset.
+
+  GraphStats is filled one graph (or one block of graphs) at a time, as the dataset is
+  preprocessed, and two GraphStats are merged exactly, so that the shards of a parallel
+  build are summarized independently. It holds:
+
+    target mean and variance   Welford's algorithm, blocks merged with Chan et al.'s update
+    degrees                    set of node degrees (undirected edges)
+    edge_labels                set of edge feature values, dropped past max_labels values
+    num_graphs, num_nodes, num_edges, max_nodes, max_edges
+
+  Stores keep theirs in stats.json, see GraphStore.stats().
+
+  Usage:
+    stats = GraphStats()
+    for x, edge_index, edge_attr, y in graphs:
+      stats.update(x, edge_index, edge_attr, y)
+    stats.target_mean, stats.target_std
+
+"""
+
+import numpy as np
+
+__author__ = "Pedro HC Avelar"
+__email__ = "phcavelar@inf.ufrgs.br"
+
+MAX_LABELS = 1024
+
+
+class GraphStats(object):
+
+  def __init__(self, max_labels=MAX_LABELS):
+    self.max_labels = max_labels
+    self.num_graphs = 0
+    self.num_nodes = 0
+    self.num_edges = 0
+    self.max_nodes = 0
+    self.max_edges = 0
+    self.num_targets = 0
+    self.mean = None
+    self.m2 = None
+    self.degrees = set()
+    # None once there are too many distinct values to be labels
+    self.edge_labels = set()
+
+  def update(self, x, edge_index, edge_attr, y):
+    """Adds one graph, with edge_index listing every undirected edge once"""
+    n = len(x)
+    edge_index = np.asarray(edge_index, dtype=np.int64).reshape(-1, 2)
+    degree = np.bincount(edge_index.ravel(), minlength=n)
+    self.update_arrays(np.array([n]), np.array([len(edge_index)]), degree, edge_attr, np.asarray(y).reshape(1, -1))
+
+  def update_arrays(self, num_nodes, num_edges, degrees, edge_attr, y):
+    """Adds a block of graphs: their node and edge counts, node degrees, edge features and G x ft targets"""
+    num_nodes, num_edges = np.asarray(num_nodes), np.asarray(num_edges)
+    self.num_graphs += len(num_nodes)
+    self.num_nodes += int(num_nodes.sum())
+    self.num_edges += int(num_edges.sum())
+    self.max_nodes = max(self.max_nodes, int(num_nodes.max(initial=0)))
+    self.max_edges = max(self.max_edges, int(num_edges.max(initial=0)))
+    self.degrees.update(np.unique(degrees).tolist())
+    if self.edge_labels is not None:
+      self._add_labels(np.unique(np.asarray(edge_attr, dtype=np.float32)).tolist())
+    self._add_targets(len(y), np.mean(y, axis=0, dtype=np.float64) if len(y) else None,
+                      np.sum(np.square(y - np.mean(y, axis=0, dtype=np.float64)), axis=0) if len(y) else None)
+
+  def _add_labels(self, labels):
+    if self.edge_labels is None or labels is None:
+      self.edge_labels = None
+      return
+    self.edge_labels.update(labels)
+    if len(self.edge_labels) > self.max_labels:
+      self.edge_labels = None
+
+  def _add_targets(self, count, mean, m2):
+    """Merges count targets of the given mean and sum of squared deviations m2"""
+    if not count:
+      return
+    total = self.num_targets + count
+    if self.mean is None:
+      self.mean, self.m2 = np.array(mean, dtype=np.float64), np.array(m2, dtype=np.float64)
+    else:
+      delta = mean - self.mean
+      self.mean = self.mean + delta * count / total
+      self.m2 = self.m2 + m2 + delta**2 * self.num_targets * count / total
+    self.num_targets = total
+
+  def merge(self, other):
+    """Adds the graphs summarized by other"""
+    self.num_graphs += other.num_graphs
+    self.num_nodes += other.num_nodes
+    self.num_edges += other.num_edges
+    self.max_nodes = max(self.max_nodes, other.max_nodes)
+    self.max_edges = max(self.max_edges, other.max_edges)
+    self.degrees.update(other.degrees)
+    self._add_labels(other.edge_labels)
+    self._add_targets(other.num_targets, other.mean, other.m2)
+    return self
+
+  @property
+  def target_mean(self):
+    return self.mean
+
+  @property
+  def target_var(self):
+    return self.m2 / self.num_targets if self.num_targets else None
+
+  @property
+  def target_std(self):
+    return np.sqrt(self.target_var) if self.num_targets else None
+
+  def to_dict(self):
+    return {
+        'num_graphs': self.num_graphs,
+        'num_nodes': self.num_nodes,
+        'num_edges': self.num_edges,
+        'max_nodes': self.max_nodes,
+        'max_edges': self.max_edges,
+        'num_targets': self.num_targets,
+        'target_mean': None if self.mean is None else self.mean.tolist(),
+        'target_m2': None if self.m2 is None else self.m2.tolist(),
+        'degrees': sorted(self.degrees),
+        'edge_labels': None if self.edge_labels is None else sorted(self.edge_labels),
+        'max_labels': self.max_labels,
+    }
+
+  @classmethod
+  def from_dict(cls, d):
+    stats = cls(d.get('max_labels', MAX_LABELS))
+    for name in ('num_graphs', 'num_nodes', 'num_edges', 'max_nodes', 'max_edges', 'num_targets'):
+      setattr(stats, name, d[name])
+    stats.mean = None if d['target_mean'] is None else np.array(d['target_mean'], dtype=np.float64)
+    stats.m2 = None if d['target_m2'] is None else np.array(d['target_m2'], dtype=np.float64)
+    stats.degrees = set(d['degrees'])
+    stats.edge_labels = None if d['edge_labels'] is None else set(d['edge_labels'])
+    return stats
+#end GraphStats
+
+
+def store_array_stats(arrays, max_labels=MAX_LABELS, block_size=10000):
+  """GraphStats of flat store arrays (see store.concat_graphs), streamed in blocks of graphs"""
+  stats = GraphStats(max_labels)
+  node_ptr, edge_ptr = np.asarray(arrays['node_ptr']), np.asarray(arrays['edge_ptr'])
+  for start in range(0, len(node_ptr)-1, block_size):
+    end = min(start + block_size, len(node_ptr)-1)
+    n0, n1, m0, m1 = node_ptr[start], node_ptr[end], edge_ptr[start], edge_ptr[end]
+    # Edge endpoints as node numbers within the block
+    offsets = np.repeat(node_ptr[start:end] - n0, np.diff(edge_ptr[start:end+1]))
+    edge_index = np.asarray(arrays['edge_index'][m0:m1], dtype=np.int64) + offsets[:, None]
+    degrees = np.bincount(edge_index.ravel(), minlength=n1-n0)
+    stats.update_arrays(np.diff(node_ptr[start:end+1]), np.diff(edge_ptr[start:end+1]), degrees,
+                        arrays['edge_attr'][m0:m1], np.asarray(arrays['y'][start:end]))
+  #end for
+  return stats
@@ -0,0 +1,194 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+  store.py: Flat, memory-mapped storage for preprocessed graph datasets.
+
+  A store is a directory holding one .npy file per array plus a meta.json:
+
+    x.npy          total_nodes x fn :: Float32   node features of every graph
+    node_ptr.npy   G+1 :: Int64                  graph i owns x[node_ptr[i]:node_ptr[i+1]]
+    edge_index.npy total_edges x 2 :: Int32      (src, tgt) local to each graph, one entry per undirected edge
+    edge_attr.npy  total_edges x fe :: Float32   edge features
+    edge_ptr.npy   G+1 :: Int64                  graph i owns edge_*[edge_ptr[i]:edge_ptr[i+1]]
+    y.npy          G x ft :: Float32             targets
+    ids.npy        G :: Str                      source file of each graph
+
+  and a stats.json with the target mean and variance, degrees and sizes of the graphs, see
+  stats.GraphStats, gathered as the store is written.
+
+  Usage:
+    store = GraphStore(path)
+    x, edge_index, edge_attr, y = store[i]
+    mean, std = store.stats().target_mean, store.stats().target_std
+
+"""
+
+import json
+import os
+import shutil
+
+import numpy as np
+
+from datasets.stats import GraphStats, store_array_stats
+
+__author__ = "Pedro HC Avelar"
+__email__ = "phcavelar@inf.ufrgs.br"
+
+ARRAY_NAMES = ('x', 'node_ptr', 'edge_index', 'edge_attr', 'edge_ptr', 'y', 'ids')
+
+
+def store_exists(path):
+  return os.path.isfile(os.path.join(path, 'meta.json'))
+
+
+class GraphStore(object):
+  """Read-only view over a store directory, arrays are opened lazily and memory-mapped."""
+
+  def __init__(self, path):
+    self.path = path
+    with open(os.path.join(path, 'meta.json'), 'r') as f:
+      self.meta = json.load(f)
+    self._arrays = None
+    self._stats = None
+
+  def _open(self):
+    if self._arrays is None:
+      self._arrays = {name: np.load(os.path.join(self.path, name + '.npy'), mmap_mode='r')
+                      for name in ARRAY_NAMES if name != 'ids'}
+    return self._arrays
+
+  def __getstate__(self):
+    # Each DataLoader worker re-opens the memory maps instead of receiving a pickled copy
+    state = self.__dict__.copy()
+    state['_arrays'] = None
+    return state
+
+  def __len__(self):
+    return self.meta['num_graphs']
+
+  def __getitem__(self, index):
+    a = self._open()
+    n0, n1 = a['node_ptr'][index], a['node_ptr'][index+1]
+    m0, m1 = a['edge_ptr'][index], a['edge_ptr'][index+1]
+    return a['x'][n0:n1], a['edge_index'][m0:m1], a['edge_attr'][m0:m1], a['y'][index]
+
+  def array(self, name):
+    if name == 'ids':
+      return np.load(os.path.join(self.path, 'ids.npy'))
+    return self._open()[name]
+
+  def num_nodes(self):
+    return np.diff(self.array('node_ptr'))
+
+  def num_edges(self):
+    return np.diff(self.array('edge_ptr'))
+
+  def stats(self):
+    """GraphStats of the whole store, gathered once for stores written without them"""
+    if self._stats is None:
+      stats_file = os.path.join(self.path, 'stats.json')
+      if os.path.isfile(stats_file):
+        with open(stats_file, 'r') as f:
+          self._stats = GraphStats.from_dict(json.load(f))
+      else:
+        self._stats = store_array_stats({name: self.array(name) for name in ARRAY_NAMES if name != 'ids'})
+        try:
+          write_stats(self.path, self._stats)
+        except OSError:
+          pass
+      #end if
+    #end if
+    return self._stats
+#end GraphStore
+
+
+def write_stats(path, stats):
+  tmp_file = os.path.join(path, 'stats.json.tmp{}'.format(os.getpid()))
+  with open(tmp_file, 'w') as f:
+    json.dump(stats.to_dict(), f)
+  os.replace(tmp_file, os.path.join(path, 'stats.json'))
+
+
+def write_store(path, graphs, meta=None):
+  """
+    Writes an iterable of (id, x, edge_index, edge_attr, y) tuples as a store at path.
+
+    The store is assembled in a temporary directory and renamed into place, so a
+    partially written store is never visible to readers.
+  """
+  ids, xs, eis, eas, ys = [], [], [], [], []
+  stats = GraphStats()
+  for g_id, x, edge_index, edge_attr, y in graphs:
+    ids.append(g_id)
+    xs.append(np.asarray(x, dtype=np.float32))
+    eis.append(np.asarray(edge_index, dtype=np.int32).reshape(-1, 2))
+    edge_attr = np.asarray(edge_attr, dtype=np.float32)
+    eas.append(edge_attr.reshape(len(eis[-1]), -1) if len(eis[-1]) else edge_attr.reshape(0, 0))
+    ys.append(np.asarray(y, dtype=np.float32))
+    stats.update(xs[-1], eis[-1], eas[-1], ys[-1])
+  #end for
+  if not ids:
+    raise ValueError("Cannot write an empty store")
+  return write_store_arrays(path, concat_graphs(ids, xs, eis, eas, ys), meta, stats)
+
+
+def concat_graphs(ids, xs, eis, eas, ys):
+  """Concatenates per-graph arrays into the flat store arrays."""
+  # Graphs without edges carry no edge feature width
+  fe = max(e.shape[1] for e in eas)
+  eas = [e if len(e) else np.zeros((0, fe), dtype=np.float32) for e in eas]
+  node_ptr = np.zeros(len(xs)+1, dtype=np.int64)
+  node_ptr[1:] = np.cumsum([len(x) for x in xs])
+  edge_ptr = np.zeros(len(eis)+1, dtype=np.int64)
+  edge_ptr[1:] = np.cumsum([len(e) for e in eis])
+  return {
+      'x': np.concatenate(xs),
+      'node_ptr': node_ptr,
+      'edge_index': np.concatenate(eis),
+      'edge_attr': np.concatenate(eas),
+      'edge_ptr': edge_ptr,
+      'y': np.stack(ys),
+      'ids': np.asarray(ids, dtype=str),
+  }
+
+
+def write_store_arrays(path, arrays, meta=None, stats=None):
+  """Writes already flattened store arrays at path, see concat_graphs, with their GraphStats if known."""
+  meta = dict(meta or {})
+  meta['num_graphs'] = len(arrays['node_ptr']) - 1
+  meta['node_features'] = int(arrays['x'].shape[1])
+  meta['edge_features'] = int(arrays['edge_attr'].shape[1])
+  meta['target_features'] = int(arrays['y'].shape[1])
+
+  path = os.path.normpath(path)
+  tmp_path = '{}.tmp{}'.format(path, os.getpid())
+  if os.path.isdir(tmp_path):
+    shutil.rmtree(tmp_path)
+  os.makedirs(tmp_path)
+  for name in ARRAY_NAMES:
+    np.save(os.path.join(tmp_path, name + '.npy'), arrays[name])
+  write_stats(tmp_path, stats if stats is not None else store_array_stats(arrays))
+  with open(os.path.join(tmp_path, 'meta.json'), 'w') as f:
+    json.dump(meta, f, indent=2)
+  if os.path.isdir(path):
+    shutil.rmtree(path)
+  os.rename(tmp_path, path)
+  return GraphStore(path)
+
+
+def merge_stores(path, stores, meta=None):
+  """Concatenates several stores, in order, into a single store at path."""
+  stores = [s if isinstance(s, GraphStore) else GraphStore(s) for s in stores]
+  arrays = {}
+  for name in ('x', 'edge_index', 'edge_attr', 'y', 'ids'):
+    arrays[name] = np.concatenate([s.array(name) for s in stores])
+  for name, count in (('node_ptr', 'num_nodes'), ('edge_ptr', 'num_edges')):
+    ptr = np.zeros(sum(len(s) for s in stores)+1, dtype=np.int64)
+    ptr[1:] = np.cumsum(np.concatenate([getattr(s, count)() for s in stores]))
+    arrays[name] = ptr
+  #end for
+  stats = GraphStats()
+  for s in stores:
+    stats.merge(s.stats())
+  return write_store_arrays(path, arrays, meta, stats)
@@ -94,6 +94,58 @@ def qm9_edges(g, e_representation='raw_distance'):
   return nx.to_numpy_matrix(g), e
   
 
+def qm9_nodes_array(mol, hydrogen=False):
+  """qm9_nodes for a molecule read by xyz_array_reader, as an n x fn array"""
+  h = [
+      # Atom type (One-hot H, C, N, O F)
+      mol['a_type'][:,None] == np.array(['H', 'C', 'N', 'O', 'F'])[None,:],
+      # Atomic number, Partial Charge, Acceptor, Donor, Aromatic
+      np.stack([mol['a_num'], mol['pc'], mol['acceptor'], mol['donor'], mol['aromatic']], axis=1),
+      # Hybradization
+      mol['hybridization'][:,None] == np.arange(3)[None,:],
+  ]
+  # If number hydrogen is used as a
+  if hydrogen:
+    h.append(mol['num_h'][:,None])
+  return np.concatenate([a.astype(np.float64) for a in h], axis=1)
+
+
+def distance_bin(distance, start=2, stop=6, bins=9):
+  """Vectorized bin of the unbonded distance thresholds in qm9_edges, bins+1 values from 0 to bins"""
+  return np.searchsorted(start + np.arange(bins)*(stop-start)/(bins-1.0), distance, side='right')
+
+
+def qm9_edges_array(mol, e_representation='raw_distance'):
+  """
+    qm9_edges for a molecule read by xyz_array_reader.
+
+    Returns (edge_index, edge_attr) with the edges of qm9_edges in sorted (i<=j) order.
+  """
+  bonds, b_type = mol['bonds'], mol['b_type']
+  # Bonds of a type outside of SINGLE, DOUBLE, TRIPLE, AROMATIC carry no features in qm9_edges
+  known = b_type >= 0
+  if e_representation == 'chem_graph':
+    return bonds[known], (b_type[known]+1)[:,None]
+  elif e_representation == 'distance_bin':
+    n = len(mol['a_num'])
+    src, tgt = np.triu_indices(n)
+    e = distance_bin(mol['distance'][src, tgt]) + 5
+    bond_type = np.full([n, n], -2, dtype=np.int64)
+    bond_type[bonds[:,0], bonds[:,1]] = b_type
+    b = bond_type[src, tgt]
+    e[b >= 0] = b[b >= 0] + 1
+    keep = b != -1
+    return np.stack([src, tgt], axis=1)[keep], e[keep][:,None]
+  elif e_representation == 'raw_distance':
+    bonds, b_type = bonds[known], b_type[known]
+    e = np.concatenate([mol['distance'][bonds[:,0], bonds[:,1]][:,None],
+                        b_type[:,None] == np.arange(4)[None,:]], axis=1).astype(np.float64)
+    return bonds, e
+  else:
+    raise ValueError('Incorrect Edge representation transform')
+  #end if
+
+
 def normalize_data(data, mean, std):
   data_norm = (data-mean)/std
   return data_norm
@@ -151,70 +203,54 @@ def accuracy(output, target, topk=(1,)):
   return res
 
 def collate_g_concat_edge_data(batch):
-  g_M = lambda g: g[0][0]
-  g_n = lambda g: g_M(g).shape[0]
-  g_x = lambda g: g[0][1]
-  g_x_d = lambda g: len(g_x(g)[0])
-  g_e = lambda g: g[0][2]
-  g_m = lambda g: len(g_e(g))
-  g_e_keys = lambda g: list(g_e(g).keys())
-  g_e_values = lambda g: list(g_e(g).values())
-  g_e_d = lambda g: len(g_e_values(g)[0])
-  g_o = lambda g: g[1]
-  g_o_d = lambda g: len(g[1])
-  
-  n_d, e_d, o_d = g_x_d(batch[0]), g_e_d(batch[0]), g_o_d(batch[0])
-  N = 0
-  M = 0
-  batch_size = len(batch)
-  for g in batch:
-    n = g_n(g)
-    m = g_m(g)
-    N += n
-    M += m
-  #end for
-  G = np.zeros([N, N])
-  B = np.zeros([N], dtype=np.int64)
-  X = np.zeros([N, n_d])
-  E_d = np.zeros([2*M, e_d])
-  E_src = np.zeros([2*M], dtype=np.int64)
-  E_tgt = np.zeros([2*M,2], dtype=np.int64)
-  Y = np.zeros([batch_size, o_d])
-  
-  n_acc = 0
-  m_acc = 0
-  for b, g in enumerate(batch):
-    n = g_n(g)
-    G[n_acc:n_acc+n,n_acc:n_acc+n] = g_M(g)
-    B[n_acc:n_acc+n] = b
-    X[n_acc:n_acc+n,:] = g_x(g)
-    for edge_id, edge in enumerate(sorted(g_e_keys(g))):
-      src, tgt = edge
-      
-      src_edge_id = m_acc+edge_id
-      E_d[src_edge_id,:] = g_e(g)[edge]
-      E_src[src_edge_id] = src
-      E_tgt[src_edge_id,:] = [tgt,src_edge_id]
-      
-      tgt_edge_id = M+m_acc+edge_id
-      E_d[tgt_edge_id,:] = g_e(g)[edge]
-      E_src[tgt_edge_id] = tgt
-      E_tgt[tgt_edge_id] = [src,tgt_edge_id]
-    #end for
-    Y[b] = g_o(g)
-    n_acc+=n
-    m_acc+=g_m(g)
+  """Same output as collate_g_concat_arrays, for the ((g, h, e), target) items with edge dicts"""
+  graphs = []
+  for (g, h, e), target in batch:
+    edges = sorted(e.keys())
+    graphs.append(((h, np.array(edges, dtype=np.int64).reshape(-1, 2), np.array([e[k] for k in edges])), target))
   #end for
-
-  G = torch.FloatTensor(G)
-  B = torch.LongTensor(B)
-  X = torch.FloatTensor(X)
-  E_d = torch.FloatTensor(E_d)
-  E_src = torch.LongTensor(E_src)
-  E_tgt = torch.sparse.FloatTensor(torch.LongTensor(E_tgt.transpose()),torch.FloatTensor(np.ones(2*M)),torch.Size([N,2*M])).to_dense()
-  Y = torch.FloatTensor(Y)
-  return batch_size,G,B,X,E_d,E_src,E_tgt,Y
-#end collate_g_concat
+  return collate_g_concat_arrays(graphs)
+#end collate_g_concat_edge_data
+
+def collate_g_concat_arrays(batch):
+  """
+    Concatenates a batch of ((x, edge_index, edge_attr), target) graphs, as served by Qm9Cached, into
+    a single disconnected graph described by index vectors only, so that it takes O(N+M) memory.
+
+    Returns batch_size, B (N), X (N x fn), E_d (2M x fe), E_src (2M) and E_tgt (2M). Every edge is
+    listed once in each direction, first all forward edges and then all reversed ones, and edge k
+    carries a message from node E_src[k] to node E_tgt[k].
+  """
+  batch_size = len(batch)
+  n = np.array([len(g[0][0]) for g in batch], dtype=np.int64)
+  m = np.array([len(g[0][1]) for g in batch], dtype=np.int64)
+
+  # Shift each graph's local edge indices by the number of nodes before it
+  n_offset = np.repeat(np.cumsum(n) - n, m)
+  edges = [g[0][1] for g in batch if len(g[0][1])]
+  edges = np.concatenate(edges).astype(np.int64) if edges else np.zeros((0, 2), dtype=np.int64)
+  edges = edges + n_offset[:,None]
+  src, tgt = edges[:,0], edges[:,1]
+  e_d = [g[0][2] for g in batch if len(g[0][1])]
+  # A batch of lone atoms has no edges, but its edge features keep their width
+  fe = np.shape(batch[0][0][2])[1] if np.ndim(batch[0][0][2]) == 2 else 0
+  e_d = np.concatenate(e_d) if e_d else np.zeros((0, fe), dtype=np.float32)
+
+  B = np.repeat(np.arange(batch_size, dtype=np.int64), n)
+  X = np.concatenate([g[0][0] for g in batch])
+  E_d = np.concatenate([e_d, e_d])
+  E_src = np.concatenate([src, tgt])
+  E_tgt = np.concatenate([tgt, src])
+  Y = np.stack([g[1] for g in batch])
+
+  B = torch.from_numpy(B)
+  X = torch.from_numpy(np.asarray(X, dtype=np.float32))
+  E_d = torch.from_numpy(np.asarray(E_d, dtype=np.float32))
+  E_src = torch.from_numpy(E_src)
+  E_tgt = torch.from_numpy(E_tgt)
+  Y = torch.from_numpy(np.asarray(Y, dtype=np.float32))
+  return batch_size,B,X,E_d,E_src,E_tgt,Y
+#end collate_g_concat_arrays
 
 def collate_g_concat(batch):
   g_M = lambda g: g[0][0]
@@ -0,0 +1,150 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+  dense.py: Padded dense batches for batches of small graphs.
+
+  The models run on a concatenated batch: one N x f node matrix, edges as the E_src/E_tgt
+  index vectors, and gathers and scatters between them. For graphs as small as QM9's (up to
+  29 atoms) the same batch can be laid out padded instead, B x Nmax x f for the nodes, with a
+  B x Nmax mask of the real ones, and the messages of a layer computed with a few batched
+  matmuls over the B x Nmax x Nmax pairs instead:
+
+    E x fo x fo edge matrices      one B x Nmax*fo x Nmax*fo matrix per graph, a bmm
+    low rank (U, V) factors        B x Nmax x Nmax x fo x r factors, two einsums
+    K edge types (group_edge_types)  B x K x Nmax x Nmax adjacency, a matmul per type
+
+  Padding costs compute on the pairs and nodes that are not there, so whether the dense layout
+  pays off depends on how evenly sized the graphs of the batch are and how dense the graphs are.
+  With edges grouped by type, messages are gathered with K adjacency matmuls and transformed
+  once per node and type, instead of once per edge; that beats the concatenated layout when
+  the graphs are dense enough. Per-edge matrices have to be written out for every pair, and the
+  padded layout only adds work to them. use_dense decides accordingly, see benchmark_dense.py.
+
+  Usage:
+    index = dense_index(batch)
+    if use_dense(index, Esrc.size(0), typed=True):
+      x, mask = to_dense_batch(x, index)
+      edges = to_dense_edges(edge_data, Esrc, Etgt, index, edge_counts)
+      x = dense_messages(edges, torch.matmul(x, weight))
+
+"""
+
+import collections
+
+import torch
+
+__author__ = "Pedro HC Avelar"
+__email__ = "phcavelar@inf.ufrgs.br"
+
+DENSE_AGGREGATIONS = ('sum', 'mean')
+DENSE_MODES = ('never', 'auto', 'always')
+
+# Default thresholds of use_dense, from benchmark_dense.py on QM9-sized molecules
+MIN_FILL = 0.7
+MIN_DENSITY = 0.25
+
+# num_graphs B and max_nodes Nmax of a batch, and the graph and position within it of every node
+DenseIndex = collections.namedtuple('DenseIndex', ['num_graphs', 'max_nodes', 'batch', 'local', 'mask'])
+
+# Edges laid out by to_dense_edges, see dense_messages
+DenseEdges = collections.namedtuple('DenseEdges', ['data', 'adj', 'norm'])
+
+
+def dense_index(batch, num_graphs=None):
+  """DenseIndex of the N :: Long graph index of a concatenated batch, whose nodes are sorted by graph"""
+  counts = torch.bincount(batch, minlength=0 if num_graphs is None else num_graphs)
+  max_nodes = int(counts.max()) if counts.numel() else 0
+  ptr = torch.cumsum(counts, 0) - counts
+  local = torch.arange(batch.size(0), device=batch.device) - ptr[batch]
+  mask = torch.arange(max_nodes, device=batch.device).unsqueeze(0) < counts.unsqueeze(1)
+  return DenseIndex(counts.size(0), max_nodes, batch, local, mask)
+
+
+def use_dense(index, num_edges, typed=False, min_fill=MIN_FILL, min_density=MIN_DENSITY):
+  """
+    Whether the dense layout is expected to be faster than the concatenated one: only for edges grouped
+    by type, with the nodes filling at least min_fill of the B x Nmax slots and the edges at least
+    min_density of the B x Nmax x Nmax pairs.
+  """
+  padded = index.num_graphs * index.max_nodes
+  if not typed or index.batch.size(0) < min_fill * padded:
+    return False
+  return num_edges >= min_density * padded * index.max_nodes
+
+
+def to_dense_batch(x, index):
+  """B x Nmax x f padded copy of the N x f node features x, zeros past the end of each graph, and the B x Nmax mask of the nodes"""
+  dense = x.new_zeros((index.num_graphs, index.max_nodes) + x.size()[1:])
+  return dense.index_put((index.batch, index.local), x), index.mask
+
+
+def from_dense_batch(x, index):
+  """N x f node features of the concatenated batch from the B x Nmax x f padded x"""
+  return x[index.batch, index.local]
+
+
+def to_dense_edges(edge_data, Esrc, Etgt, index, edge_counts=None, aggr='sum'):
+  """
+    Lays the edge data of layers.edge_messages out over the B x Nmax x Nmax node pairs: E x fo x fo
+    matrices, low rank (U, V) factors, or either grouped by type with the edge_counts of
+    layers.group_edge_types. The pair of every edge must be unique, as in the collated batches.
+  """
+  if aggr not in DENSE_AGGREGATIONS:
+    raise ValueError("The dense layout supports the {} aggregations, not {}".format(DENSE_AGGREGATIONS, aggr))
+  B, N = index.num_graphs, index.max_nodes
+  graph, tgt, src = index.batch[Etgt], index.local[Etgt], index.local[Esrc]
+  norm = None
+  if aggr == 'mean':
+    ones = torch.ones(Etgt.size(0), device=Etgt.device)
+    degree = ones.new_zeros(B, N).index_put_((graph, tgt), ones, accumulate=True)
+    norm = 1. / degree.clamp(min=1).unsqueeze(-1)
+  #end if
+  if edge_counts is not None:
+    K = len(edge_counts)
+    etype = torch.repeat_interleave(torch.arange(K, device=Etgt.device), torch.tensor(edge_counts, dtype=torch.long, device=Etgt.device))
+    ones = torch.ones(Etgt.size(0), device=Etgt.device)
+    adj = ones.new_zeros(B, K, N, N).index_put_((graph, etype, tgt, src), ones, accumulate=True)
+    return DenseEdges(edge_data, adj, norm)
+  #end if
+  if isinstance(edge_data, tuple):
+    U, V = edge_data
+    shape = (B, N, N) + U.size()[1:]
+    return DenseEdges((U.new_zeros(shape).index_put((graph, tgt, src), U), V.new_zeros(shape).index_put((graph, tgt, src), V)), None, norm)
+  #end if
+  fo = edge_data.size(1)
+  # Laid out as B x Nmax(tgt) x fo x Nmax(src) x fo, so that each graph is a single Nmax*fo square matrix
+  W = edge_data.new_zeros(B, N, fo, N, fo)
+  W.permute(0, 1, 3, 2, 4).index_put_((graph, tgt, src), edge_data)
+  return DenseEdges(W.view(B, N*fo, N*fo), None, norm)
+
+
+def dense_messages(edges, support):
+  """
+    B x Nmax x fo messages aggregated into each node from the B x Nmax x fo support of its neighbours,
+    the padded counterpart of layers.edge_messages followed by layers.aggregate_edges.
+  """
+  B, N, fo = support.size()
+  data, adj, norm = edges
+  if adj is not None:
+    # Neighbours summed per edge type, then transformed by the matrix of the type
+    s = torch.matmul(adj, support.unsqueeze(1)) # B x K x Nmax x fo
+    if isinstance(data, tuple):
+      U, V = data
+      output = torch.einsum('bkir,kpr->bip', torch.einsum('bkiq,kqr->bkir', s, V), U)
+    else:
+      output = torch.einsum('bkiq,kpq->bip', s, data)
+  elif isinstance(data, tuple):
+    U, V = data
+    output = torch.einsum('bijpr,bijr->bip', U, torch.einsum('bijqr,bjq->bijr', V, support))
+  else:
+    output = torch.bmm(data, support.reshape(B, N*fo, 1)).view(B, N, fo)
+  #end if
+  if norm is not None:
+    output = output * norm
+  return output
+
+
+def dense_sum(x, mask):
+  """Sum readout of the B x Nmax x f padded x over the nodes in the B x Nmax mask"""
+  return x.masked_fill(~mask.unsqueeze(-1), 0).sum(1)
@@ -0,0 +1,113 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+  distributed.py: Data-parallel training in local worker processes.
+
+  launch(main, world_size) starts world_size processes on this machine, joins them in a
+  torch.distributed process group over the gloo backend, which runs on the CPU, and calls main()
+  in each. The model is wrapped in DistributedDataParallel, which averages the gradients of all
+  ranks in every backward pass, and every rank trains on its share of the batches of each epoch,
+  see shard_batches. Only rank 0 prints, logs and writes checkpoints.
+
+  Each rank gets an equal share of the CPU cores as intra-op threads, and the same random seed,
+  so that the ranks draw the same dataset splits and model initialization.
+
+  Usage:
+    def main():
+      args = parser.parse_args()
+      if args.world_size > 1 and not is_distributed():
+        return launch(main, args.world_size)
+      model = wrap(Model(...))
+      loader = DataLoader(data, batch_sampler=shard_batches(data, 20, shuffle=True), ...)
+
+"""
+
+import os
+import socket
+import sys
+
+import numpy as np
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from torch.nn.parallel import DistributedDataParallel
+from torch.utils.data import BatchSampler, RandomSampler, SequentialSampler
+
+from datasets.sampler import DistributedBatchSampler
+
+__author__ = "Pedro HC Avelar"
+__email__ = "phcavelar@inf.ufrgs.br"
+
+
+def is_distributed():
+  return dist.is_available() and dist.is_initialized()
+
+
+def get_rank():
+  return dist.get_rank() if is_distributed() else 0
+
+
+def get_world_size():
+  return dist.get_world_size() if is_distributed() else 1
+
+
+def is_main():
+  return get_rank() == 0
+
+
+def barrier():
+  if is_distributed():
+    dist.barrier()
+
+
+def free_port():
+  with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+    s.bind(('127.0.0.1', 0))
+    return s.getsockname()[1]
+
+
+def _worker(rank, fn, world_size, threads, seed):
+  dist.init_process_group('gloo', rank=rank, world_size=world_size)
+  torch.set_num_threads(threads)
+  np.random.seed(seed)
+  torch.manual_seed(seed)
+  if rank != 0:
+    sys.stdout = open(os.devnull, 'w')
+  try:
+    fn()
+  finally:
+    dist.destroy_process_group()
+
+
+def launch(fn, world_size, threads=None, seed=None):
+  """Runs fn() in world_size local processes of a gloo process group, with threads intra-op threads each"""
+  if threads is None:
+    threads = max((os.cpu_count() or 1) // world_size, 1)
+  if seed is None:
+    seed = np.random.randint(2**31)
+  os.environ.setdefault('MASTER_ADDR', '127.0.0.1')
+  os.environ.setdefault('MASTER_PORT', str(free_port()))
+  print('Training in {} processes with {} threads each'.format(world_size, threads), flush=True)
+  mp.spawn(_worker, args=(fn, world_size, threads, seed), nprocs=world_size, join=True)
+
+
+def wrap(model):
+  """model in DistributedDataParallel when running in a process group"""
+  return DistributedDataParallel(model) if is_distributed() else model
+
+
+def unwrap(model):
+  return model.module if isinstance(model, DistributedDataParallel) else model
+
+
+def shard_batches(data, batch_size, shuffle, seed=0, batch_sampler=None):
+  """
+    The batches of data of this rank: those of batch_sampler, or of batch_size graphs at a time,
+    shuffled with seed, shared out between the ranks. Training batches that do not go around all
+    ranks are dropped, so that every rank takes the same number of steps.
+  """
+  if batch_sampler is None:
+    sampler = RandomSampler(data, generator=torch.Generator().manual_seed(seed)) if shuffle else SequentialSampler(data)
+    batch_sampler = BatchSampler(sampler, batch_size, drop_last=False)
+  return DistributedBatchSampler(batch_sampler, get_rank(), get_world_size(), drop_uneven=shuffle)
@@ -0,0 +1,241 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+  export.py: Self-contained inference artifacts of trained models.
+
+  Each checkpoint is traced with torch.export, with the number of nodes and of edges of the batch
+  left dynamic, and saved as a single .pt2 file holding the graph, the weights and, in a
+  meta.json, the model's arguments, target names and target statistics. infer.py --artifact
+  serves such a file without any of the model code. With --formats aoti the exported program is
+  also compiled ahead of time by TorchInductor, torch.compile's compiler, into a .aoti.pt2
+  package of native code.
+
+  TorchScript is not used: tracing would bake the number of graphs of the example batch into the
+  sum readouts, and scripting needs the models rewritten in its subset of Python. torch.export
+  keeps what depends on the data, such as batch.max().item(), symbolic. What it cannot trace is
+  exported in an equivalent form:
+
+    dense="auto"            chooses per batch; exported on the concatenated (sparse) layout
+    discrete_edges          groups edges into a data-dependent number of types; exported
+                            encoding every edge, which gives the same edge matrices
+    eode fixed grid solver  stepped in Python without gradients, see EdgeODEBlock
+    eode adaptive solver    chooses its steps from the data; only exported with a fixed grid
+                            --ode-solver instead
+
+  Every artifact is reloaded from its file and validated against the eager model it was exported
+  from, on batches of the valid split of the store the model was trained on (random molecules if
+  there is none), and the latency of both timed on the CPU. How far a fixed grid --ode-solver
+  moves the outputs of the checkpoint is reported apart.
+
+  Usage:
+    python export.py ./checkpoint/egcnsum-3/qm9/all/model_best.pth
+    python export.py --models egcnsum enns2s eodesum --ode-solver rk4 --formats export aoti --out-dir ./export/
+    python infer.py molecules.smi --artifact ./export/egcnsum.pt2
+
+"""
+
+from __future__ import print_function
+
+import argparse
+import copy
+import json
+import os
+import sys
+import time
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+import infer
+from datasets import Qm9Cached
+from datasets.splits import split_dir, seed_of, load_or_create, qm9_split
+from datasets.utils import collate_g_concat_arrays
+from layer_models import EdgeODEBlock, FIXED_GRID_SOLVERS, UnimplementedModel
+from benchmark_aggregation import random_molecules
+from train_egcn import model_dict
+
+__author__ = "Pedro HC Avelar"
+__email__ = "phcavelar@inf.ufrgs.br"
+
+FORMATS = ('export', 'aoti')
+INPUTS = ('node_features', 'edge_features', 'Esrc', 'Etgt', 'batch')
+
+
+class Exportable(nn.Module):
+  """The model, taking its inputs as keyword tensors only, as torch.export traces them"""
+  def __init__(self, model):
+    super(Exportable, self).__init__()
+    self.model = model
+
+  def forward(self, node_features, edge_features, Esrc, Etgt, batch):
+    return self.model(node_features=node_features, edge_features=edge_features, Esrc=Esrc, Etgt=Etgt, batch=batch)
+#end Exportable
+
+
+def prepare(model, ode_solver=None):
+  """Copy of model computing the same in a form torch.export can trace, see the module documentation"""
+  model = copy.deepcopy(model).cpu().eval()
+  model.dense = "never"
+  model.discrete_edges = False
+  for module in model.modules():
+    if isinstance(module, EdgeODEBlock):
+      if ode_solver is not None:
+        module.solver = ode_solver
+      if module.solver not in FIXED_GRID_SOLVERS:
+        raise ValueError("The {} solver chooses its steps from the data and cannot be exported, "
+                         "give a fixed grid solver, one of {}".format(module.solver, FIXED_GRID_SOLVERS))
+    #end if
+  #end for
+  return model
+
+
+def inputs_of(batch):
+  """The model inputs of a batch collated by collate_g_concat_arrays, by name"""
+  _, b, x, e_d, e_src, e_tgt, _ = batch
+  return dict(zip(INPUTS, (x, e_d, e_src, e_tgt, b)))
+
+
+def export_model(model, example):
+  """torch.export program of the prepared model, dynamic in the nodes and edges of the example batch"""
+  nodes, edges = torch.export.Dim('nodes'), torch.export.Dim('edges')
+  dynamic_shapes = {'node_features': {0: nodes}, 'edge_features': {0: edges}, 'Esrc': {0: edges}, 'Etgt': {0: edges}, 'batch': {0: nodes}}
+  with torch.no_grad():
+    return torch.export.export(Exportable(model), (), kwargs=inputs_of(example), dynamic_shapes=dynamic_shapes)
+
+
+def save_artifact(program, path, meta, format='export'):
+  if format == 'export':
+    torch.export.save(program, path, extra_files={'meta.json': json.dumps(meta)})
+  elif format == 'aoti':
+    torch._inductor.aoti_compile_and_package(program, package_path=path,
+                                             inductor_configs={'aot_inductor.metadata': {'meta.json': json.dumps(meta)}})
+  else:
+    raise ValueError("Unknown format {}, must be one of {}".format(format, FORMATS))
+  #end if
+  return path
+
+
+def load_artifact(path):
+  """The model of an artifact written by save_artifact, called with the keyword inputs of the models, and its meta.json"""
+  if path.endswith('.aoti.pt2'):
+    model = torch._inductor.aoti_load_package(path)
+    return model, json.loads(model.get_metadata()['meta.json'])
+  #end if
+  extra_files = {'meta.json': ''}
+  program = torch.export.load(path, extra_files=extra_files)
+  return program.module(), json.loads(extra_files['meta.json'])
+
+
+def latency(model, inputs, repeats):
+  """Median time of a forward pass, in ms"""
+  times = []
+  with torch.inference_mode():
+    model(**inputs)
+    for _ in range(repeats):
+      start = time.perf_counter()
+      model(**inputs)
+      times.append(time.perf_counter() - start)
+    #end for
+  #end with
+  return np.median(times) * 1e3
+
+
+def main():
+  parser = argparse.ArgumentParser(description='Export trained models as self-contained inference artifacts.')
+  parser.add_argument('checkpoints', nargs='*', help='Checkpoints written by train_egcn.py (default: model_best.pth of each of --models)')
+  parser.add_argument('--models', nargs='+', choices=sorted(model_dict.keys()),
+                      default=sorted(name for name, Model in model_dict.items() if Model is not UnimplementedModel))
+  parser.add_argument('--resume', default='./checkpoint/{model}-{layers}/{dataset}/all', help='Checkpoint directory layout of train_egcn.py')
+  parser.add_argument('--layers', type=int, default=3, help='Layers of the models in the checkpoint layout (default: 3)')
+  parser.add_argument('--dataset', default='qm9')
+  parser.add_argument('--cache-path', help='Store to validate on (default: the one the checkpoint was trained on)')
+  parser.add_argument('--out-dir', default='./export/', help='Where to write the artifacts (default: ./export/)')
+  parser.add_argument('--formats', nargs='+', choices=FORMATS, default=['export'], help='torch.export programs and/or AOTInductor packages')
+  parser.add_argument('--ode-solver', choices=FIXED_GRID_SOLVERS, help='Fixed grid solver to export the eode models with')
+  parser.add_argument('--batch-sizes', type=int, nargs='+', default=[1, 16, 64], help='Batch sizes to validate and time (default: 1 16 64)')
+  parser.add_argument('--repeats', type=int, default=20, help='Timed forward passes (default: 20)')
+  parser.add_argument('--tol', type=float, default=1e-4, help='Largest difference to the eager outputs accepted (default: 1e-4)')
+  parser.add_argument('--threads', type=int, default=None, help='torch intra-op threads')
+  args = parser.parse_args()
+
+  if args.threads:
+    torch.set_num_threads(args.threads)
+  if not os.path.isdir(args.out_dir):
+    os.makedirs(args.out_dir)
+  checkpoints = args.checkpoints
+  if not checkpoints:
+    checkpoints = [os.path.join(args.resume.format(model=name, layers=args.layers, dataset=args.dataset), 'model_best.pth') for name in args.models]
+    missing = [checkpoint for checkpoint in checkpoints if not os.path.isfile(checkpoint)]
+    for checkpoint in missing:
+      print('=> no checkpoint at {}, skipped'.format(checkpoint), file=sys.stderr)
+    checkpoints = [checkpoint for checkpoint in checkpoints if checkpoint not in missing]
+  #end if
+
+  print('{:>8} {:>7} {:>9} {:>9} {:>10} '.format('model', 'format', 'size(KB)', 'build(s)', 'max|diff|')
+        + ' '.join('{:>10}'.format('B={} ms'.format(batch_size)) for batch_size in args.batch_sizes), flush=True)
+  failed = 0
+  for checkpoint in checkpoints:
+    infer_args = infer.parser.parse_args(['--checkpoint', checkpoint, '--no-cuda'] + (['--cache-path', args.cache_path] if args.cache_path else []))
+    predictor, names, e_representation, store = infer.load_predictor(infer_args)
+    model = predictor.model
+    name = [key for key, Model in model_dict.items() if type(model) is Model][0]
+    if store is not None:
+      split = load_or_create(split_dir(store.path), 'default', lambda: qm9_split(len(store), seed_of('default')))
+      molecules = Qm9Cached(store, split['valid'])
+      molecules = [molecules[i] for i in range(min(len(molecules), sum(args.batch_sizes)))]
+    else:
+      molecules = random_molecules(sum(args.batch_sizes))
+    #end if
+    offsets = np.cumsum([0] + args.batch_sizes)
+    batches = [collate_g_concat_arrays(molecules[start:end]) for start, end in zip(offsets[:-1], offsets[1:]) if end <= len(molecules)]
+    example = max(batches, key=lambda batch: batch[0])
+
+    latencies = [latency(model, inputs_of(batch), args.repeats) for batch in batches]
+    print('{:>8} {:>7} {:>9} {:>9} {:>10} '.format(name, 'eager', '', '', '') + ' '.join('{:>10.2f}'.format(ms) for ms in latencies), flush=True)
+
+    start = time.perf_counter()
+    prepared = prepare(model, args.ode_solver)
+    program = export_model(prepared, example)
+    export_time = time.perf_counter() - start
+    if args.ode_solver is not None and any(isinstance(module, EdgeODEBlock) for module in model.modules()):
+      with torch.inference_mode():
+        solver_diff = max((prepared(**inputs_of(batch)) - model(**inputs_of(batch))).abs().max().item() for batch in batches)
+      #end with
+      print('{:>8} exported with the {} solver, max|diff| {:.2g} from the checkpoint\'s'.format(name, args.ode_solver, solver_diff), flush=True)
+    model_kwargs = dict(torch.load(checkpoint, map_location='cpu').get('model_kwargs') or {}, dense="never", discrete_edges=False)
+    if args.ode_solver is not None:
+      model_kwargs['ode_solver'] = args.ode_solver
+    meta = {
+        'model': name,
+        'model_kwargs': model_kwargs,
+        'checkpoint': checkpoint,
+        'targets': list(names),
+        'target_mean': None if predictor.target_mean is None else predictor.target_mean.tolist(),
+        'target_std': None if predictor.target_std is None else predictor.target_std.tolist(),
+        'e_representation': e_representation,
+        'torch': torch.__version__,
+    }
+    for format in args.formats:
+      path = os.path.join(args.out_dir, '{}.pt2'.format(name) if format == 'export' else '{}.{}.pt2'.format(name, format))
+      start = time.perf_counter()
+      save_artifact(program, path, dict(meta, format=format), format)
+      build_time = time.perf_counter() - start + export_time
+      artifact, _ = load_artifact(path)
+      with torch.inference_mode():
+        diff = max((artifact(**inputs_of(batch)) - prepared(**inputs_of(batch))).abs().max().item() for batch in batches)
+      #end with
+      failed += diff > args.tol
+      latencies = [latency(artifact, inputs_of(batch), args.repeats) for batch in batches]
+      print('{:>8} {:>7} {:>9.1f} {:>9.1f} {:>10.2g} '.format(name, format, os.path.getsize(path) / 1024., build_time, diff)
+            + ' '.join('{:>10.2f}'.format(ms) for ms in latencies) + ('  MISMATCH' if diff > args.tol else ''), flush=True)
+    #end for
+  #end for
+  if failed:
+    print('{} artifacts differ from their eager models by more than {}'.format(failed, args.tol), file=sys.stderr)
+    sys.exit(1)
+
+
+if __name__ == '__main__':
+  main()
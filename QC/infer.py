@@ -0,0 +1,451 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+  infer.py: Predictions of a trained model for molecules given as SMILES.
+
+  Loads a checkpoint written by train_egcn.py, model_best.pth of the checkpoint layout
+  ./checkpoint/{model}-{layers}/{dataset}/all/ by default. Checkpoints name their model and its
+  constructor arguments; for older ones, which do not, the model is rebuilt from the same options
+  as train_egcn.py takes. Outputs are de-normalized with the target statistics of the store the
+  model was trained on, or with those of the whole QM9 when it was trained without one. An
+  artifact written by export.py carries its statistics and needs none of the model code.
+
+  SMILES are featurized by a pool of worker processes with RDKit: the molecule is embedded in 3D
+  and given Gasteiger charges, see smiles_array_reader, and its edges built as in the store. As
+  molecules come out of the pool they are queued for the model, which takes them in batches of up
+  to --node-budget atoms, waiting at most --max-wait ms to fill one, and runs them under
+  torch.inference_mode.
+
+  Molecules are read one SMILES per line, from a file or stdin, and written as tab separated
+  predictions in input order; or served over HTTP on localhost (--serve PORT), where
+  POST /predict takes a JSON list of SMILES, or one per line, and GET /stats reports the
+  throughput and latency so far. Every request gets a JSON reply, an 'error' one with status 400
+  for a body of any other shape. Latencies are those of the model queue, from a molecule being
+  featurized to its prediction, and of the featurization itself; over HTTP also of whole requests.
+
+  Usage:
+    python infer.py molecules.smi --model egcnsum --layers 3 > predictions.tsv
+    cat molecules.smi | python infer.py --checkpoint ./checkpoint/egcnsum-3/qm9/all/model_best.pth
+    python infer.py --serve 8000 --workers 4 --quantize
+    python infer.py molecules.smi --artifact ./export/egcnsum.pt2
+    curl -d '["CCO", "c1ccccc1"]' http://127.0.0.1:8000/predict
+
+"""
+
+from __future__ import print_function
+
+import argparse
+import collections
+import http.server
+import json
+import multiprocessing
+import os
+import queue
+import signal
+import sys
+import threading
+import time
+from concurrent.futures import Future
+
+import numpy as np
+import torch
+
+from datasets.store import GraphStore, store_exists
+from datasets.utils import collate_g_concat_arrays
+from datasets.featurize import init_worker
+from train_egcn import model_dict, dataset_cache_paths, dataset_types
+from util import QM9_TARGETS, QM9_TARGET_MEAN, QM9_TARGET_STD
+from quantize import quantize_dynamic
+
+__author__ = "Pedro HC Avelar"
+__email__ = "phcavelar@inf.ufrgs.br"
+
+# Argument parser
+parser = argparse.ArgumentParser(description='Predict the targets of molecules given as SMILES with a trained model.')
+parser.add_argument('input', nargs='?', help='File with one SMILES per line (default: stdin)')
+parser.add_argument('--output', help='Tab separated predictions (default: stdout)')
+parser.add_argument('--serve', type=int, metavar='PORT', help='Serve predictions over HTTP on localhost instead')
+parser.add_argument('--checkpoint', help='Checkpoint to load (default: model_best.pth under --resume)')
+parser.add_argument('--artifact', help='Self-contained model written by export.py, loaded instead of a checkpoint')
+parser.add_argument('--resume', default='./checkpoint/{model}-{layers}/{dataset}/all', help='Checkpoint directory layout of train_egcn.py')
+parser.add_argument('--dataset', default='qm9', help='Dataset the model was trained on')
+parser.add_argument('--cache-path', help='Store the model was trained on, for its target statistics (default: the one in the checkpoint)')
+parser.add_argument('--node-budget', type=int, default=1000, metavar='N', help='Atoms per batch (default: 1000)')
+parser.add_argument('--max-wait', type=float, default=5., metavar='MS', help='Longest wait to fill a batch, in ms (default: 5)')
+parser.add_argument('--workers', type=int, default=None, help='Featurization processes (default: all cores)')
+parser.add_argument('--threads', type=int, default=None, help='torch intra-op threads')
+parser.add_argument('--dense', choices=["never", "auto", "always"], default=None, help='Override the dense mode of the model')
+parser.add_argument('--quantize', action='store_true', default=False,
+          help='Run the model dynamically quantized to int8, on the CPU, see quantize.py')
+parser.add_argument('--no-cuda', action='store_true', default=False, help='Disables CUDA')
+# For checkpoints that do not record their model, as in train_egcn.py
+parser.add_argument('--model', choices=sorted(model_dict.keys()), default="egcnsum")
+parser.add_argument('--hidden', type=int, default=73)
+parser.add_argument('--layers', type=int, default=3)
+parser.add_argument('--s2s', type=int, default=4)
+parser.add_argument('--aggr', choices=["sum", "mean", "max"], default="sum")
+parser.add_argument('--discrete-edges', action='store_true', default=False)
+parser.add_argument('--rank', type=int, default=None)
+parser.add_argument('--ode-solver', default="dopri5")
+parser.add_argument('--ode-gradient', default="adjoint")
+parser.add_argument('--ode-tol', type=float, default=1e-3)
+
+
+def init_featurize_worker():
+  # Interrupting the server stops the main process, which then closes the pool
+  signal.signal(signal.SIGINT, signal.SIG_IGN)
+  init_worker()
+
+
+def featurize_smiles(task):
+  """(smiles, arrays or None, error or None, seconds) for a (smiles, e_representation) task, in a worker"""
+  from datasets.qm9 import smiles_graph_arrays
+  smiles, e_representation = task
+  start = time.perf_counter()
+  try:
+    arrays, error = smiles_graph_arrays(smiles, e_representation), None
+  except Exception as e:
+    arrays, error = None, repr(e)
+  return smiles, arrays, error, time.perf_counter() - start
+
+
+class Latencies(object):
+  """Latencies and batch sizes recorded from any thread, and their percentiles"""
+
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.start = time.perf_counter()
+    self.values = collections.defaultdict(list)
+    self.batches = []
+
+  def add(self, name, seconds):
+    with self.lock:
+      self.values[name].append(seconds)
+
+  def add_batch(self, graphs, nodes):
+    with self.lock:
+      self.batches.append((graphs, nodes))
+
+  def summary(self):
+    with self.lock:
+      elapsed = time.perf_counter() - self.start
+      done = sum(graphs for graphs, _ in self.batches)
+      summary = {
+          'molecules': done,
+          'batches': len(self.batches),
+          'seconds': elapsed,
+          'molecules_per_second': done / max(elapsed, 1e-9),
+          'mean_batch_molecules': done / max(len(self.batches), 1),
+          'mean_batch_nodes': sum(nodes for _, nodes in self.batches) / max(len(self.batches), 1),
+      }
+      for name, values in self.values.items():
+        p50, p90, p99 = np.percentile(np.array(values) * 1e3, [50, 90, 99]) if values else (0., 0., 0.)
+        summary[name + '_ms'] = {'p50': p50, 'p90': p90, 'p99': p99, 'max': max(values) * 1e3 if values else 0.}
+      #end for
+    return summary
+
+  def report(self, file=sys.stderr):
+    summary = self.summary()
+    print('{molecules} molecules in {batches} batches, {seconds:.2f}s: {molecules_per_second:.1f} mol/s, '
+          '{mean_batch_molecules:.1f} molecules and {mean_batch_nodes:.0f} atoms per batch'.format(**summary), file=file)
+    for name in sorted(self.values):
+      print('\t{:<10} latency (ms) p50 {p50:.2f} p90 {p90:.2f} p99 {p99:.2f} max {max:.2f}'.format(name, **summary[name + '_ms']), file=file)
+    file.flush()
+#end Latencies
+
+
+class Predictor(object):
+  """A trained model, in eval mode, and the statistics to de-normalize its outputs with"""
+
+  def __init__(self, model, target_mean=None, target_std=None, cuda=False):
+    self.model = model
+    self.target_mean = None if target_mean is None else torch.as_tensor(target_mean, dtype=torch.float32)
+    self.target_std = None if target_std is None else torch.as_tensor(target_std, dtype=torch.float32)
+    self.cuda = cuda
+
+  def __call__(self, graphs):
+    """num_graphs x target_features predictions for a list of (x, edge_index, edge_attr) arrays"""
+    _, b, x, e_d, e_src, e_tgt, _ = collate_g_concat_arrays([(g, np.zeros(0, dtype=np.float32)) for g in graphs])
+    return self.predict_batch(b, x, e_d, e_src, e_tgt)
+
+  def predict_batch(self, b, x, e_d, e_src, e_tgt):
+    """Predictions for a batch collated by collate_g_concat_arrays"""
+    if self.cuda:
+      b, x, e_d, e_src, e_tgt = map(lambda a: a.cuda(), (b, x, e_d, e_src, e_tgt))
+    with torch.inference_mode():
+      output = self.model(node_features=x, edge_features=e_d, Esrc=e_src, Etgt=e_tgt, batch=b).float().cpu()
+    if self.target_mean is not None:
+      output = output * self.target_std + self.target_mean
+    return output.numpy()
+#end Predictor
+
+
+class Batcher(object):
+  """
+    Runs predictor on the molecules submitted from any thread, in batches of up to node_budget atoms,
+    collected for at most max_wait seconds after the first molecule of the batch comes in.
+  """
+
+  def __init__(self, predictor, node_budget=1000, max_wait=0.005, latencies=None):
+    self.predictor = predictor
+    self.node_budget = node_budget
+    self.max_wait = max_wait
+    self.latencies = latencies if latencies is not None else Latencies()
+    self.queue = queue.Queue()
+    self.thread = threading.Thread(target=self._run, name='Batcher', daemon=True)
+    self.thread.start()
+
+  def submit(self, graph):
+    """Future of the predictions for the (x, edge_index, edge_attr) arrays of one molecule"""
+    future = Future()
+    self.queue.put((graph, future, time.perf_counter()))
+    return future
+
+  def _batches(self):
+    # A molecule taken off the queue that did not fit in the previous batch
+    carry = []
+    while True:
+      item = carry.pop() if carry else self.queue.get()
+      if item is None:
+        return
+      batch, nodes = [item], len(item[0][0])
+      deadline = time.perf_counter() + self.max_wait
+      while nodes < self.node_budget:
+        try:
+          item = self.queue.get(timeout=max(deadline - time.perf_counter(), 0))
+        except queue.Empty:
+          break
+        if item is None or nodes + len(item[0][0]) > self.node_budget:
+          carry.append(item)
+          break
+        #end if
+        batch.append(item)
+        nodes += len(item[0][0])
+      #end while
+      yield batch, nodes
+    #end while
+
+  def _run(self):
+    for batch, nodes in self._batches():
+      try:
+        output = self.predictor([graph for graph, _, _ in batch])
+      except Exception as e:
+        for _, future, _ in batch:
+          future.set_exception(e)
+        continue
+      #end try
+      now = time.perf_counter()
+      for (_, future, submitted), prediction in zip(batch, output):
+        self.latencies.add('queue', now - submitted)
+        future.set_result(prediction)
+      #end for
+      self.latencies.add_batch(len(batch), nodes)
+    #end for
+
+  def close(self):
+    self.queue.put(None)
+    self.thread.join()
+#end Batcher
+
+
+def load_predictor(args):
+  """The Predictor of the checkpoint selected by args, the names of its targets, its edge representation and its store, if any"""
+  if args.artifact is not None:
+    from export import load_artifact
+    print('=> loading artifact {}'.format(args.artifact), file=sys.stderr)
+    model, meta = load_artifact(args.artifact)
+    print('\t{} ({}), {} edges'.format(meta['model'], meta['format'], meta['e_representation']), file=sys.stderr)
+    return Predictor(model, meta['target_mean'], meta['target_std']), meta['targets'], meta['e_representation'], None
+  #end if
+  checkpoint_file = args.checkpoint
+  if checkpoint_file is None:
+    checkpoint_file = os.path.join(args.resume.format(dataset=args.dataset, model=args.model, layers=args.layers), 'model_best.pth')
+  print('=> loading model {}'.format(checkpoint_file), file=sys.stderr)
+  checkpoint = torch.load(checkpoint_file, map_location='cpu')
+
+  cache = args.cache_path or checkpoint.get('cache_path') or dataset_cache_paths.get(args.dataset)
+  store = GraphStore(cache) if cache is not None and store_exists(cache) else None
+  if store is not None:
+    e_representation = store.meta['e_representation']
+    stats = store.stats()
+    target_mean, target_std = stats.target_mean, np.where(stats.target_std > 0, stats.target_std, 1)
+  else:
+    print('\tNo store at {}, using the statistics of the whole QM9'.format(cache), file=sys.stderr)
+    e_representation, target_mean, target_std = 'raw_distance', QM9_TARGET_MEAN, QM9_TARGET_STD
+  #end if
+
+  name = checkpoint.get('model', args.model)
+  model_kwargs = checkpoint.get('model_kwargs')
+  if model_kwargs is None:
+    if store is not None:
+      features = store.meta['node_features'], store.meta['edge_features'], store.meta['target_features']
+    else:
+      features = 13, 5, len(QM9_TARGETS)
+    model_kwargs = dict(node_features=features[0], edge_features=features[1], target_features=features[2],
+                        hidden_features=args.hidden, num_layers=args.layers, dropout=0.5, type=dataset_types[args.dataset],
+                        s2s_processing_steps=args.s2s, aggr=args.aggr, discrete_edges=args.discrete_edges, rank=args.rank,
+                        dense=args.dense or "auto", ode_solver=args.ode_solver, ode_gradient=args.ode_gradient, ode_tol=args.ode_tol)
+  #end if
+  if args.dense is not None:
+    model_kwargs = dict(model_kwargs, dense=args.dense)
+  model = model_dict[name](**model_kwargs)
+  model.load_state_dict(checkpoint['state_dict'])
+  model.eval()
+  if args.quantize:
+    model = quantize_dynamic(model)
+  cuda = not args.no_cuda and not args.quantize and torch.cuda.is_available()
+  if cuda:
+    model = model.cuda()
+  print('\t{} (epoch {}), {} edges{}'.format(name, checkpoint.get('epoch'), e_representation, ', int8' if args.quantize else ''), file=sys.stderr)
+
+  target_features = model_kwargs['target_features']
+  names = QM9_TARGETS if target_features == len(QM9_TARGETS) else tuple('y{}'.format(i) for i in range(target_features))
+  if model_kwargs.get('type', 'regression') != 'regression':
+    target_mean = target_std = None
+  return Predictor(model, target_mean, target_std, cuda), names, e_representation, store
+
+
+def read_smiles(lines):
+  for line in lines:
+    line = line.strip()
+    if line and not line.startswith('#'):
+      # SMILES files may carry a name or other columns after the SMILES
+      yield line.split()[0]
+
+
+def predict_stream(lines, out, pool, batcher, e_representation, names, latencies):
+  """Writes the predictions of the SMILES in lines to out, in input order, while later ones are still being featurized"""
+  print('\t'.join(('smiles',) + tuple(names)), file=out)
+  failed = 0
+  pending = collections.deque()
+  def write(smiles, future):
+    if future.exception() is not None:
+      print('{}\t{}'.format(smiles, future.exception()), file=sys.stderr)
+      print('\t'.join([smiles] + ['nan'] * len(names)), file=out)
+      return 1
+    print('\t'.join([smiles] + ['{:.6g}'.format(v) for v in future.result()]), file=out)
+    return 0
+  tasks = ((smiles, e_representation) for smiles in read_smiles(lines))
+  for smiles, arrays, error, seconds in pool.imap(featurize_smiles, tasks, chunksize=8):
+    latencies.add('featurize', seconds)
+    if error is not None:
+      future = Future()
+      future.set_exception(ValueError(error))
+    else:
+      future = batcher.submit(arrays)
+    pending.append((smiles, future))
+    while pending and pending[0][1].done():
+      failed += write(*pending.popleft())
+  #end for
+  while pending:
+    smiles, future = pending.popleft()
+    future.exception()
+    failed += write(smiles, future)
+  #end while
+  out.flush()
+  return failed
+
+
+def serve(port, pool, batcher, e_representation, names, latencies):
+  """Serves POST /predict and GET /stats on localhost until interrupted"""
+
+  class Handler(http.server.BaseHTTPRequestHandler):
+
+    def reply(self, code, body):
+      data = json.dumps(body).encode('utf-8')
+      self.send_response(code)
+      self.send_header('Content-Type', 'application/json')
+      self.send_header('Content-Length', str(len(data)))
+      self.end_headers()
+      self.wfile.write(data)
+
+    def do_GET(self):
+      if self.path != '/stats':
+        return self.reply(404, {'error': 'GET /stats or POST /predict'})
+      self.reply(200, latencies.summary())
+
+    def do_POST(self):
+      if self.path != '/predict':
+        return self.reply(404, {'error': 'GET /stats or POST /predict'})
+      start = time.perf_counter()
+      try:
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0))).decode('utf-8')
+      except ValueError as e:
+        return self.reply(400, {'error': repr(e)})
+      try:
+        smiles = json.loads(body)
+      except ValueError:
+        smiles = list(read_smiles(body.splitlines()))
+      #end try
+      if isinstance(smiles, dict):
+        smiles = smiles.get('smiles')
+      if isinstance(smiles, str):
+        smiles = [smiles]
+      if not isinstance(smiles, list) or not all(isinstance(s, str) for s in smiles):
+        return self.reply(400, {'error': 'expected SMILES lines, or JSON of a SMILES string, a list of them or {"smiles": ...}'})
+      try:
+        results = []
+        for s, arrays, error, seconds in pool.imap(featurize_smiles, [(s, e_representation) for s in smiles]):
+          latencies.add('featurize', seconds)
+          results.append((s, error, batcher.submit(arrays) if error is None else None))
+        #end for
+        predictions = []
+        for s, error, future in results:
+          if future is not None and future.exception() is not None:
+            error = repr(future.exception())
+          if error is not None:
+            predictions.append({'smiles': s, 'error': error})
+          else:
+            predictions.append({'smiles': s, 'prediction': dict(zip(names, map(float, future.result())))})
+        #end for
+      except Exception as e:
+        return self.reply(500, {'error': repr(e)})
+      #end try
+      latencies.add('request', time.perf_counter() - start)
+      self.reply(200, {'predictions': predictions})
+
+    def log_message(self, format, *args):
+      pass
+  #end Handler
+
+  server = http.server.ThreadingHTTPServer(('127.0.0.1', port), Handler)
+  print('Serving on http://127.0.0.1:{}/predict'.format(server.server_address[1]), file=sys.stderr, flush=True)
+  try:
+    server.serve_forever()
+  except KeyboardInterrupt:
+    pass
+  finally:
+    server.server_close()
+  #end try
+
+
+def main():
+  args = parser.parse_args()
+  if args.threads:
+    torch.set_num_threads(args.threads)
+  predictor, names, e_representation, _ = load_predictor(args)
+  # Forked before the batcher thread starts
+  pool = multiprocessing.Pool(args.workers if args.workers else multiprocessing.cpu_count(), initializer=init_featurize_worker)
+  latencies = Latencies()
+  batcher = Batcher(predictor, args.node_budget, args.max_wait * 1e-3, latencies)
+  try:
+    if args.serve is not None:
+      serve(args.serve, pool, batcher, e_representation, names, latencies)
+    else:
+      lines = open(args.input, 'r') if args.input else sys.stdin
+      out = open(args.output, 'w') if args.output else sys.stdout
+      failed = predict_stream(lines, out, pool, batcher, e_representation, names, latencies)
+      if failed:
+        print('{} molecules failed'.format(failed), file=sys.stderr)
+    #end if
+  finally:
+    pool.close()
+    pool.join()
+    batcher.close()
+  #end try
+  latencies.report()
+
+
+if __name__ == '__main__':
+  main()
@@ -1,11 +1,14 @@
+import math
+
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-from torchdiffeq import odeint_adjoint as odeint
+from torchdiffeq import odeint, odeint_adjoint
 from mpnn import MPNN_enn_edge as MPNN_enn
 from set2set import Set2Set
-from layers import TransitionMLP, EdgeEncoderMLP, EdgeGraphConvolution
-from torch_scatter import scatter_add
+from layers import TransitionMLP, EdgeEncoderMLP, LowRankEdgeEncoderMLP, EdgeGraphConvolution, group_edge_types
+from segment import scatter_add
+from dense import DENSE_AGGREGATIONS, DENSE_MODES, DenseEdges, dense_index, use_dense, to_dense_batch, to_dense_edges, dense_sum
 
 def get_output_function(type,target_features):
     if type=="regression":
@@ -22,16 +25,54 @@ class UnimplementedModel(nn.Module):
   def forward(self,*args,**kwargs):
     raise NotImplementedError("Model not implemented yet")
 #end UnimplementedModel
+
+def get_edge_encoder(edge_features, hidden_features, rank=None):
+  """Full hidden x hidden edge matrices, or their rank r factorization when rank is given"""
+  if rank is None or rank >= hidden_features:
+    return EdgeEncoderMLP( edge_features, hidden_features )
+  return LowRankEdgeEncoderMLP( edge_features, hidden_features, rank )
+#end get_edge_encoder
+
+def check_dense(dense, aggr):
+  if dense not in DENSE_MODES:
+    raise ValueError("Unknown dense mode {}, must be one of {}".format(dense, DENSE_MODES))
+  if dense == "always" and aggr not in DENSE_AGGREGATIONS:
+    raise ValueError("The dense layout supports the {} aggregations, not {}".format(DENSE_AGGREGATIONS, aggr))
+  return dense
+#end check_dense
+
+def densify(dense, x, edge_data, Esrc, Etgt, batch, edge_counts=None, aggr="sum"):
+  """
+    The batch laid out padded for the forward_dense of the layers: B x Nmax x f nodes, their mask
+    and the dense.DenseEdges, or None to stay on the concatenated batch. dense is "never", "always"
+    or "auto", which lets dense.use_dense choose from the sizes of the graphs in the batch.
+  """
+  if dense == "never" or aggr not in DENSE_AGGREGATIONS:
+    return None
+  index = dense_index(batch)
+  if dense == "auto" and not use_dense(index, Esrc.size(0), typed=edge_counts is not None):
+    return None
+  x, mask = to_dense_batch(x, index)
+  return x, mask, to_dense_edges(edge_data, Esrc, Etgt, index, edge_counts, aggr)
+#end densify
+
+def padded(f, x):
+  """Applies the node-wise f, which takes N x f matrices, to the B x Nmax x f padded x"""
+  return f(x.reshape(-1, x.size(-1))).view(x.size(0), x.size(1), -1)
+#end padded
   
 
 class MPNN_ENN_K_Sum(nn.Module):
-  def __init__(self, node_features = None, edge_features = None, target_features = 1, hidden_features = 73, num_layers = 3, s2s_processing_steps = 12, type="regression", dropout=0.5, **kwargs):
+  def __init__(self, node_features = None, edge_features = None, target_features = 1, hidden_features = 73, num_layers = 3, s2s_processing_steps = 12, type="regression", dropout=0.5, aggr="sum", discrete_edges=False, rank=None, dense="never", **kwargs):
     super(MPNN_ENN_K_Sum, self).__init__()
     self.input = nn.Linear(in_features=node_features,out_features=hidden_features)
-    self.ee = EdgeEncoderMLP( edge_features, hidden_features )
-    self.mpnn = MPNN_enn(edge_features, hidden_features)
+    self.ee = get_edge_encoder( edge_features, hidden_features, rank )
+    self.mpnn = MPNN_enn(edge_features, hidden_features, aggr=aggr)
     self.mpnn.set_T(num_layers)
     self.output = nn.Linear(in_features=hidden_features,out_features=target_features)
+    self.discrete_edges = discrete_edges
+    self.aggr = aggr
+    self.dense = check_dense(dense, aggr)
     self.type = type
     self.output_function = get_output_function(type,target_features)
 
@@ -39,28 +80,42 @@ class MPNN_ENN_K_Sum(nn.Module):
       node_features,   # N x fn :: Float
       edge_features,   # E x fe :: Float
       Esrc,  # E :: Long
-      Etgt,  # N x E :: Float
+      Etgt,  # E :: Long
       batch,   # B x N :: Float
       ):
-    batch_size = batch.max().item() + 1
     x = node_features
+    edge_counts = None
+    if self.discrete_edges:
+      edge_features, Esrc, Etgt, edge_counts = group_edge_types(edge_features, Esrc, Etgt)
     edge_data = self.ee(edge_features)
     
     x = self.input(x)
-    x = self.mpnn(x,Esrc,Etgt,edge_data)
+    padded_batch = densify(self.dense, x, edge_data, Esrc, Etgt, batch, edge_counts, self.aggr)
+    if padded_batch is not None:
+      x, mask, edges = padded_batch
+      x = self.mpnn.forward_dense(x,edges)
+      x = self.output(x)
+      x = dense_sum(x, mask)
+      return self.output_function(x)
+    #end if
+    batch_size = batch.max().item() + 1
+    x = self.mpnn(x,Esrc,Etgt,edge_data,edge_counts)
     x = self.output(x)
     x = scatter_add(x, batch, dim=0, dim_size=batch_size)
     return self.output_function(x)
 
 class MPNN_ENN_K_Set2Set(nn.Module):
-  def __init__(self, node_features = None, edge_features = None, target_features = 1, hidden_features = 73, num_layers = 3, s2s_processing_steps = 12, type="regression", dropout=0.5, **kwargs):
+  def __init__(self, node_features = None, edge_features = None, target_features = 1, hidden_features = 73, num_layers = 3, s2s_processing_steps = 12, type="regression", dropout=0.5, aggr="sum", discrete_edges=False, rank=None, dense="never", **kwargs):
     super(MPNN_ENN_K_Set2Set, self).__init__()
     self.input = nn.Linear(in_features=node_features,out_features=hidden_features)
-    self.ee = EdgeEncoderMLP( edge_features, hidden_features )
-    self.mpnn = MPNN_enn(edge_features, hidden_features)
+    self.ee = get_edge_encoder( edge_features, hidden_features, rank )
+    self.mpnn = MPNN_enn(edge_features, hidden_features, aggr=aggr)
     self.mpnn.set_T(num_layers)
     self.s2s = Set2Set(hidden_features, s2s_processing_steps, num_layers=1)
     self.output = nn.Linear(in_features=hidden_features,out_features=target_features)
+    self.discrete_edges = discrete_edges
+    self.aggr = aggr
+    self.dense = check_dense(dense, aggr)
     self.type = type
     self.output_function = get_output_function(type,target_features)
 
@@ -68,31 +123,44 @@ class MPNN_ENN_K_Set2Set(nn.Module):
       node_features,   # N x fn :: Float
       edge_features,   # E x fe :: Float
       Esrc,  # E :: Long
-      Etgt,  # N x E :: Float
+      Etgt,  # E :: Long
       batch,   # B x N :: Float
       ):
     x = node_features
+    edge_counts = None
+    if self.discrete_edges:
+      edge_features, Esrc, Etgt, edge_counts = group_edge_types(edge_features, Esrc, Etgt)
     edge_data = self.ee(edge_features)
     
     x = self.input(x)
-    x = self.mpnn(x,Esrc,Etgt,edge_data)
-    x = self.s2s(x,batch)[:,:x.size()[1]]
+    padded_batch = densify(self.dense, x, edge_data, Esrc, Etgt, batch, edge_counts, self.aggr)
+    if padded_batch is not None:
+      x, mask, edges = padded_batch
+      x = self.mpnn.forward_dense(x,edges)
+      x = self.s2s.forward_dense(x,mask)[:,:x.size()[2]]
+    else:
+      x = self.mpnn(x,Esrc,Etgt,edge_data,edge_counts)
+      x = self.s2s(x,batch)[:,:x.size()[1]]
+    #end if
     x = self.output(x)
     return self.output_function(x)
 
 
 class EdgeGCN_K_Sum(nn.Module):
-  def __init__(self, node_features = None, edge_features = None, target_features = 1, hidden_features = 73, num_layers = 3, s2s_processing_steps = 12, type="regression", dropout=0.5, **kwargs):
+  def __init__(self, node_features = None, edge_features = None, target_features = 1, hidden_features = 73, num_layers = 3, s2s_processing_steps = 12, type="regression", dropout=0.5, aggr="sum", discrete_edges=False, rank=None, dense="never", **kwargs):
     super(EdgeGCN_K_Sum, self).__init__()
     self.mlpin = TransitionMLP( node_features, hidden_features )
     self.gcmid = nn.ModuleList(
-        [ EdgeGraphConvolution( hidden_features, hidden_features )
+        [ EdgeGraphConvolution( hidden_features, hidden_features, aggr=aggr )
             for _ in range(num_layers) ] )
     self.mlpout = TransitionMLP( hidden_features, target_features )
     self.dropout = dropout
     
-    self.ee = EdgeEncoderMLP( edge_features, hidden_features )
+    self.ee = get_edge_encoder( edge_features, hidden_features, rank )
     
+    self.discrete_edges = discrete_edges
+    self.aggr = aggr
+    self.dense = check_dense(dense, aggr)
     self.type = type
     self.output_function = get_output_function(type,target_features)
   #end __init__
@@ -101,20 +169,36 @@ class EdgeGCN_K_Sum(nn.Module):
       node_features,   # N x fn :: Float
       edge_features,   # E x fe :: Float
       Esrc,  # E :: Long
-      Etgt,  # N x E :: Float
+      Etgt,  # E :: Long
       batch,   # B x N :: Float
       ):
-    batch_size = batch.max().item() + 1
     x = node_features
+    edge_counts = None
+    if self.discrete_edges:
+      edge_features, Esrc, Etgt, edge_counts = group_edge_types(edge_features, Esrc, Etgt)
     ef = self.ee(edge_features)
 
     x = self.mlpin(x)
     
+    padded_batch = densify(self.dense, x, ef, Esrc, Etgt, batch, edge_counts, self.aggr)
+    if padded_batch is not None:
+      x, mask, edges = padded_batch
+      for gc in self.gcmid[:-1]:
+        x = F.relu(gc.forward_dense(x, edges))
+        x = F.dropout(x, self.dropout, training=self.training)
+      #end for
+      x = self.gcmid[-1].forward_dense(x, edges)
+      x = padded(self.mlpout, x)
+      x = dense_sum(x, mask)
+      return self.output_function(x)
+    #end if
+    
+    batch_size = batch.max().item() + 1
     for gc in self.gcmid[:-1]:
-      x = F.relu(gc(x, Esrc, Etgt, ef))
+      x = F.relu(gc(x, Esrc, Etgt, ef, edge_counts))
       x = F.dropout(x, self.dropout, training=self.training)
     #end for
-    x = self.gcmid[-1](x, Esrc, Etgt, ef)
+    x = self.gcmid[-1](x, Esrc, Etgt, ef, edge_counts)
     
     x = self.mlpout(x)
     
@@ -123,19 +207,22 @@ class EdgeGCN_K_Sum(nn.Module):
 
 
 class EdgeGCN_K_Set2Set(nn.Module):
-  def __init__(self, node_features = None, edge_features = None, target_features = 1, hidden_features = 73, num_layers = 3, s2s_processing_steps = 12, type="regression", dropout=0.5, **kwargs):
+  def __init__(self, node_features = None, edge_features = None, target_features = 1, hidden_features = 73, num_layers = 3, s2s_processing_steps = 12, type="regression", dropout=0.5, aggr="sum", discrete_edges=False, rank=None, dense="never", **kwargs):
     super(EdgeGCN_K_Set2Set, self).__init__()
     self.mlpin = TransitionMLP( node_features, hidden_features )
     self.gcmid = nn.ModuleList(
-        [ EdgeGraphConvolution( hidden_features, hidden_features )
+        [ EdgeGraphConvolution( hidden_features, hidden_features, aggr=aggr )
             for _ in range(num_layers) ] )
     self.mlpout = TransitionMLP( hidden_features, target_features )
     self.dropout = dropout
     
-    self.ee = EdgeEncoderMLP( edge_features, hidden_features )
+    self.ee = get_edge_encoder( edge_features, hidden_features, rank )
     
     self.s2s = Set2Set(hidden_features, s2s_processing_steps, num_layers=1)
     
+    self.discrete_edges = discrete_edges
+    self.aggr = aggr
+    self.dense = check_dense(dense, aggr)
     self.type = type
     self.output_function = get_output_function(type,target_features)
   #end __init__
@@ -144,36 +231,52 @@ class EdgeGCN_K_Set2Set(nn.Module):
       node_features,   # N x fn :: Float
       edge_features,   # E x fe :: Float
       Esrc,  # E :: Long
-      Etgt,  # N x E :: Float
+      Etgt,  # E :: Long
       batch,   # B x N :: Float
       ):
     x = node_features
+    edge_counts = None
+    if self.discrete_edges:
+      edge_features, Esrc, Etgt, edge_counts = group_edge_types(edge_features, Esrc, Etgt)
     ef = self.ee(edge_features)
 
     x = self.mlpin(x)
     
-    for gc in self.gcmid[:-1]:
-      x = F.relu(gc(x, Esrc, Etgt, ef))
-      x = F.dropout(x, self.dropout, training=self.training)
-    #end for
-    x = self.gcmid[-1](x, Esrc, Etgt, ef)
-    
-    x = self.s2s(x, batch)[:,:x.size()[1]]
+    padded_batch = densify(self.dense, x, ef, Esrc, Etgt, batch, edge_counts, self.aggr)
+    if padded_batch is not None:
+      x, mask, edges = padded_batch
+      for gc in self.gcmid[:-1]:
+        x = F.relu(gc.forward_dense(x, edges))
+        x = F.dropout(x, self.dropout, training=self.training)
+      #end for
+      x = self.gcmid[-1].forward_dense(x, edges)
+      x = self.s2s.forward_dense(x, mask)[:,:x.size()[2]]
+    else:
+      for gc in self.gcmid[:-1]:
+        x = F.relu(gc(x, Esrc, Etgt, ef, edge_counts))
+        x = F.dropout(x, self.dropout, training=self.training)
+      #end for
+      x = self.gcmid[-1](x, Esrc, Etgt, ef, edge_counts)
+      x = self.s2s(x, batch)[:,:x.size()[1]]
+    #end if
     x = self.mlpout(x)
     return self.output_function(x)
     
 
 class EdgeRES1_K_Set2Set(nn.Module):
-  def __init__(self, node_features = None, edge_features = None, target_features = 1, hidden_features = 73, num_layers = 3, s2s_processing_steps = 12, type="regression", dropout=0.5, **kwargs):
+  def __init__(self, node_features = None, edge_features = None, target_features = 1, hidden_features = 73, num_layers = 3, s2s_processing_steps = 12, type="regression", dropout=0.5, aggr="sum", discrete_edges=False, rank=None, dense="never", **kwargs):
     super(EdgeRES1_K_Set2Set, self).__init__()
     self.mlpin = TransitionMLP( node_features, hidden_features )
-    self.gcmid = RESKnorm( hidden_features, hidden_features, hidden_features, nlayers = num_layers, residue_layers=1 )
+    self.gcmid = RESKnorm( hidden_features, hidden_features, hidden_features, nlayers = num_layers, residue_layers=1, aggr=aggr )
     self.mlpout = TransitionMLP( hidden_features, target_features )
     
-    self.ee = EdgeEncoderMLP( edge_features, hidden_features )
+    self.ee = get_edge_encoder( edge_features, hidden_features, rank )
     
     self.s2s = Set2Set(hidden_features, s2s_processing_steps, num_layers=1)
     
+    self.discrete_edges = discrete_edges
+    self.aggr = aggr
+    self.dense = check_dense(dense, aggr)
     self.type = type
     self.output_function = get_output_function(type,target_features)
   #end __init__
@@ -182,22 +285,31 @@ class EdgeRES1_K_Set2Set(nn.Module):
       node_features,   # N x fn :: Float
       edge_features,   # E x fe :: Float
       Esrc,  # E :: Long
-      Etgt,  # N x E :: Float
+      Etgt,  # E :: Long
       batch,   # B x N :: Float
       ):
     x = node_features
+    edge_counts = None
+    if self.discrete_edges:
+      edge_features, Esrc, Etgt, edge_counts = group_edge_types(edge_features, Esrc, Etgt)
     ef = self.ee(edge_features)
 
     x = self.mlpin(x)
     
-    x = self.gcmid(x, Esrc, Etgt, ef)
-    
-    x = self.s2s(x, batch)[:,:x.size()[1]]
+    padded_batch = densify(self.dense, x, ef, Esrc, Etgt, batch, edge_counts, self.aggr)
+    if padded_batch is not None:
+      x, mask, edges = padded_batch
+      x = self.gcmid.forward_dense(x, edges)
+      x = self.s2s.forward_dense(x, mask)[:,:x.size()[2]]
+    else:
+      x = self.gcmid(x, Esrc, Etgt, ef, edge_counts)
+      x = self.s2s(x, batch)[:,:x.size()[1]]
+    #end if
     x = self.mlpout(x)
     return self.output_function(x)
     
 class RESKnorm(nn.Module):
-  def __init__(self, nfeat, nhid, nclass, nlayers=3, residue_layers=1):
+  def __init__(self, nfeat, nhid, nclass, nlayers=3, residue_layers=1, aggr="sum"):
     super(RESKnorm, self).__init__()
     
     if nlayers<2+residue_layers:
@@ -205,15 +317,15 @@ class RESKnorm(nn.Module):
     
     self.n_layers = nlayers
     stacked_layers = (
-      [EdgeGraphConvolution(nfeat, nhid)] +
-      [EdgeGraphConvolution(nhid, nhid) for _ in range(self.n_layers - 2) ] +
-      [EdgeGraphConvolution(nhid, nclass)]
+      [EdgeGraphConvolution(nfeat, nhid, aggr=aggr)] +
+      [EdgeGraphConvolution(nhid, nhid, aggr=aggr) for _ in range(self.n_layers - 2) ] +
+      [EdgeGraphConvolution(nhid, nclass, aggr=aggr)]
     )
     self.gcs = nn.ModuleList(stacked_layers)
     self.norms = nn.ModuleList([nn.GroupNorm(min(32, nhid), nhid) for _ in range(self.n_layers-2)])
     self.residue_layers = residue_layers
 
-  def forward(self, x, Esrc, Etgt, ef):
+  def forward(self, x, Esrc, Etgt, ef, edge_counts=None):
     gather_residue = 1
     
     for gc,norm in zip(self.gcs[0:-1],self.norms):
@@ -221,13 +333,268 @@ class RESKnorm(nn.Module):
       if gather_residue == 0:
         r = x
         gather_residue = self.residue_layers
-      x = F.relu(gc(x, Esrc, Etgt, ef))
+      x = F.relu(gc(x, Esrc, Etgt, ef, edge_counts))
       x = norm(x)
       if gather_residue == 1:
         x = x + r
     #end for
     if gather_residue > 1:
       x = x + r
-    x = self.gcs[-1](x, Esrc, Etgt, ef)
+    x = self.gcs[-1](x, Esrc, Etgt, ef, edge_counts)
+    return x
+
+  def forward_dense(self, x, edges):
+    gather_residue = 1
+    
+    for gc,norm in zip(self.gcs[0:-1],self.norms):
+      gather_residue -= 1
+      if gather_residue == 0:
+        r = x
+        gather_residue = self.residue_layers
+      x = F.relu(gc.forward_dense(x, edges))
+      x = padded(norm, x)
+      if gather_residue == 1:
+        x = x + r
+    #end for
+    if gather_residue > 1:
+      x = x + r
+    x = self.gcs[-1].forward_dense(x, edges)
     return x
 
+
+ODE_SOLVERS = ("dopri5", "bosh3", "adaptive_heun", "rk4", "midpoint", "euler")
+FIXED_GRID_SOLVERS = ("rk4", "midpoint", "euler")
+
+# Increments of one step of the fixed grid solvers of torchdiffeq, rk4 being its 3/8 rule variant
+def euler_step(func, t0, dt, y0):
+  return dt * func(t0, y0)
+
+def midpoint_step(func, t0, dt, y0):
+  half_dt = 0.5 * dt
+  return dt * func(t0 + half_dt, y0 + func(t0, y0) * half_dt)
+
+def rk4_step(func, t0, dt, y0):
+  k1 = func(t0, y0)
+  k2 = func(t0 + dt / 3., y0 + dt * k1 / 3.)
+  k3 = func(t0 + dt * 2. / 3., y0 + dt * (k2 - k1 / 3.))
+  k4 = func(t0 + dt, y0 + dt * (k1 - k2 + k3))
+  return (k1 + 3 * (k2 + k3) + k4) * dt * 0.125
+
+FIXED_GRID_STEPS = {"rk4": rk4_step, "midpoint": midpoint_step, "euler": euler_step}
+
+def fixed_grid(step_size, end):
+  """The times torchdiffeq's fixed grid solvers step through over [0, end]"""
+  if not step_size:
+    return [0., end]
+  grid = [i * step_size for i in range(int(math.ceil(end / step_size + 1)))]
+  grid[-1] = end
+  return grid
+#end fixed_grid
+ODE_GRADIENTS = ("adjoint", "backprop")
+
+def edge_tensors(edge_data):
+  """The tensors of the edge data of edge_messages, or of dense.DenseEdges, that gradients flow to"""
+  if isinstance(edge_data, DenseEdges):
+    edge_data = edge_data.data
+  return edge_data if isinstance(edge_data, tuple) else (edge_data,)
+#end edge_tensors
+
+class EdgeODEfunc(nn.Module):
+  """dx/dt = relu(EdgeGraphConvolution([t, norm(x)])) over the edges of a batch, as GCN's ODEfunc"""
+  def __init__(self, dim, aggr="sum"):
+    super(EdgeODEfunc, self).__init__()
+    self.norm1 = nn.GroupNorm(min(32, dim), dim)
+    self.gc1 = EdgeGraphConvolution(dim+1, dim, aggr=aggr)
+    self.nfe = 0
+
+  def forward(self, t, x, edges):
+    """edges is (Esrc, Etgt, edge_data, edge_counts) for N x dim x, or dense.DenseEdges for B x Nmax x dim x"""
+    self.nfe += 1
+    # Concatenate time to node's features
+    if isinstance(edges, DenseEdges):
+      x = padded(self.norm1, x)
+      tt = torch.ones_like(x[..., :1]) * t
+      return F.relu(self.gc1.forward_dense(torch.cat([tt, x], -1), edges))
+    #end if
+    x = self.norm1(x)
+    tt = torch.ones_like(x[:, :1]) * t
+    return F.relu(self.gc1(torch.cat([tt, x], 1), *edges))
+#end EdgeODEfunc
+
+class EdgeODEBlock(nn.Module):
+  """
+    Integrates an EdgeODEfunc over [0, integration_time] with the solver of torchdiffeq, see EdgeODE_K_Sum.
+
+    With gradient="adjoint" the backward pass solves the adjoint ODE instead of backpropagating
+    through the solver steps, so the memory taken does not grow with the number of steps.
+    step_size is used by the fixed grid solvers only. Without gradients, the steps of these are taken
+    here, the same as torchdiffeq takes, which saves its bookkeeping and lets torch.export trace them.
+  """
+  def __init__(self, odefunc, solver="dopri5", gradient="adjoint", tol=1e-3, step_size=None, integration_time=1.):
+    super(EdgeODEBlock, self).__init__()
+    if solver not in ODE_SOLVERS:
+      raise ValueError("Unknown ODE solver {}, must be one of {}".format(solver, ODE_SOLVERS))
+    if gradient not in ODE_GRADIENTS:
+      raise ValueError("Unknown ODE gradient {}, must be one of {}".format(gradient, ODE_GRADIENTS))
+    self.odefunc = odefunc
+    self.solver = solver
+    self.gradient = gradient
+    self.tol = tol
+    self.step_size = step_size
+    self.end_time = float(integration_time)
+    self.integration_time = torch.tensor([0, integration_time]).float()
+
+  def forward(self, x, Esrc, Etgt, edge_data, edge_counts=None):
+    return self.integrate(x, (Esrc, Etgt, edge_data, edge_counts), edge_tensors(edge_data))
+
+  def forward_dense(self, x, edges):
+    return self.integrate(x, edges, edge_tensors(edges))
+
+  def integrate(self, x, edges, params):
+    if self.solver in FIXED_GRID_SOLVERS and not torch.is_grad_enabled():
+      return self.integrate_fixed(x, edges)
+    self.integration_time = self.integration_time.type_as(x)
+    options = {"step_size": self.step_size} if self.solver in FIXED_GRID_SOLVERS and self.step_size else None
+    # The edges of the batch are bound here rather than kept in odefunc, so that the adjoint pass
+    # of a batch uses its own edges even if the model ran on another batch in the meantime
+    func = lambda t, x: self.odefunc(t, x, edges)
+    if self.gradient == "adjoint":
+      out = odeint_adjoint(func, x, self.integration_time, rtol=self.tol, atol=self.tol, method=self.solver, options=options,
+                           adjoint_params=tuple(self.odefunc.parameters()) + params)
+    else:
+      out = odeint(func, x, self.integration_time, rtol=self.tol, atol=self.tol, method=self.solver, options=options)
+    return out[1]
+
+  def integrate_fixed(self, x, edges):
+    step = FIXED_GRID_STEPS[self.solver]
+    func = lambda t, x: self.odefunc(t, x, edges)
+    grid = fixed_grid(self.step_size, self.end_time)
+    for t0, t1 in zip(grid[:-1], grid[1:]):
+      x = x + step(func, t0, t1 - t0, x)
+      if t1 >= self.end_time:
+        break
+    #end for
+    return x
+
+  @property
+  def nfe(self):
+    return self.odefunc.nfe
+
+  @nfe.setter
+  def nfe(self, value):
+    self.odefunc.nfe = value
+#end EdgeODEBlock
+
+class EdgeODE_K_Sum(nn.Module):
+  """
+    EdgeGCN_K_Sum with the stacked gcmid layers replaced by a single EdgeODEBlock, whose dynamics are
+    conditioned on the edge matrices of the batch. Fixed grid solvers take num_layers steps. No dropout
+    is applied inside the ODE.
+  """
+  def __init__(self, node_features = None, edge_features = None, target_features = 1, hidden_features = 73, num_layers = 3, s2s_processing_steps = 12, type="regression", dropout=0.5, aggr="sum", discrete_edges=False, rank=None, dense="never", ode_solver="dopri5", ode_gradient="adjoint", ode_tol=1e-3, **kwargs):
+    super(EdgeODE_K_Sum, self).__init__()
+    self.mlpin = TransitionMLP( node_features, hidden_features )
+    self.ode = EdgeODEBlock( EdgeODEfunc( hidden_features, aggr=aggr ), solver=ode_solver, gradient=ode_gradient, tol=ode_tol, step_size=1./num_layers )
+    self.mlpout = TransitionMLP( hidden_features, target_features )
+    
+    self.ee = get_edge_encoder( edge_features, hidden_features, rank )
+    
+    self.discrete_edges = discrete_edges
+    self.aggr = aggr
+    self.dense = check_dense(dense, aggr)
+    self.type = type
+    self.output_function = get_output_function(type,target_features)
+  #end __init__
+  
+  def forward(self,
+      node_features,   # N x fn :: Float
+      edge_features,   # E x fe :: Float
+      Esrc,  # E :: Long
+      Etgt,  # E :: Long
+      batch,   # B x N :: Float
+      ):
+    x = node_features
+    edge_counts = None
+    if self.discrete_edges:
+      edge_features, Esrc, Etgt, edge_counts = group_edge_types(edge_features, Esrc, Etgt)
+    ef = self.ee(edge_features)
+
+    x = self.mlpin(x)
+    
+    padded_batch = densify(self.dense, x, ef, Esrc, Etgt, batch, edge_counts, self.aggr)
+    if padded_batch is not None:
+      x, mask, edges = padded_batch
+      x = self.ode.forward_dense(x, edges)
+      x = padded(self.mlpout, x)
+      x = dense_sum(x, mask)
+      return self.output_function(x)
+    #end if
+    
+    batch_size = batch.max().item() + 1
+    x = self.ode(x, Esrc, Etgt, ef, edge_counts)
+    x = self.mlpout(x)
+    x = scatter_add(x, batch, dim=0, dim_size=batch_size)
+    return self.output_function(x)
+
+  @property
+  def nfe(self):
+    return self.ode.nfe
+
+  @nfe.setter
+  def nfe(self, value):
+    self.ode.nfe = value
+
+
+class EdgeODE_K_Set2Set(nn.Module):
+  """EdgeGCN_K_Set2Set with an EdgeODEBlock, see EdgeODE_K_Sum"""
+  def __init__(self, node_features = None, edge_features = None, target_features = 1, hidden_features = 73, num_layers = 3, s2s_processing_steps = 12, type="regression", dropout=0.5, aggr="sum", discrete_edges=False, rank=None, dense="never", ode_solver="dopri5", ode_gradient="adjoint", ode_tol=1e-3, **kwargs):
+    super(EdgeODE_K_Set2Set, self).__init__()
+    self.mlpin = TransitionMLP( node_features, hidden_features )
+    self.ode = EdgeODEBlock( EdgeODEfunc( hidden_features, aggr=aggr ), solver=ode_solver, gradient=ode_gradient, tol=ode_tol, step_size=1./num_layers )
+    self.mlpout = TransitionMLP( hidden_features, target_features )
+    
+    self.ee = get_edge_encoder( edge_features, hidden_features, rank )
+    
+    self.s2s = Set2Set(hidden_features, s2s_processing_steps, num_layers=1)
+    
+    self.discrete_edges = discrete_edges
+    self.aggr = aggr
+    self.dense = check_dense(dense, aggr)
+    self.type = type
+    self.output_function = get_output_function(type,target_features)
+  #end __init__
+  
+  def forward(self,
+      node_features,   # N x fn :: Float
+      edge_features,   # E x fe :: Float
+      Esrc,  # E :: Long
+      Etgt,  # E :: Long
+      batch,   # B x N :: Float
+      ):
+    x = node_features
+    edge_counts = None
+    if self.discrete_edges:
+      edge_features, Esrc, Etgt, edge_counts = group_edge_types(edge_features, Esrc, Etgt)
+    ef = self.ee(edge_features)
+
+    x = self.mlpin(x)
+    
+    padded_batch = densify(self.dense, x, ef, Esrc, Etgt, batch, edge_counts, self.aggr)
+    if padded_batch is not None:
+      x, mask, edges = padded_batch
+      x = self.ode.forward_dense(x, edges)
+      x = self.s2s.forward_dense(x, mask)[:,:x.size()[2]]
+    else:
+      x = self.ode(x, Esrc, Etgt, ef, edge_counts)
+      x = self.s2s(x, batch)[:,:x.size()[1]]
+    #end if
+    x = self.mlpout(x)
+    return self.output_function(x)
+
+  @property
+  def nfe(self):
+    return self.ode.nfe
+
+  @nfe.setter
+  def nfe(self, value):
+    self.ode.nfe = value
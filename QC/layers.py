@@ -7,6 +7,9 @@ import torch.nn.functional as F
 from torch.nn.parameter import Parameter
 from torch.nn.modules.module import Module
 
+from segment import scatter
+from dense import dense_messages
+
 class MyLinear(Module):
   def __init__(self, in_features, out_features, bias=True):
     super(MyLinear, self).__init__()
@@ -85,6 +88,21 @@ class EdgeEncoderMLP(Module):
   #end forward
 #end MLP
 
+class LowRankEdgeEncoderMLP(Module):
+  """Rank r alternative to EdgeEncoderMLP, encodes each edge matrix as U_e V_e^T from E x nf x r factors"""
+  def __init__(self, edge_features, node_features, rank, bias=True):
+    super(LowRankEdgeEncoderMLP, self).__init__()
+    self.mlp = TransitionMLP(  edge_features, 2*node_features*rank, bias=bias )
+    self.nf = node_features
+    self.rank = rank
+  #end __init__
+  
+  def forward(self, input):
+    uv = self.mlp(input).reshape([input.size()[0],self.nf,2*self.rank])
+    return uv[:,:,:self.rank], uv[:,:,self.rank:]
+  #end forward
+#end LowRankEdgeEncoderMLP
+
 class EdgeGraphConvolution_UNUSED(Module):
   """
   Simple GCN layer, similar to https://arxiv.org/abs/1609.02907
@@ -111,15 +129,74 @@ class EdgeGraphConvolution_UNUSED(Module):
          + str(self.in_features) + ' -> ' \
          + str(self.out_features) + ')'
 
+def group_edge_types(edge_features, Esrc, Etgt):
+  """
+    Discrete edge vocabulary: finds the K distinct rows of edge_features (e.g. the bond types of
+    chem_graph or the bins of distance_bin) and sorts the edges by them.
+
+    Returns the K x fe edge types, Esrc and Etgt in type order and the K group sizes, so that the
+    edge encoder runs once per type and edge_messages does one mm per type.
+  """
+  if Etgt.dim() != 1:
+    raise ValueError("Grouping edges by type needs an E :: Long target index")
+  types, etype = torch.unique(edge_features, dim=0, return_inverse=True)
+  etype, order = torch.sort(etype, stable=True)
+  counts = torch.bincount(etype, minlength=types.size(0)).tolist()
+  return types, Esrc[order], Etgt[order], counts
+
+
+def edge_messages(edge_data, edge_support, edge_counts=None):
+  """
+    E x fo messages edge_data[e] @ edge_support[e] for E x fo x fo edge matrices, or, when edge_counts
+    gives the group sizes from group_edge_types, with K x fo x fo matrices shared by each group.
+
+    edge_data may also be the (U, V) factors of LowRankEdgeEncoderMLP, in which case the messages
+    are U_e (V_e^T edge_support[e]) and the fo x fo matrices are never formed.
+  """
+  if edge_counts is not None and not edge_counts:
+    # No edge types to group, as in a batch of lone atoms
+    return edge_support.new_zeros(0, edge_support.size(1))
+  if isinstance(edge_data, tuple):
+    U, V = edge_data
+    if edge_counts is None:
+      return torch.bmm(U, torch.bmm(V.transpose(1, 2), edge_support.unsqueeze(-1))).squeeze(-1)
+    return torch.cat([s.mm(v).mm(u.t()) for s, u, v in zip(edge_support.split(edge_counts), U, V)])
+  #end if
+  if edge_counts is None:
+    return torch.bmm(edge_data, edge_support.unsqueeze(-1)).squeeze(-1)
+  return torch.cat([torch.mm(s, w.t()) for s, w in zip(edge_support.split(edge_counts), edge_data)])
+
+
+AGGREGATIONS = ('sum', 'mean', 'max')
+
+def aggregate_edges(edge_msg, Etgt, num_nodes, aggr='sum'):
+  """
+    Reduces the E x f edge messages into their target nodes with a sum, mean or max.
+
+    Etgt is an E :: Long index, nodes without incoming edges get zeros. The N x E incidence
+    matrix used before the index collate is still accepted, for sums only.
+  """
+  if Etgt.dim() != 1:
+    if aggr != 'sum':
+      raise ValueError("Only the sum aggregation is supported with an incidence matrix")
+    return torch.spmm(Etgt, edge_msg)
+  if aggr not in AGGREGATIONS:
+    raise ValueError("Unknown aggregation {}, must be one of {}".format(aggr, AGGREGATIONS))
+  return scatter(edge_msg, Etgt, dim=0, dim_size=num_nodes, reduce=aggr)
+
+
 class EdgeGraphConvolution(Module):
   """
   Simple GCN layer, similar to https://arxiv.org/abs/1609.02907
   """
 
-  def __init__(self, in_features, out_features, node_layers = 1, edge_layers = 1, bias=True):
+  def __init__(self, in_features, out_features, node_layers = 1, edge_layers = 1, bias=True, aggr='sum'):
     super(EdgeGraphConvolution, self).__init__()
+    if aggr not in AGGREGATIONS:
+      raise ValueError("Unknown aggregation {}, must be one of {}".format(aggr, AGGREGATIONS))
     self.in_features = in_features
     self.out_features = out_features
+    self.aggr = aggr
     self.weight = Parameter(torch.FloatTensor(in_features, out_features))
     if bias:
       self.bias = Parameter(torch.FloatTensor(out_features))
@@ -136,13 +213,25 @@ class EdgeGraphConvolution(Module):
   def forward(self,
       input,   # N x fi :: Float
       Esrc,  # E :: Long
-      Etgt,  # N x E :: Float
-      edge_data, # E x fo x fo :: Float
+      Etgt,  # E :: Long
+      edge_data, # E x fo x fo :: Float, or K x fo x fo with edge_counts, or low rank factors, see edge_messages
+      edge_counts=None, # K :: Int, see group_edge_types
       ):
     support = torch.mm(input, self.weight) # N x fo
     edge_support = torch.index_select( support, 0, Esrc ) # E x fo
-    edge_msg = torch.bmm( edge_data, edge_support.unsqueeze(-1) ).squeeze(-1) # E x fo
-    output = torch.spmm( Etgt, edge_msg ) # N x fo
+    edge_msg = edge_messages( edge_data, edge_support, edge_counts ) # E x fo
+    output = aggregate_edges( edge_msg, Etgt, input.size(0), self.aggr ) # N x fo
+    if self.bias is not None:
+      return output + self.bias
+    else:
+      return output
+
+  def forward_dense(self,
+      input,   # B x Nmax x fi :: Float
+      edges,   # dense.DenseEdges, see dense.to_dense_edges
+      ):
+    support = torch.matmul(input, self.weight) # B x Nmax x fo
+    output = dense_messages( edges, support ) # B x Nmax x fo
     if self.bias is not None:
       return output + self.bias
     else:
@@ -20,7 +20,7 @@ class MPNN_ENN_Sum(nn.Module):
       node_features,   # N x fn :: Float
       edge_features,   # E x fe :: Float
       Esrc,  # E :: Long
-      Etgt,  # N x E :: Float
+      Etgt,  # E :: Long
       batch,   # B x N :: Float
       ):
     batch_size = batch.max().item() + 1
@@ -49,7 +49,7 @@ class MPNN_ENN_Set2Set(nn.Module):
       node_features,   # N x fn :: Float
       edge_features,   # E x fe :: Float
       Esrc,  # E :: Long
-      Etgt,  # N x E :: Float
+      Etgt,  # E :: Long
       batch,   # B x N :: Float
       ):
     batch_size = batch.max().item() + 1
@@ -83,7 +83,7 @@ class EdgeGCN3_Sum(nn.Module):
       node_features,   # N x fn :: Float
       edge_features,   # E x fe :: Float
       Esrc,  # E :: Long
-      Etgt,  # N x E :: Float
+      Etgt,  # E :: Long
       batch,   # B x N :: Float
       ):
     batch_size = batch.max().item() + 1
@@ -121,7 +121,7 @@ class EdgeGCN3_Set2Set(nn.Module):
       node_features,   # N x fn :: Float
       edge_features,   # E x fe :: Float
       Esrc,  # E :: Long
-      Etgt,  # N x E :: Float
+      Etgt,  # E :: Long
       batch,   # B x N :: Float
       ):
     x = node_features
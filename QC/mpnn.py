@@ -1,13 +1,18 @@
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from layers import aggregate_edges, edge_messages, AGGREGATIONS
+from dense import dense_messages
 
 class MPNN_enn_edge(nn.Module):
-  def __init__(self, edge_data_dim, node_data_hidden_dim=200):
+  def __init__(self, edge_data_dim, node_data_hidden_dim=200, aggr='sum'):
     super(MPNN_enn_edge, self).__init__()
+    if aggr not in AGGREGATIONS:
+      raise ValueError("Unknown aggregation {}, must be one of {}".format(aggr, AGGREGATIONS))
     
     self.e_d = edge_data_dim
     self.h_d = node_data_hidden_dim
+    self.aggr = aggr
     
     self.update_net = nn.GRUCell( self.h_d*2, self.h_d )
     self.T = 8
@@ -19,18 +24,30 @@ class MPNN_enn_edge(nn.Module):
   def forward(self,
       x,   # N x h :: Float
       Esrc,  # E :: Long
-      Etgt,  # N x E :: Float
-      edge_data, # E x h x h :: Float
+      Etgt,  # E :: Long
+      edge_data, # E x h x h :: Float, or K x h x h with edge_counts, or low rank factors, see layers.edge_messages
+      edge_counts=None, # K :: Int, see layers.group_edge_types
       ):
     #GRU_h = torch.zeros_like( x, device=x.device )
     for t in range(self.T):
       edge_support = torch.index_select( x, 0, Esrc ) # E x h
-      edge_msg = torch.bmm( edge_data, edge_support.unsqueeze(-1) ).squeeze() # E x h
-      node_msg = torch.spmm( Etgt, edge_msg ) # N x h
+      edge_msg = edge_messages( edge_data, edge_support, edge_counts ) # E x h
+      node_msg = aggregate_edges( edge_msg, Etgt, x.size(0), self.aggr ) # N x h
       x = self.update_net(torch.cat([x, node_msg], 1), x)
     #end for
     return x
 
+  def forward_dense(self,
+      x,   # B x Nmax x h :: Float
+      edges,   # dense.DenseEdges, see dense.to_dense_edges
+      ):
+    B, N, h = x.size()
+    for t in range(self.T):
+      node_msg = dense_messages( edges, x ) # B x Nmax x h
+      x = self.update_net(torch.cat([x, node_msg], 2).view(B*N, 2*h), x.view(B*N, h)).view(B, N, h)
+    #end for
+    return x
+
 class MPNN_enn(nn.Module):
   def __init__(self, edge_data_dim, edge_net_hidden_dim, node_data_hidden_dim=200):
     super(MPNN_enn, self).__init__()
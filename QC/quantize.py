@@ -0,0 +1,81 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+  quantize.py: Post-training dynamic int8 quantization of the QC models, for inference.
+
+  Most of the inference cost of the models is in dense layers: the TransitionMLPs reading the
+  node features in and the targets out, the EdgeEncoderMLP writing a hidden x hidden matrix for
+  every edge, the nn.Linear heads of the ENN models, the GRUCell update of MPNN_enn_edge and the
+  LSTM of Set2Set. Dynamic quantization stores the weights of these as int8 and quantizes their
+  inputs on the fly, batch by batch, so no calibration data is needed.
+
+  The MyLinear layers of layers.MLP keep their weight transposed and multiply with torch.mm, which
+  torch's quantization does not know of; they are swapped for the equivalent nn.Linear first. The
+  message passing itself, the per-edge matrices applied to the node states and the aggregations,
+  stays in float32, as do the weights of EdgeGraphConvolution.
+
+  Quantized models only run forward, see benchmark_quantize.py for what they cost in accuracy.
+
+  Usage:
+    model.load_state_dict(checkpoint['state_dict'])
+    qmodel = quantize_dynamic(model)
+    with torch.inference_mode():
+      output = qmodel(node_features=x, edge_features=e_d, Esrc=e_src, Etgt=e_tgt, batch=b)
+
+"""
+
+import copy
+import io
+import warnings
+
+import torch
+import torch.nn as nn
+
+from layers import MyLinear
+
+__author__ = "Pedro HC Avelar"
+__email__ = "phcavelar@inf.ufrgs.br"
+
+# Modules with a dynamic quantized counterpart
+QUANTIZABLE = {nn.Linear, nn.GRUCell, nn.LSTM}
+
+
+def linear_of(module):
+  """nn.Linear computing the same as the MyLinear module, which keeps its weight as in_features x out_features"""
+  in_features, out_features = module.weight.size()
+  linear = nn.Linear(in_features, out_features, bias=module.bias is not None)
+  with torch.no_grad():
+    linear.weight.copy_(module.weight.t())
+    if module.bias is not None:
+      linear.bias.copy_(module.bias)
+  #end with
+  return linear
+
+
+def swap_linears(model):
+  """Replaces every MyLinear in model by its nn.Linear, in place"""
+  for name, child in model.named_children():
+    if isinstance(child, MyLinear):
+      setattr(model, name, linear_of(child))
+    else:
+      swap_linears(child)
+  #end for
+  return model
+
+
+def quantize_dynamic(model, dtype=torch.qint8, modules=QUANTIZABLE):
+  """Quantized copy of model, for inference on the CPU, with the weights of its modules of the given types in dtype"""
+  model = swap_linears(copy.deepcopy(model).cpu().eval())
+  with warnings.catch_warnings():
+    # torch.ao.quantization is deprecated in favour of torchao, which is not a dependency here
+    warnings.simplefilter('ignore')
+    return torch.ao.quantization.quantize_dynamic(model, modules, dtype=dtype, inplace=True)
+  #end with
+
+
+def model_size(model):
+  """Bytes of the serialized state dict of model"""
+  buffer = io.BytesIO()
+  torch.save(model.state_dict(), buffer)
+  return buffer.tell()
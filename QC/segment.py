@@ -0,0 +1,152 @@
+"""
+  segment.py: Vectorized segment reductions.
+
+  The scatter_* functions reduce the slices of src along dim that share a value of index, in any
+  order, into dim_size output slices. index is either a vector over dim or has the shape of src.
+  The segment_*_csr functions reduce a src sorted by segment, described by the G+1 offsets of ptr
+  (segment i is src[ptr[i]:ptr[i+1]] along dim), e.g. the nodes of a collated batch. On CPU it is
+  the faster path for max and min, the scatter sums are as fast or faster (see benchmark_segment.py).
+
+  Empty segments reduce to zeros, and to -1 in scatter_argmax. All reductions support autograd,
+  the gradient of max and min is shared between tied maxima (minima).
+
+  Usage:
+    out = scatter(src, index, dim=0, dim_size=num_graphs, reduce='mean')
+    out = segment_csr(src, index_to_ptr(index, num_graphs), reduce='mean')
+
+"""
+
+import torch
+
+__author__ = "Pedro HC Avelar"
+__email__ = "phcavelar@inf.ufrgs.br"
+
+REDUCTIONS = ('sum', 'mean', 'max', 'min')
+
+
+def _dim_size(index, dim_size=None):
+  if dim_size is not None:
+    return dim_size
+  return int(index.max()) + 1 if index.numel() > 0 else 0
+
+
+def _broadcast(index, src, dim):
+  """View a vector index over dim so that it broadcasts against src"""
+  size = [1] * src.dim()
+  size[dim] = -1
+  return index.view(size)
+
+
+def _out_size(src, dim, dim_size):
+  size = list(src.size())
+  size[dim] = dim_size
+  return size
+
+
+def scatter_add(src, index, dim=0, dim_size=None):
+  dim = range(src.dim())[dim]
+  out = src.new_zeros(_out_size(src, dim, _dim_size(index, dim_size)))
+  if index.dim() == 1:
+    return out.index_add_(dim, index, src)
+  return out.scatter_add_(dim, index, src)
+
+
+def scatter_count(index, dim_size=None):
+  """Number of elements of each segment of a vector index"""
+  return torch.bincount(index, minlength=_dim_size(index, dim_size))
+
+
+def scatter_mean(src, index, dim=0, dim_size=None):
+  dim = range(src.dim())[dim]
+  dim_size = _dim_size(index, dim_size)
+  if index.dim() == 1:
+    count = _broadcast(scatter_count(index, dim_size), src, dim)
+  else:
+    count = scatter_add(torch.ones_like(src), index, dim, dim_size)
+  return scatter_add(src, index, dim, dim_size) / count.clamp(min=1).to(src.dtype)
+
+
+def _scatter_reduce(src, index, dim, dim_size, reduce):
+  dim = range(src.dim())[dim]
+  if index.dim() == 1:
+    index = _broadcast(index, src, dim).expand_as(src)
+  out = src.new_zeros(_out_size(src, dim, _dim_size(index, dim_size)))
+  # Without include_self the zeros only remain in the empty segments
+  return out.scatter_reduce(dim, index, src, reduce=reduce, include_self=False)
+
+
+def scatter_max(src, index, dim=0, dim_size=None):
+  return _scatter_reduce(src, index, dim, dim_size, 'amax')
+
+
+def scatter_min(src, index, dim=0, dim_size=None):
+  return _scatter_reduce(src, index, dim, dim_size, 'amin')
+
+
+def scatter_argmax(src, index, dim=0, dim_size=None, out=None):
+  """
+    Position along dim of the first maximum of each segment, -1 for empty segments.
+
+    If the maxima out are given, positions are only reported where src reaches them.
+  """
+  dim = range(src.dim())[dim]
+  src = src.detach()
+  if index.dim() == 1:
+    index = _broadcast(index, src, dim).expand_as(src)
+  if out is None:
+    out = scatter_max(src, index, dim, dim_size)
+  n = src.size(dim)
+  position = _broadcast(torch.arange(n, device=src.device), src, dim).expand_as(src)
+  candidate = torch.where(src == out.detach().gather(dim, index), position, torch.full_like(position, n))
+  arg = torch.full(out.size(), n, dtype=torch.long, device=src.device).scatter_reduce_(dim, index, candidate, reduce='amin')
+  return arg.masked_fill_(arg == n, -1)
+
+
+def scatter_softmax(src, index, dim=0, dim_size=None):
+  """Softmax over the elements of each segment"""
+  dim = range(src.dim())[dim]
+  dim_size = _dim_size(index, dim_size)
+  gather_index = _broadcast(index, src, dim).expand_as(src) if index.dim() == 1 else index
+  # The max only keeps exp() in range, its gradient cancels out of the softmax
+  out = (src - scatter_max(src.detach(), gather_index, dim, dim_size).gather(dim, gather_index)).exp()
+  return out / scatter_add(out, gather_index, dim, dim_size).gather(dim, gather_index)
+
+
+_scatter_functions = {
+    'sum': scatter_add,
+    'mean': scatter_mean,
+    'max': scatter_max,
+    'min': scatter_min,
+}
+
+def scatter(src, index, dim=0, dim_size=None, reduce='sum'):
+  if reduce not in _scatter_functions:
+    raise ValueError("Unknown reduction {}, must be one of {}".format(reduce, REDUCTIONS))
+  return _scatter_functions[reduce](src, index, dim, dim_size)
+
+
+def index_to_ptr(index, dim_size=None):
+  """G+1 segment offsets of a sorted vector index"""
+  ptr = index.new_zeros(_dim_size(index, dim_size) + 1)
+  ptr[1:] = torch.cumsum(scatter_count(index, dim_size), 0)
+  return ptr
+
+
+def segment_csr(src, ptr, dim=0, reduce='sum'):
+  """Reduces the sorted segments src[ptr[i]:ptr[i+1]] along dim"""
+  if reduce not in REDUCTIONS:
+    raise ValueError("Unknown reduction {}, must be one of {}".format(reduce, REDUCTIONS))
+  dim = range(src.dim())[dim]
+  out = torch.segment_reduce(src, reduce, offsets=ptr, axis=dim, unsafe=True)
+  if reduce != 'sum':
+    # Empty segments come out as nan or +-inf
+    out = out.masked_fill(_broadcast(ptr[1:] == ptr[:-1], out, dim), 0)
+  return out
+
+
+def segment_softmax_csr(src, ptr, dim=0):
+  """Softmax over the elements of each sorted segment src[ptr[i]:ptr[i+1]] along dim"""
+  dim = range(src.dim())[dim]
+  counts = ptr[1:] - ptr[:-1]
+  out = (src - segment_csr(src.detach(), ptr, dim, 'max').repeat_interleave(counts, dim)).exp()
+  return out / segment_csr(out, ptr, dim, 'sum').repeat_interleave(counts, dim)
@@ -3,7 +3,7 @@
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-from torch_scatter import scatter_add
+from segment import scatter_add
 from torch_geometric_utils import softmax
 
 class Set2Set(nn.Module):
@@ -56,23 +56,34 @@ class Set2Set(nn.Module):
        x.new_zeros((self.num_layers, batch_size, self.in_channels)))
     q_star = x.new_zeros(batch_size, self.out_channels)
     
-    one_t = torch.ones_like( batch , dtype=batch.dtype, device=batch.device)
     for i in range(self.processing_steps):
       q, h = self.lstm(q_star.unsqueeze(0), h)
       q = q.view(batch_size, self.in_channels)
       e = (x * q[batch]).sum(dim=-1, keepdim=True)
-      # Softmax
-      a = torch.zeros( [x.size()[0]], dtype=x.dtype, device=x.device )
-      for i in range(batch_size):
-        mask = batch.eq(one_t*i)
-        elements_to_softmax = torch.masked_select( e.squeeze(-1), mask )
-        softmaxed_elements = F.softmax(elements_to_softmax, dim=0 )
-        a[mask] += softmaxed_elements
-      #end for
-      a = a.unsqueeze(1)
+      a = softmax(e, batch, num_nodes=batch_size)
       r = scatter_add(a * x, batch, dim=0, dim_size=batch_size)
       q_star = torch.cat([q, r], dim=-1)
-     #end for
+    #end for
+
+    return q_star
+
+  def forward_dense(self, x, mask):
+    """Same as forward, for the B x Nmax x f padded x with the B x Nmax mask of its nodes"""
+    batch_size = x.size(0)
+
+    h = (x.new_zeros((self.num_layers, batch_size, self.in_channels)),
+       x.new_zeros((self.num_layers, batch_size, self.in_channels)))
+    q_star = x.new_zeros(batch_size, self.out_channels)
+
+    for i in range(self.processing_steps):
+      q, h = self.lstm(q_star.unsqueeze(0), h)
+      q = q.view(batch_size, self.in_channels)
+      e = torch.bmm(x, q.unsqueeze(-1)).squeeze(-1).masked_fill(~mask, float('-inf'))
+      # Graphs without nodes get all -inf, and NaN weights
+      a = torch.softmax(e, dim=1).masked_fill(~mask, 0)
+      r = torch.bmm(a.unsqueeze(1), x).squeeze(1)
+      q_star = torch.cat([q, r], dim=-1)
+    #end for
 
     return q_star
 
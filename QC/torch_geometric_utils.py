@@ -1,6 +1,6 @@
 # Adapted from https://github.com/rusty1s/pytorch_geometric
 
-from torch_scatter import scatter_max, scatter_add
+from segment import scatter_softmax
 
 def maybe_num_nodes(index, num_nodes=None):
   return index.max().item() + 1 if num_nodes is None else num_nodes
@@ -21,10 +21,4 @@ def softmax(src, index, num_nodes=None):
   """
 
   num_nodes = maybe_num_nodes(index, num_nodes)
-
-  out = src - scatter_max(src, index, dim=0, dim_size=num_nodes)[0][index]
-  out = out.exp()
-  out = out / (
-    scatter_add(out, index, dim=0, dim_size=num_nodes)[index] + 1e-16)
-
-  return out
+  return scatter_softmax(src, index, dim=0, dim_size=num_nodes)
@@ -21,8 +21,10 @@ import torch.optim as optim
 
 # Our Modules
 import layer_models as models
-from LogMetric import Logger
-from util import restricted_float, count_params, train, validate, read_dataset, get_metric_by_task_type, save_checkpoint
+from LogMetric import Logger, NullLogger
+from util import restricted_float, count_params, train, validate, read_dataset, get_metric_by_task_type
+from checkpoint import CheckpointWriter
+import distributed
 
 __author__ = "Pedro H.C. Avelar, Pau Riba, Anjan Dutta"
 __email__ = "phcavelar@inf.ufrgs.br, priba@cvc.uab.cat, adutta@cvc.uab.cat"
@@ -33,11 +35,18 @@ parser = argparse.ArgumentParser(description='Neural message passing')
 parser.add_argument('--dataset', default='qm9', help='dataset name, can be any of "qm9", "mutag", "enzymes" or a custom one')
 parser.add_argument('--dataset-type', choices=["classification", "regression"], help='dataset name')
 parser.add_argument('--dataset-path', help='custom dataset path')
+parser.add_argument('--cache-path', help='preprocessed dataset store, used instead of parsing the dataset files if it exists')
+parser.add_argument('--split', default='default',
+          help='name of the train/valid/test split manifest kept with the dataset, created on first use (default: default)')
 parser.add_argument('--log_path', default='./log/{model}-{layers}/{dataset}/all', help='log path')
 parser.add_argument('--plotLr', default=False, help='allow plotting the data')
 parser.add_argument('--plot_path', default='./plot/{model}-{layers}/{dataset}/all', help='plot path')
 parser.add_argument('--resume', default='./checkpoint/{model}-{layers}/{dataset}/all',
           help='path to latest checkpoint')
+parser.add_argument('--keep-last', type=int, default=1, metavar='K',
+          help='Number of most recent epoch checkpoints to keep (default: 1)')
+parser.add_argument('--keep-best', type=int, default=1, metavar='K',
+          help='Number of best epoch checkpoints to keep (default: 1)')
 # Optimization Options
 parser.add_argument('--model', choices=["egcnsum", "egcns2s", "ennsum", "enns2s", "eressum", "eress2s", "eodesum", "eodes2s"], default="egcnsum",
           help='Which model to train')
@@ -45,8 +54,28 @@ parser.add_argument('--hidden', type=int, default=73, metavar='H',
           help='Number of hidden units in hidden layers(default: 73)')
 parser.add_argument('--batch-size', type=int, default=20, metavar='B',
           help='Input batch size for training (default: 20)')
+parser.add_argument('--bucket', action='store_true', default=False,
+          help='Batch molecules of similar size together (needs a preprocessed store)')
+parser.add_argument('--node-budget', type=int, default=None, metavar='N',
+          help='Fill each batch up to N atoms instead of --batch-size molecules, implies --bucket')
+parser.add_argument('--edge-budget', type=int, default=None, metavar='E',
+          help='Fill each batch up to E directed edges instead of --batch-size molecules, implies --bucket')
 parser.add_argument('--layers', type=int, default=3, metavar='L',
           help='Number of layers/message-passing iterations (default: 3)')
+parser.add_argument('--aggr', choices=["sum", "mean", "max"], default="sum",
+          help='How messages are aggregated into each node (default: sum)')
+parser.add_argument('--discrete-edges', action='store_true', default=False,
+          help='Encode each distinct edge feature once and group messages by edge type, for chem_graph or distance_bin stores')
+parser.add_argument('--rank', type=int, default=None, metavar='R',
+          help='Rank of the factorized edge matrices, full rank if not given')
+parser.add_argument('--dense', choices=["never", "auto", "always"], default="auto",
+          help='Run on padded dense batches instead of concatenated ones; auto decides per batch, from the graph sizes and density (default: auto)')
+parser.add_argument('--ode-solver', choices=models.ODE_SOLVERS, default="dopri5",
+          help='ODE solver of the eode models, rk4, midpoint and euler take --layers steps (default: dopri5)')
+parser.add_argument('--ode-gradient', choices=models.ODE_GRADIENTS, default="adjoint",
+          help='Backpropagate through the ODE solver steps, or solve the adjoint ODE with memory constant in the number of steps (default: adjoint)')
+parser.add_argument('--ode-tol', type=float, default=1e-3, metavar='TOL',
+          help='Relative and absolute tolerance of the adaptive ODE solvers (default: 1e-3)')
 parser.add_argument('--s2s', type=int, default=4, metavar='S',
           help='Number of Set2Set iterations (default: 4)')
 parser.add_argument('--no-cuda', action='store_true', default=False,
@@ -68,8 +97,14 @@ parser.add_argument('--log-interval', type=int, default=20, metavar='N',
           help='How many batches to wait before logging training status')
 # Accelerating
 parser.add_argument('--prefetch', type=int, default=8, help='Pre-fetching threads.')
+parser.add_argument('--prefetch-mode', choices=['thread', 'process'], default='process',
+          help='Collate batches in --prefetch worker processes, or in as many threads over the shared store arrays (default: process)')
+parser.add_argument('--prefetch-batches', type=int, default=2, metavar='N',
+          help='Batches kept prefetched in thread mode (default: 2)')
+parser.add_argument('--world-size', type=int, default=1, metavar='N',
+          help='Train data-parallel in N local processes, over gloo, each on 1/N of the batches (default: 1)')
 
-best_er1 = 0
+best_er1 = None
 
 dataset_paths = {
     "qm9": "./data/qm9/dsgdb9nsd/",
@@ -77,6 +112,10 @@ dataset_paths = {
     "enzymes": "./data/enzymes/",
 }
 
+dataset_cache_paths = {
+    "qm9": "./data/qm9/cache/raw_distance/",
+}
+
 dataset_types = {
     "qm9": "regression",
     "mutag": "classification",
@@ -90,20 +129,25 @@ model_dict = {
     "enns2s": models.MPNN_ENN_K_Set2Set,
     "eressum": models.UnimplementedModel,
     "eress2s": models.EdgeRES1_K_Set2Set,
-    "eodesum": models.UnimplementedModel,
-    "eodes2s": models.UnimplementedModel,
+    "eodesum": models.EdgeODE_K_Sum,
+    "eodes2s": models.EdgeODE_K_Set2Set,
 }
 
 def main():
 
   global args, best_er1
   args = parser.parse_args()
+  if args.world_size > 1 and not distributed.is_distributed():
+    distributed.launch(main, args.world_size)
+    return
+  #end if
 
   # Check if CUDA is enabled
   args.cuda = not args.no_cuda and torch.cuda.is_available()
 
   # Load data
   root = args.dataset_path if args.dataset_path else dataset_paths[args.dataset]
+  cache = args.cache_path if args.cache_path else dataset_cache_paths.get(args.dataset)
   task_type = args.dataset_type if args.dataset_type else dataset_types[args.dataset]
   if args.resume:
     resume_dir = args.resume.format(dataset=args.dataset,model=args.model,layers=args.layers)
@@ -111,11 +155,15 @@ def main():
   Model_Class = model_dict[args.model]
   
   print("Preparing dataset")
-  node_features, edge_features, target_features, task_type, train_loader, valid_loader, test_loader = read_dataset(args.dataset,root,args.batch_size,args.prefetch)
+  node_features, edge_features, target_features, task_type, train_loader, valid_loader, test_loader = read_dataset(args.dataset,root,args.batch_size,args.prefetch,cache=cache,
+      bucket=args.bucket,node_budget=args.node_budget,edge_budget=args.edge_budget,split=args.split,
+      prefetch_mode=args.prefetch_mode,prefetch_batches=args.prefetch_batches)
 
   print('\tCreate model')
   hidden_state_size = args.hidden
-  model = Model_Class(node_features=node_features, edge_features=edge_features, target_features=target_features, hidden_features=hidden_state_size, num_layers=args.layers, dropout=0.5, type=task_type, s2s_processing_steps=args.s2s)
+  # Kept in the checkpoints, so that infer.py can rebuild the model
+  model_kwargs = dict(node_features=node_features, edge_features=edge_features, target_features=target_features, hidden_features=hidden_state_size, num_layers=args.layers, dropout=0.5, type=task_type, s2s_processing_steps=args.s2s, aggr=args.aggr, discrete_edges=args.discrete_edges, rank=args.rank, dense=args.dense, ode_solver=args.ode_solver, ode_gradient=args.ode_gradient, ode_tol=args.ode_tol)
+  model = Model_Class(**model_kwargs)
   print("#Parameters: {param_count}".format(param_count=count_params(model)))
 
   print('Optimizer')
@@ -124,7 +172,7 @@ def main():
   criterion, evaluation, metric_name, metric_compare, metric_best = get_metric_by_task_type(task_type,target_features)
 
   print('Logger')
-  logger = Logger(args.log_path.format(dataset=args.dataset,model=args.model,layers=args.layers))
+  logger = Logger(args.log_path.format(dataset=args.dataset,model=args.model,layers=args.layers)) if distributed.is_main() else NullLogger()
 
   lr_step = (args.lr-args.lr*args.lr_decay)/(args.epochs*args.schedule[1] - args.epochs*args.schedule[0])
 
@@ -133,7 +181,7 @@ def main():
     checkpoint_dir = resume_dir
     best_model_file = os.path.join(checkpoint_dir, 'model_best.pth')
     if not os.path.isdir(checkpoint_dir):
-      os.makedirs(checkpoint_dir)
+      os.makedirs(checkpoint_dir, exist_ok=True)
     if os.path.isfile(best_model_file):
       print("=> loading best model '{}'".format(best_model_file))
       checkpoint = torch.load(best_model_file)
@@ -146,12 +194,18 @@ def main():
       print("=> loaded best model '{}' (epoch {})".format(best_model_file, checkpoint['epoch']))
     else:
       print("=> no best model found at '{}'".format(best_model_file))
+    if distributed.is_main():
+      checkpoints = CheckpointWriter(resume_dir, keep_last=args.keep_last, keep_best=args.keep_best, compare=metric_compare)
+  #end if
 
   print('Check cuda')
   if args.cuda:
     print('\t* Cuda')
     model = model.cuda()
     criterion = criterion.cuda()
+  # Averages the gradients of the ranks of a distributed job, net is the model itself
+  net = model
+  model = distributed.wrap(model)
 
   # Epoch for loop
   for epoch in range(0, args.epochs):
@@ -166,12 +220,14 @@ def main():
       train(train_loader, model, criterion, optimizer, epoch, evaluation, logger, metric_name=metric_name, cuda=args.cuda, log_interval=args.log_interval)
 
       # evaluate on test set
-      er1 = validate(valid_loader, model, criterion, evaluation, logger, metric_name=metric_name, cuda=args.cuda, log_interval=args.log_interval)
+      er1 = validate(valid_loader, net, criterion, evaluation, logger, metric_name=metric_name, cuda=args.cuda, log_interval=args.log_interval)
 
-      is_best = metric_compare( er1, best_er1 )
-      best_er1 = metric_best(er1, best_er1)
-      save_checkpoint({'epoch': epoch + 1, 'state_dict': model.state_dict(), 'best_er1': best_er1,
-                   'optimizer': optimizer.state_dict(), }, is_best=is_best, directory=resume_dir)
+      is_best = best_er1 is None or metric_compare( er1, best_er1 )
+      best_er1 = er1 if best_er1 is None else metric_best(er1, best_er1)
+      if args.resume and distributed.is_main():
+        checkpoints.save({'epoch': epoch + 1, 'state_dict': net.state_dict(), 'best_er1': best_er1,
+                     'optimizer': optimizer.state_dict(), 'model': args.model, 'model_kwargs': model_kwargs,
+                     'cache_path': cache, }, is_best=is_best, metric=er1)
 
       # Logger step
       logger.log_value('learning_rate', args.lr).step()
@@ -182,6 +238,9 @@ def main():
 
   # get the best checkpoint and test it with test set
   if args.resume:
+    if distributed.is_main():
+      checkpoints.close()
+    distributed.barrier()
     checkpoint_dir = resume_dir
     best_model_file = os.path.join(checkpoint_dir, 'model_best.pth')
     if not os.path.isdir(checkpoint_dir):
@@ -191,9 +250,9 @@ def main():
       checkpoint = torch.load(best_model_file)
       args.start_epoch = checkpoint['epoch']
       best_acc1 = checkpoint['best_er1']
-      model.load_state_dict(checkpoint['state_dict'])
+      net.load_state_dict(checkpoint['state_dict'])
       if args.cuda:
-        model.cuda()
+        net.cuda()
       optimizer.load_state_dict(checkpoint['optimizer'])
       print("=> loaded best model '{}' (epoch {})".format(best_model_file, checkpoint['epoch']))
     else:
@@ -202,7 +261,7 @@ def main():
   #end if
 
   # (For testing)
-  validate(test_loader, model, criterion, evaluation, metric_name=metric_name, cuda=args.cuda, log_interval=args.log_interval)
+  validate(test_loader, net, criterion, evaluation, metric_name=metric_name, cuda=args.cuda, log_interval=args.log_interval)
 #end main
 
 
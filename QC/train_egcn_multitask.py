@@ -27,7 +27,9 @@ import numpy as np
 import datasets
 from datasets import utils
 import models
-from LogMetric import AverageMeter, Logger
+from LogMetric import AverageMeter, Logger, NullLogger
+from checkpoint import CheckpointWriter
+import distributed
 
 __author__ = "Pedro H.C. Avelar, Pau Riba, Anjan Dutta"
 __email__ = "phcavelar@inf.ufrgs.br, priba@cvc.uab.cat, adutta@cvc.uab.cat"
@@ -51,6 +53,10 @@ parser.add_argument('--plotLr', default=False, help='allow plotting the data')
 parser.add_argument('--plot_path', default='./plot/{model}/{dataset}/', help='plot path')
 parser.add_argument('--resume', default='./checkpoint/{model}/{dataset}/',
           help='path to latest checkpoint')
+parser.add_argument('--keep-last', type=int, default=1, metavar='K',
+          help='Number of most recent epoch checkpoints to keep (default: 1)')
+parser.add_argument('--keep-best', type=int, default=1, metavar='K',
+          help='Number of best epoch checkpoints to keep (default: 1)')
 # Optimization Options
 parser.add_argument('--model', choices=["egcn3sum", "egcn3s2s", "ennsum", "enns2s", "eres3sum", "eres3s2s", "eode3sum", "eode3s2s"], default="egc3",
           help='Which model to train')
@@ -75,8 +81,10 @@ parser.add_argument('--log-interval', type=int, default=20, metavar='N',
           help='How many batches to wait before logging training status')
 # Accelerating
 parser.add_argument('--prefetch', type=int, default=8, help='Pre-fetching threads.')
+parser.add_argument('--world-size', type=int, default=1, metavar='N',
+          help='Train data-parallel in N local processes, over gloo, each on 1/N of the batches (default: 1)')
 
-best_er1 = 0
+best_er1 = float('inf')
 
 dataset_paths = {
     "qm9": "./data/qm9/dsgdb9nsd/",
@@ -112,6 +120,11 @@ def main():
 
   global args, best_er1
   args = parser.parse_args()
+  if args.world_size > 1 and not distributed.is_distributed():
+    # The ranks share the numpy seed, and with it the split below
+    distributed.launch(main, args.world_size)
+    return
+  #end if
 
   # Check if CUDA is enabled
   args.cuda = not args.no_cuda and torch.cuda.is_available()
@@ -170,18 +183,28 @@ def main():
                                        stat_dict['target_std']))
 
   # Data Loader
-  train_loader = torch.utils.data.DataLoader(data_train,
-                         batch_size=args.batch_size, shuffle=True,
-                         collate_fn=datasets.utils.collate_g_concat_edge_data,
-                         num_workers=args.prefetch, pin_memory=True)
-  valid_loader = torch.utils.data.DataLoader(data_valid,
-                         batch_size=args.batch_size, shuffle=False,
-                         collate_fn=datasets.utils.collate_g_concat_edge_data,
-                         num_workers=args.prefetch, pin_memory=True)
-  test_loader = torch.utils.data.DataLoader(data_test,
-                        batch_size=args.batch_size, shuffle=False,
-                        collate_fn=datasets.utils.collate_g_concat_edge_data,
-                        num_workers=args.prefetch, pin_memory=True)
+  if distributed.is_distributed():
+    # Each rank loads its share of the batches
+    seed = np.random.randint(2**31)
+    train_loader, valid_loader, test_loader = (
+        torch.utils.data.DataLoader(data, batch_sampler=distributed.shard_batches(data, args.batch_size, shuffle, seed),
+                                    collate_fn=datasets.utils.collate_g_concat_edge_data,
+                                    num_workers=args.prefetch, pin_memory=True)
+        for data, shuffle in ((data_train, True), (data_valid, False), (data_test, False)))
+  else:
+    train_loader = torch.utils.data.DataLoader(data_train,
+                           batch_size=args.batch_size, shuffle=True,
+                           collate_fn=datasets.utils.collate_g_concat_edge_data,
+                           num_workers=args.prefetch, pin_memory=True)
+    valid_loader = torch.utils.data.DataLoader(data_valid,
+                           batch_size=args.batch_size, shuffle=False,
+                           collate_fn=datasets.utils.collate_g_concat_edge_data,
+                           num_workers=args.prefetch, pin_memory=True)
+    test_loader = torch.utils.data.DataLoader(data_test,
+                          batch_size=args.batch_size, shuffle=False,
+                          collate_fn=datasets.utils.collate_g_concat_edge_data,
+                          num_workers=args.prefetch, pin_memory=True)
+  #end if
 
   print('Optimizer')
   optimizer = optim.Adam(model.parameters(), lr=args.lr)#, weight_decay=args.weight_decay)
@@ -191,16 +214,19 @@ def main():
   evaluation = lambda output, target: torch.mean(torch.abs(output - target) / torch.abs(target))
 
   print('Logger')
-  logger = Logger(args.log_path.format(dataset=args.dataset,model=args.model))
+  logger = Logger(args.log_path.format(dataset=args.dataset,model=args.model)) if distributed.is_main() else NullLogger()
 
   lr_step = (args.lr-args.lr*args.lr_decay)/(args.epochs*args.schedule[1] - args.epochs*args.schedule[0])
 
+  # The error ratio is better the lower it is
+  metric_compare = lambda x, y: x < y
+
   # get the best checkpoint if available without training
   if args.resume:
     checkpoint_dir = resume_dir
     best_model_file = os.path.join(checkpoint_dir, 'model_best.pth')
     if not os.path.isdir(checkpoint_dir):
-      os.makedirs(checkpoint_dir)
+      os.makedirs(checkpoint_dir, exist_ok=True)
     if os.path.isfile(best_model_file):
       print("=> loading best model '{}'".format(best_model_file))
       checkpoint = torch.load(best_model_file)
@@ -213,12 +239,18 @@ def main():
       print("=> loaded best model '{}' (epoch {})".format(best_model_file, checkpoint['epoch']))
     else:
       print("=> no best model found at '{}'".format(best_model_file))
+    if distributed.is_main():
+      checkpoints = CheckpointWriter(resume_dir, keep_last=args.keep_last, keep_best=args.keep_best, compare=metric_compare)
+  #end if
 
   print('Check cuda')
   if args.cuda:
     print('\t* Cuda')
     model = model.cuda()
     criterion = criterion.cuda()
+  # Averages the gradients of the ranks of a distributed job, net is the model itself
+  net = model
+  model = distributed.wrap(model)
 
   # Epoch for loop
   for epoch in range(0, args.epochs):
@@ -232,18 +264,22 @@ def main():
     train(train_loader, model, criterion, optimizer, epoch, evaluation, logger)
 
     # evaluate on test set
-    er1 = validate(valid_loader, model, criterion, evaluation, logger)
+    er1 = validate(valid_loader, net, criterion, evaluation, logger)
 
-    is_best = er1 > best_er1
-    best_er1 = min(er1, best_er1)
-    utils.save_checkpoint({'epoch': epoch + 1, 'state_dict': model.state_dict(), 'best_er1': best_er1,
-                 'optimizer': optimizer.state_dict(), }, is_best=is_best, directory=resume_dir)
+    is_best = metric_compare(er1, best_er1)
+    best_er1 = er1 if is_best else best_er1
+    if args.resume and distributed.is_main():
+      checkpoints.save({'epoch': epoch + 1, 'state_dict': net.state_dict(), 'best_er1': best_er1,
+                   'optimizer': optimizer.state_dict(), }, is_best=is_best, metric=er1)
 
     # Logger step
     logger.log_value('learning_rate', args.lr).step()
 
   # get the best checkpoint and test it with test set
   if args.resume:
+    if distributed.is_main():
+      checkpoints.close()
+    distributed.barrier()
     checkpoint_dir = resume_dir
     best_model_file = os.path.join(checkpoint_dir, 'model_best.pth')
     if not os.path.isdir(checkpoint_dir):
@@ -253,16 +289,16 @@ def main():
       checkpoint = torch.load(best_model_file)
       args.start_epoch = checkpoint['epoch']
       best_acc1 = checkpoint['best_er1']
-      model.load_state_dict(checkpoint['state_dict'])
+      net.load_state_dict(checkpoint['state_dict'])
       if args.cuda:
-        model.cuda()
+        net.cuda()
       optimizer.load_state_dict(checkpoint['optimizer'])
       print("=> loaded best model '{}' (epoch {})".format(best_model_file, checkpoint['epoch']))
     else:
       print("=> no best model found at '{}'".format(best_model_file))
 
   # For testing
-  validate(test_loader, model, criterion, evaluation)
+  validate(test_loader, net, criterion, evaluation)
 
 
 def train(train_loader, model, criterion, optimizer, epoch, evaluation, logger):
@@ -275,12 +311,11 @@ def train(train_loader, model, criterion, optimizer, epoch, evaluation, logger):
   model.train()
 
   end = time.time()
-  for i, (batch_size,g,b,x,e_d,e_src,e_tgt,target) in enumerate(train_loader):
-    e_tgt = e_tgt.to_sparse()
+  for i, (batch_size,b,x,e_d,e_src,e_tgt,target) in enumerate(train_loader):
     
     if args.cuda:
-      g,b,x,e_d,e_src,e_tgt,target = map(lambda a:a.cuda(), (g,b,x,e_d,e_src,e_tgt,target))
-    #g,b,x,e_d,e_src,e_tgt,target = map(lambda a:Variable(a), (g,b,x,e_d,e_src,e_tgt,target))
+      b,x,e_d,e_src,e_tgt,target = map(lambda a:a.cuda(), (b,x,e_d,e_src,e_tgt,target))
+    #b,x,e_d,e_src,e_tgt,target = map(lambda a:Variable(a), (b,x,e_d,e_src,e_tgt,target))
 
     # Measure data loading time
     data_time.update(time.time() - end)
@@ -298,8 +333,8 @@ def train(train_loader, model, criterion, optimizer, epoch, evaluation, logger):
     train_loss = criterion(output, target)
 
     # Logs
-    losses.update(train_loss.item(), batch_size)
-    error_ratio.update(evaluation(output, target).item(), batch_size)
+    losses.update(train_loss, batch_size)
+    error_ratio.update(evaluation(output, target), batch_size)
 
     # compute gradient and do SGD step
     train_loss.backward()
@@ -319,6 +354,8 @@ def train(train_loader, model, criterion, optimizer, epoch, evaluation, logger):
           .format(epoch, i, len(train_loader), batch_time=batch_time,
               data_time=data_time, loss=losses, err=error_ratio), flush=True)
               
+  losses.all_reduce()
+  error_ratio.all_reduce()
   logger.log_value('train_epoch_loss', losses.avg)
   logger.log_value('train_epoch_error_ratio', error_ratio.avg)
 
@@ -335,12 +372,11 @@ def validate(val_loader, model, criterion, evaluation, logger=None):
   model.eval()
   with torch.no_grad():
     end = time.time()
-    for i, (batch_size,g,b,x,e_d,e_src,e_tgt,target) in enumerate(val_loader):
-      e_tgt.to_sparse()
+    for i, (batch_size,b,x,e_d,e_src,e_tgt,target) in enumerate(val_loader):
       
       if args.cuda:
-        g,b,x,e_d,e_src,e_tgt,target = map(lambda a:a.cuda(), (g,b,x,e_d,e_src,e_tgt,target))
-      #g,b,x,e_d,e_src,e_tgt,target = map(lambda a:Variable(a), (g,b,x,e_d,e_src,e_tgt,target))
+        b,x,e_d,e_src,e_tgt,target = map(lambda a:a.cuda(), (b,x,e_d,e_src,e_tgt,target))
+      #b,x,e_d,e_src,e_tgt,target = map(lambda a:Variable(a), (b,x,e_d,e_src,e_tgt,target))
       
       # Compute output
       train_loss = torch.zeros((),)
@@ -353,8 +389,8 @@ def validate(val_loader, model, criterion, evaluation, logger=None):
           )
 
       # Logs
-      losses.update(criterion(output, target).item(), batch_size)
-      error_ratio.update(evaluation(output, target).item(), batch_size)
+      losses.update(criterion(output, target), batch_size)
+      error_ratio.update(evaluation(output, target), batch_size)
 
       # measure elapsed time
       batch_time.update(time.time() - end)
@@ -372,6 +408,8 @@ def validate(val_loader, model, criterion, evaluation, logger=None):
     #end for
   #end torch.no_grad
 
+  losses.all_reduce()
+  error_ratio.all_reduce()
   print(' * Average Error Ratio {err.avg:.3f}; Average Loss {loss.avg:.3f}'
       .format(err=error_ratio, loss=losses), flush=True)
 
@@ -22,7 +22,8 @@ import torch.optim as optim
 # Our Modules
 import layer_models as models
 from LogMetric import Logger
-from util import restricted_float, count_params, train, validate, read_dataset, get_metric_by_task_type, save_checkpoint
+from checkpoint import CheckpointWriter
+from util import restricted_float, count_params, train, validate, train_targets, validate_targets, read_dataset, get_metric_by_task_type, save_checkpoint
 
 __author__ = "Pedro H.C. Avelar, Pau Riba, Anjan Dutta"
 __email__ = "phcavelar@inf.ufrgs.br, priba@cvc.uab.cat, adutta@cvc.uab.cat"
@@ -33,6 +34,9 @@ parser = argparse.ArgumentParser(description='Neural message passing')
 parser.add_argument('--dataset', choices=["qm9"], default='qm9', help='dataset name, can be any of "qm9", "mutag", "enzymes" or a custom one')
 parser.add_argument('--dataset-type', choices=["regression"], help='dataset type')
 parser.add_argument('--dataset-path', help='custom dataset path')
+parser.add_argument('--cache-path', help='preprocessed dataset store, used instead of parsing the dataset files if it exists')
+parser.add_argument('--split', default='default',
+          help='name of the train/valid/test split manifest kept with the dataset, created on first use (default: default)')
 parser.add_argument('--log_path', default='./log/{model}-{layers}/{dataset}_individual/{feature}', help='log path')
 parser.add_argument('--plotLr', default=False, help='allow plotting the data')
 parser.add_argument('--plot_path', default='./plot/{model}-{layers}/{dataset}_individual/{feature}', help='plot path')
@@ -47,6 +51,12 @@ parser.add_argument('--batch-size', type=int, default=20, metavar='B',
           help='Input batch size for training (default: 20)')
 parser.add_argument('--layers', type=int, default=3, metavar='L',
           help='Number of layers/message-passing iterations (default: 3)')
+parser.add_argument('--ode-solver', choices=models.ODE_SOLVERS, default="dopri5",
+          help='ODE solver of the eode models, rk4, midpoint and euler take --layers steps (default: dopri5)')
+parser.add_argument('--ode-gradient', choices=models.ODE_GRADIENTS, default="adjoint",
+          help='Backpropagate through the ODE solver steps, or solve the adjoint ODE with memory constant in the number of steps (default: adjoint)')
+parser.add_argument('--ode-tol', type=float, default=1e-3, metavar='TOL',
+          help='Relative and absolute tolerance of the adaptive ODE solvers (default: 1e-3)')
 parser.add_argument('--s2s', type=int, default=4, metavar='S',
           help='Number of Set2Set iterations (default: 4)')
 parser.add_argument('--no-cuda', action='store_true', default=False,
@@ -68,13 +78,19 @@ parser.add_argument('--log-interval', type=int, default=20, metavar='N',
           help='How many batches to wait before logging training status')
 # Accelerating
 parser.add_argument('--prefetch', type=int, default=8, help='Pre-fetching threads.')
+parser.add_argument('--concurrent', action='store_true', default=False,
+          help='Train the models of all targets side by side, reading and collating every batch once for all of them')
 
-best_er1 = 0
+best_er1 = None
 
 dataset_paths = {
     "qm9": "./data/qm9/dsgdb9nsd/",
 }
 
+dataset_cache_paths = {
+    "qm9": "./data/qm9/cache/raw_distance/",
+}
+
 dataset_types = {
     "qm9": "regression",
 }
@@ -90,23 +106,139 @@ model_dict = {
     "enns2s": models.MPNN_ENN_K_Set2Set,
     "eressum": models.UnimplementedModel,
     "eress2s": models.EdgeRES1_K_Set2Set,
-    "eodesum": models.UnimplementedModel,
-    "eodes2s": models.UnimplementedModel,
+    "eodesum": models.EdgeODE_K_Sum,
+    "eodes2s": models.EdgeODE_K_Set2Set,
 }
 
 
+def load_best_model(model, optimizer, checkpoint_dir, cuda=False):
+  """Loads model_best.pth from checkpoint_dir if there is one, returns its best_er1 or None"""
+  best_model_file = os.path.join(checkpoint_dir, 'model_best.pth')
+  if not os.path.isdir(checkpoint_dir):
+    os.makedirs(checkpoint_dir)
+  if os.path.isfile(best_model_file):
+    print("=> loading best model '{}'".format(best_model_file))
+    checkpoint = torch.load(best_model_file)
+    model.load_state_dict(checkpoint['state_dict'])
+    if cuda:
+      model.cuda()
+    optimizer.load_state_dict(checkpoint['optimizer'])
+    print("=> loaded best model '{}' (epoch {})".format(best_model_file, checkpoint['epoch']))
+    return checkpoint['best_er1']
+  print("=> no best model found at '{}'".format(best_model_file))
+  return None
+
+
+def main_concurrent():
+  """
+    Trains one model per target on a single pass over the data per epoch: the dataset is read
+    once and every batch is fed to all models, checkpoints and logs are kept per target.
+  """
+  targets = list(enumerate(dataset_targets[args.dataset]))
+
+  # Load data
+  root = args.dataset_path if args.dataset_path else dataset_paths[args.dataset]
+  cache = args.cache_path if args.cache_path else dataset_cache_paths.get(args.dataset)
+  task_type = args.dataset_type if args.dataset_type else dataset_types[args.dataset]
+  Model_Class = model_dict[args.model]
+
+  print("Preparing dataset")
+  node_features, edge_features, target_features, task_type, train_loader, valid_loader, test_loader = read_dataset(args.dataset,root,args.batch_size,args.prefetch,cache=cache,split=args.split)
+
+  criterion, evaluation, metric_name, metric_compare, metric_best = get_metric_by_task_type(task_type,target_features)
+
+  models, optimizers, loggers, resume_dirs, checkpoints, best_er1s = [], [], [], [], [], []
+  for tgt_idx, tgt in targets:
+    print("Creating a model for {}".format(tgt))
+    model = Model_Class(node_features=node_features, edge_features=edge_features, target_features=1, hidden_features=args.hidden, num_layers=args.layers, dropout=0.5, type=task_type, s2s_processing_steps=args.s2s, ode_solver=args.ode_solver, ode_gradient=args.ode_gradient, ode_tol=args.ode_tol)
+    print("#Parameters: {param_count}".format(param_count=count_params(model)))
+    optimizer = optim.Adam(model.parameters(), lr=args.lr, weight_decay=args.weight_decay)
+    logger = Logger(args.log_path.format(dataset=args.dataset,model=args.model,layers=args.layers,feature=tgt))
+    best_er1 = None
+    resume_dir = None
+    if args.resume:
+      resume_dir = args.resume.format(dataset=args.dataset,model=args.model,layers=args.layers,feature=tgt)
+      # get the best checkpoint if available without training
+      best_er1 = load_best_model(model, optimizer, resume_dir, cuda=args.cuda)
+      checkpoints.append(CheckpointWriter(resume_dir, compare=metric_compare))
+    #end if
+    if args.cuda:
+      model = model.cuda()
+    models.append(model)
+    optimizers.append(optimizer)
+    loggers.append(logger)
+    resume_dirs.append(resume_dir)
+    best_er1s.append(best_er1)
+  #end for
+
+  print('Check cuda')
+  if args.cuda:
+    print('\t* Cuda')
+    criterion = criterion.cuda()
+
+  lr_step = (args.lr-args.lr*args.lr_decay)/(args.epochs*args.schedule[1] - args.epochs*args.schedule[0])
+
+  # Epoch for loop
+  for epoch in range(0, args.epochs):
+    try:
+      if epoch > args.epochs * args.schedule[0] and epoch < args.epochs * args.schedule[1]:
+        args.lr -= lr_step
+        for optimizer in optimizers:
+          for param_group in optimizer.param_groups:
+            param_group['lr'] = args.lr
+      #end if
+
+      # train for one epoch
+      train_targets(train_loader, models, criterion, optimizers, epoch, evaluation, loggers, targets, metric_name=metric_name, cuda=args.cuda, log_interval=args.log_interval)
+
+      # evaluate on test set
+      er1s = validate_targets(valid_loader, models, criterion, evaluation, targets, loggers=loggers, metric_name=metric_name, cuda=args.cuda, log_interval=args.log_interval)
+
+      for k in range(len(targets)):
+        # The first epoch is always the best so far
+        is_best = best_er1s[k] is None or metric_compare(er1s[k], best_er1s[k])
+        best_er1s[k] = er1s[k] if best_er1s[k] is None else metric_best(er1s[k], best_er1s[k])
+        if args.resume:
+          checkpoints[k].save({'epoch': epoch + 1, 'state_dict': models[k].state_dict(), 'best_er1': best_er1s[k],
+                       'optimizer': optimizers[k].state_dict(), }, is_best=is_best, metric=er1s[k])
+
+        # Logger step
+        loggers[k].log_value('learning_rate', args.lr).step()
+      #end for
+    except KeyboardInterrupt:
+      break
+    #end try
+  #end for
+
+  # get the best checkpoints and test them with test set
+  if args.resume:
+    for model, optimizer, resume_dir, writer in zip(models, optimizers, resume_dirs, checkpoints):
+      writer.close()
+      load_best_model(model, optimizer, resume_dir, cuda=args.cuda)
+  #end if
+
+  # (For testing)
+  validate_targets(test_loader, models, criterion, evaluation, targets, metric_name=metric_name, cuda=args.cuda, log_interval=args.log_interval)
+#end main_concurrent
+
+
 def main():
   global args, best_er1
   args = parser.parse_args()
 
   # Check if CUDA is enabled
   args.cuda = not args.no_cuda and torch.cuda.is_available()
-  
+
+  if args.concurrent:
+    return main_concurrent()
+
   for tgt_idx, tgt in enumerate( dataset_targets[args.dataset] ):
     print("Training a model for {}".format(tgt))
+    best_er1 = None
   
     # Load data
     root = args.dataset_path if args.dataset_path else dataset_paths[args.dataset]
+    cache = args.cache_path if args.cache_path else dataset_cache_paths.get(args.dataset)
     task_type = args.dataset_type if args.dataset_type else dataset_types[args.dataset]
     if args.resume:
       resume_dir = args.resume.format(dataset=args.dataset,model=args.model,layers=args.layers,feature=tgt)
@@ -114,13 +246,13 @@ def main():
     Model_Class = model_dict[args.model]
 
     print("Preparing dataset")
-    node_features, edge_features, target_features, task_type, train_loader, valid_loader, test_loader = read_dataset(args.dataset,root,args.batch_size,args.prefetch)
+    node_features, edge_features, target_features, task_type, train_loader, valid_loader, test_loader = read_dataset(args.dataset,root,args.batch_size,args.prefetch,cache=cache,split=args.split)
 
     # Define model and optimizer
 
     print('\tCreate model')
     hidden_state_size = args.hidden
-    model = Model_Class(node_features=node_features, edge_features=edge_features, target_features=1, hidden_features=hidden_state_size, num_layers=args.layers, dropout=0.5, type=task_type, s2s_processing_steps=args.s2s)
+    model = Model_Class(node_features=node_features, edge_features=edge_features, target_features=1, hidden_features=hidden_state_size, num_layers=args.layers, dropout=0.5, type=task_type, s2s_processing_steps=args.s2s, ode_solver=args.ode_solver, ode_gradient=args.ode_gradient, ode_tol=args.ode_tol)
     print("#Parameters: {param_count}".format(param_count=count_params(model)))
 
     print('Optimizer')
@@ -173,8 +305,8 @@ def main():
         # evaluate on test set
         er1 = validate(valid_loader, model, criterion, evaluation, logger, target_range=(tgt_idx,), tgt_name=tgt, metric_name=metric_name, cuda=args.cuda, log_interval=args.log_interval)
 
-        is_best = metric_compare(er1, best_er1)
-        best_er1 = metric_best(er1, best_er1)
+        is_best = best_er1 is None or metric_compare(er1, best_er1)
+        best_er1 = er1 if best_er1 is None else metric_best(er1, best_er1)
         save_checkpoint({'epoch': epoch + 1, 'state_dict': model.state_dict(), 'best_er1': best_er1,
                      'optimizer': optimizer.state_dict(), }, is_best=is_best, directory=resume_dir)
 
@@ -5,7 +5,6 @@ import time
 import argparse
 
 import numpy as np
-import shutil
 
 import torch
 import torch.nn as nn
@@ -14,17 +13,32 @@ from torch.autograd import Variable
 # Our Modules
 import datasets
 from LogMetric import AverageMeter
-from GraphReader.graph_reader import create_graph_mutag, divide_datasets
+from GraphReader.graph_reader import create_graph_mutag, XyzPack
+from datasets.store import GraphStore, store_exists
+from datasets.sampler import BucketBatchSampler
+from datasets.prefetch import ThreadedLoader
+from datasets.splits import SPLITS, split_dir, seed_of, load_or_create, qm9_split, stratified_split
+from checkpoint import atomic_save, atomic_link
+from distributed import is_distributed, shard_batches
+
+# QM9 targets, in the order of the .xyz files, and their statistics over the whole dataset
+QM9_TARGETS = ('mu', 'alpha', 'homo', 'lumo', 'gap', 'r2', 'zpve', 'U0', 'U', 'H', 'G', 'Cv')
+QM9_TARGET_MEAN = np.array([2.71802732e+00,   7.51685080e+01,  -2.40259300e-01,   1.09503300e-02,
+                            2.51209430e-01,   1.18997445e+03,   1.48493130e-01,  -4.11609491e+02,
+                           -4.11601022e+02,  -4.11600078e+02,  -4.11642909e+02,   3.15894998e+01])
+QM9_TARGET_STD = np.array([1.58422291e+00,   8.29443552e+00,   2.23854977e-02,   4.71030547e-02,
+                           4.77156393e-02,   2.80754665e+02,   3.37238236e-02,   3.97717205e+01,
+                           3.97715029e+01,   3.97715029e+01,   3.97722334e+01,   4.09458852e+00])
 
 def save_checkpoint(state, is_best, directory):
-
+  """Synchronous checkpoint, see checkpoint.CheckpointWriter for one written in the background"""
   if not os.path.isdir(directory):
     os.makedirs(directory)
   checkpoint_file = os.path.join(directory, 'checkpoint.pth')
   best_model_file = os.path.join(directory, 'model_best.pth')
-  torch.save(state, checkpoint_file)
+  atomic_save(state, checkpoint_file)
   if is_best:
-    shutil.copyfile(checkpoint_file, best_model_file)
+    atomic_link(checkpoint_file, best_model_file)
 
 def get_metric_by_task_type(task_type,target_features):
   if task_type == "regression":
@@ -59,40 +73,81 @@ def restricted_float(x, inter):
     raise argparse.ArgumentTypeError("%r not in range [1e-5, 1e-4]"%(x,))
   return x
 
-def read_dataset(dataset,root,batch_size,num_workers):
+def data_loader(data, batch_size, shuffle, collate_fn, num_workers, batch_sampler=None, prefetch_mode="process", prefetch_batches=2):
+  """DataLoader collating in num_workers processes, or a ThreadedLoader collating in as many threads"""
+  if prefetch_mode == "thread":
+    return ThreadedLoader(data, batch_size, shuffle, collate_fn, num_workers, prefetch_batches,
+                          batch_sampler=batch_sampler, pin_memory=True)
+  if batch_sampler is not None:
+    return torch.utils.data.DataLoader(data, batch_sampler=batch_sampler, collate_fn=collate_fn,
+                                       num_workers=num_workers, pin_memory=True)
+  return torch.utils.data.DataLoader(data, batch_size=batch_size, shuffle=shuffle, collate_fn=collate_fn,
+                                     num_workers=num_workers, pin_memory=True)
+#end data_loader
+
+def list_files(root):
+  return sorted(f for f in os.listdir(root) if os.path.isfile(os.path.join(root, f)))
+#end list_files
+
+def read_dataset(dataset,root,batch_size,num_workers,cache=None,bucket=False,node_budget=None,edge_budget=None,split="default",
+                 prefetch_mode="process",prefetch_batches=2):
+  """
+    Loads the train, valid and test sets of the split manifest named split (see datasets.splits),
+    which is created on first use. In a distributed job, the loaders serve this rank's share of the batches.
+  """
+  collate_fn = datasets.utils.collate_g_concat_edge_data
   if dataset=="qm9":
-    print('Prepare files')
-    
-    files = [f for f in os.listdir(root) if os.path.isfile(os.path.join(root, f))]
-
-    idx = np.random.permutation(len(files))
-    idx = idx.tolist()
-
-    valid_ids = [files[i] for i in idx[0:10000]]
-    test_ids = [files[i] for i in idx[10000:20000]]
-    train_ids = [files[i] for i in idx[20000:]]
-
-    data_train = datasets.Qm9(root, train_ids, edge_transform=datasets.utils.qm9_edges, e_representation='raw_distance')
-    data_valid = datasets.Qm9(root, valid_ids, edge_transform=datasets.utils.qm9_edges, e_representation='raw_distance')
-    data_test = datasets.Qm9(root, test_ids, edge_transform=datasets.utils.qm9_edges, e_representation='raw_distance')
-
-    # Select one graph
-    g_tuple, l = data_train[0]
-    g, h_t, e = g_tuple
-    node_features = len(h_t[0])
-    edge_features = len(list(e.values())[0])
-    target_features = len(l)
+    if cache is not None and store_exists(cache):
+      print('Open cache {}'.format(cache))
+      store = GraphStore(cache)
+
+      idx = load_or_create(split_dir(cache), split, lambda: qm9_split(len(store), seed_of(split)))
+
+      data_train = datasets.Qm9Cached(store, idx['train'])
+      data_valid = datasets.Qm9Cached(store, idx['valid'])
+      data_test = datasets.Qm9Cached(store, idx['test'])
+
+      node_features = store.meta['node_features']
+      edge_features = store.meta['edge_features']
+      target_features = store.meta['target_features']
+      collate_fn = datasets.utils.collate_g_concat_arrays
+      # Gathered when the store was written
+      stats = store.stats()
+      stat_dict = {'target_mean': stats.target_mean, 'target_std': np.where(stats.target_std > 0, stats.target_std, 1)}
+    else:
+      print('Prepare files')
+      
+      def create_split():
+        # Single-file container written by pack_xyz_archive, or a directory of .xyz files
+        files = sorted(XyzPack(root).names) if os.path.isfile(root) else list_files(root)
+        idx = qm9_split(len(files), seed_of(split))
+        idx['ids'] = np.asarray(files, dtype=str)
+        return idx
+      #end create_split
+      idx = load_or_create(split_dir(root), split, create_split)
+      if os.path.isfile(root):
+        root = XyzPack(root)
+
+      files = idx['ids']
+      train_ids, valid_ids, test_ids = (files[idx[name]].tolist() for name in SPLITS)
+
+      data_train = datasets.Qm9(root, train_ids, edge_transform=datasets.utils.qm9_edges, e_representation='raw_distance')
+      data_valid = datasets.Qm9(root, valid_ids, edge_transform=datasets.utils.qm9_edges, e_representation='raw_distance')
+      data_test = datasets.Qm9(root, test_ids, edge_transform=datasets.utils.qm9_edges, e_representation='raw_distance')
+
+      # Select one graph
+      g_tuple, l = data_train[0]
+      g, h_t, e = g_tuple
+      node_features = len(h_t[0])
+      edge_features = len(list(e.values())[0])
+      target_features = len(l)
+
+      # Without a store there are no gathered statistics, use those of the whole QM9
+      stat_dict = {'target_mean': QM9_TARGET_MEAN, 'target_std': QM9_TARGET_STD}
+    #end if
     task_type ='regression'
 
     print('\tStatistics')
-    #stat_dict = datasets.utils.get_graph_stats(data_valid, ['target_mean', 'target_std'])
-    stat_dict = {}
-    stat_dict['target_mean'] = np.array([2.71802732e+00,   7.51685080e+01,  -2.40259300e-01,   1.09503300e-02,
-                       2.51209430e-01,   1.18997445e+03,   1.48493130e-01,  -4.11609491e+02,
-                      -4.11601022e+02,  -4.11600078e+02,  -4.11642909e+02,   3.15894998e+01])
-    stat_dict['target_std'] = np.array([1.58422291e+00,   8.29443552e+00,   2.23854977e-02,   4.71030547e-02,
-                      4.77156393e-02,   2.80754665e+02,   3.37238236e-02,   3.97717205e+01,
-                      3.97715029e+01,   3.97715029e+01,   3.97722334e+01,   4.09458852e+00])
 
     data_train.set_target_transform(lambda x: datasets.utils.normalize_data(x,stat_dict['target_mean'],
                                         stat_dict['target_std']))
@@ -101,10 +156,20 @@ def read_dataset(dataset,root,batch_size,num_workers):
     data_test.set_target_transform(lambda x: datasets.utils.normalize_data(x, stat_dict['target_mean'],
                                          stat_dict['target_std']))
   elif dataset=="mutag":
-    files = [f for f in os.listdir(root) if os.path.isfile(os.path.join(root, f))]
-    classes = [create_graph_mutag(os.path.join(root, f))[1] for f in files]
-      
-    train_ids, train_classes, valid_ids, valid_classes, test_ids, test_classes = divide_datasets(files, classes)
+    def create_split():
+      # The class labels are only parsed once, when the manifest is created
+      files = list_files(root)
+      classes = [create_graph_mutag(os.path.join(root, f))[1] for f in files]
+      idx = stratified_split(classes, seed_of(split))
+      idx['ids'] = np.asarray(files, dtype=str)
+      idx['labels'] = np.asarray(classes, dtype=np.int64)
+      return idx
+    #end create_split
+    idx = load_or_create(split_dir(root), split, create_split)
+
+    files, classes = idx['ids'], idx['labels']
+    train_ids, valid_ids, test_ids = (files[idx[name]].tolist() for name in SPLITS)
+    train_classes, valid_classes, test_classes = (classes[idx[name]].tolist() for name in SPLITS)
 
     data_train = datasets.MUTAG(root, train_ids, train_classes)
     data_valid = datasets.MUTAG(root, valid_ids, valid_classes)
@@ -124,18 +189,26 @@ def read_dataset(dataset,root,batch_size,num_workers):
   #end
 
   # Data Loader
-  train_loader = torch.utils.data.DataLoader(data_train,
-                         batch_size=batch_size, shuffle=True,
-                         collate_fn=datasets.utils.collate_g_concat_edge_data,
-                         num_workers=num_workers, pin_memory=True)
-  valid_loader = torch.utils.data.DataLoader(data_valid,
-                         batch_size=batch_size, shuffle=False,
-                         collate_fn=datasets.utils.collate_g_concat_edge_data,
-                         num_workers=num_workers, pin_memory=True)
-  test_loader = torch.utils.data.DataLoader(data_test,
-                        batch_size=batch_size, shuffle=False,
-                        collate_fn=datasets.utils.collate_g_concat_edge_data,
-                        num_workers=num_workers, pin_memory=True)
+  batch_samplers = [None, None, None]
+  if bucket or node_budget is not None or edge_budget is not None:
+    if hasattr(data_train, 'num_nodes'):
+      print('\tBatches bucketed by size' + ('' if node_budget is None else ', {} nodes'.format(node_budget)) +
+            ('' if edge_budget is None else ', {} edges'.format(edge_budget)))
+      # Seeded alike on every rank of a distributed job
+      seed = seed_of(split) if is_distributed() else None
+      batch_samplers = [BucketBatchSampler(data.num_nodes(), data.num_edges(), batch_size, node_budget, edge_budget, shuffle=shuffle, seed=seed)
+                        for data, shuffle in ((data_train, True), (data_valid, False), (data_test, False))]
+    else:
+      print('\tBucketing batches by size needs a preprocessed store, using {} graphs per batch'.format(batch_size))
+    #end if
+  #end if
+  if is_distributed():
+    batch_samplers = [shard_batches(data, batch_size, shuffle, seed_of(split), sampler)
+                      for data, shuffle, sampler in zip((data_train, data_valid, data_test), (True, False, False), batch_samplers)]
+  #end if
+  train_loader = data_loader(data_train, batch_size, True, collate_fn, num_workers, batch_samplers[0], prefetch_mode, prefetch_batches)
+  valid_loader = data_loader(data_valid, batch_size, False, collate_fn, num_workers, batch_samplers[1], prefetch_mode, prefetch_batches)
+  test_loader = data_loader(data_test, batch_size, False, collate_fn, num_workers, batch_samplers[2], prefetch_mode, prefetch_batches)
   return node_features, edge_features, target_features, task_type, train_loader, valid_loader, test_loader
 #end read_dataset
 
@@ -152,8 +225,7 @@ def train(train_loader, model, criterion, optimizer, epoch, evaluation, logger,
   model.train()
 
   end = time.time()
-  for i, (batch_size,g,b,x,e_d,e_src,e_tgt,target) in enumerate(train_loader):
-    #e_tgt = e_tgt.to_sparse()
+  for i, (batch_size,b,x,e_d,e_src,e_tgt,target) in enumerate(train_loader):
     if len(target_range) == 1:
       target=target[:,target_range]
     elif len(target_range) == 2:
@@ -163,9 +235,9 @@ def train(train_loader, model, criterion, optimizer, epoch, evaluation, logger,
     #end if
     
     if cuda:
-      g,b,x,e_d,e_src,e_tgt,target = map(lambda a:a.cuda(), (g,b,x,e_d,e_src,e_tgt,target))
-    #g,b,x,e_d,e_src,e_tgt,target = map(lambda a: torch.tensor(a,requires_grad=True if a.dtype == torch.float else False,device=a.device), (g,b,x,e_d,e_src,e_tgt,target))
-    #g,b,x,e_d,e_src,e_tgt,target = map(lambda a:Variable(a), (g,b,x,e_d,e_src,e_tgt,target))
+      b,x,e_d,e_src,e_tgt,target = map(lambda a:a.cuda(), (b,x,e_d,e_src,e_tgt,target))
+    #b,x,e_d,e_src,e_tgt,target = map(lambda a: torch.tensor(a,requires_grad=True if a.dtype == torch.float else False,device=a.device), (b,x,e_d,e_src,e_tgt,target))
+    #b,x,e_d,e_src,e_tgt,target = map(lambda a:Variable(a), (b,x,e_d,e_src,e_tgt,target))
 
     # Measure data loading time
     data_time.update(time.time() - end)
@@ -183,8 +255,8 @@ def train(train_loader, model, criterion, optimizer, epoch, evaluation, logger,
     train_loss = criterion(output, target)
 
     # Logs
-    losses.update(train_loss.item(), batch_size)
-    metric.update(evaluation(output, target).item(), batch_size)
+    losses.update(train_loss, batch_size)
+    metric.update(evaluation(output, target), batch_size)
 
     # compute gradient and do SGD step
     train_loss.backward()
@@ -204,6 +276,8 @@ def train(train_loader, model, criterion, optimizer, epoch, evaluation, logger,
           .format(epoch, i, len(train_loader), batch_time=batch_time,
               data_time=data_time, loss=losses, metric_name=metric_name, metric=metric), flush=True)
               
+  losses.all_reduce()
+  metric.all_reduce()
   logger.log_value('train_epoch_loss', losses.avg)
   logger.log_value('train_epoch_{metric}'.format(metric=metric_name), metric.avg)
 
@@ -220,8 +294,7 @@ def validate(val_loader, model, criterion, evaluation, logger=None, target_range
   model.eval()
   with torch.no_grad():
     end = time.time()
-    for i, (batch_size,g,b,x,e_d,e_src,e_tgt,target) in enumerate(val_loader):
-      e_tgt.to_sparse()
+    for i, (batch_size,b,x,e_d,e_src,e_tgt,target) in enumerate(val_loader):
       if target_range is not None:
         if len(target_range) == 1:
           target=target[:,target_range[0]]
@@ -233,8 +306,8 @@ def validate(val_loader, model, criterion, evaluation, logger=None, target_range
       #end if
       
       if cuda:
-        g,b,x,e_d,e_src,e_tgt,target = map(lambda a:a.cuda(), (g,b,x,e_d,e_src,e_tgt,target))
-      #g,b,x,e_d,e_src,e_tgt,target = map(lambda a:Variable(a), (g,b,x,e_d,e_src,e_tgt,target))
+        b,x,e_d,e_src,e_tgt,target = map(lambda a:a.cuda(), (b,x,e_d,e_src,e_tgt,target))
+      #b,x,e_d,e_src,e_tgt,target = map(lambda a:Variable(a), (b,x,e_d,e_src,e_tgt,target))
       
       # Compute output
       train_loss = torch.zeros((),)
@@ -246,8 +319,8 @@ def validate(val_loader, model, criterion, evaluation, logger=None, target_range
           batch=b
           )
       # Logs
-      losses.update(criterion(output, target).item(), batch_size)
-      metric.update(evaluation(output, target).item(), batch_size)
+      losses.update(criterion(output, target), batch_size)
+      metric.update(evaluation(output, target), batch_size)
 
       # measure elapsed time
       batch_time.update(time.time() - end)
@@ -265,6 +338,8 @@ def validate(val_loader, model, criterion, evaluation, logger=None, target_range
     #end for
   #end torch.no_grad
 
+  losses.all_reduce()
+  metric.all_reduce()
   print(' * {tgt_name} Average {metric_name} {metric.avg:.3f}; Average Loss {loss.avg:.3f}'
       .format(metric_name=metric_name, metric=metric, loss=losses, tgt_name=tgt_name,), flush=True)
 
@@ -274,3 +349,120 @@ def validate(val_loader, model, criterion, evaluation, logger=None, target_range
 
   return metric.avg
 
+
+def train_targets(train_loader, models, criterion, optimizers, epoch, evaluation, loggers, targets, metric_name="metric", cuda=False, log_interval=20):
+  """
+    Trains one single-target model per (index, name) in targets on the same batches, so that
+    every batch is loaded and collated once for all of them.
+  """
+  batch_time = AverageMeter()
+  data_time = AverageMeter()
+  losses = [AverageMeter() for _ in models]
+  metrics = [AverageMeter() for _ in models]
+  # switch to train mode
+  for model in models:
+    model.train()
+
+  end = time.time()
+  for i, (batch_size,b,x,e_d,e_src,e_tgt,target) in enumerate(train_loader):
+    if cuda:
+      b,x,e_d,e_src,e_tgt,target = map(lambda a:a.cuda(), (b,x,e_d,e_src,e_tgt,target))
+
+    # Measure data loading time
+    data_time.update(time.time() - end)
+
+    for model, optimizer, (tgt_idx, _), loss_meter, metric_meter in zip(models, optimizers, targets, losses, metrics):
+      optimizer.zero_grad()
+      output = model(
+          node_features=x,
+          edge_features=e_d,
+          Esrc=e_src,
+          Etgt=e_tgt,
+          batch=b
+          )
+      tgt = target[:,tgt_idx:tgt_idx+1]
+      train_loss = criterion(output, tgt)
+
+      # Logs
+      loss_meter.update(train_loss, batch_size)
+      metric_meter.update(evaluation(output, tgt), batch_size)
+
+      # compute gradient and do SGD step
+      train_loss.backward()
+      optimizer.step()
+    #end for
+
+    # Measure elapsed time
+    batch_time.update(time.time() - end)
+    end = time.time()
+
+    if i % log_interval == 0 and i > 0:
+      print('Epoch: [{0}][{1}/{2}]\t'
+          'Time {batch_time.val:.3f} ({batch_time.avg:.3f})\t'
+          'Data {data_time.val:.3f} ({data_time.avg:.3f})\t'
+          'Mean Loss ({loss:.4f})\t'
+          'Mean {metric_name} ({metric:.4f})'
+          .format(epoch, i, len(train_loader), batch_time=batch_time, data_time=data_time,
+              loss=np.mean([l.avg for l in losses]), metric_name=metric_name, metric=np.mean([m.avg for m in metrics])), flush=True)
+  #end for
+
+  for (_, tgt_name), logger, loss_meter, metric_meter in zip(targets, loggers, losses, metrics):
+    logger.log_value('train_epoch_loss', loss_meter.avg)
+    logger.log_value('train_epoch_{metric}'.format(metric=metric_name), metric_meter.avg)
+    print('Epoch: [{0}] {tgt_name} Avg {metric_name} {metric.avg:.3f}; Average Loss {loss.avg:.3f}; Avg Time x Batch {b_time.avg:.3f}'
+        .format(epoch, metric_name=metric_name, metric=metric_meter, loss=loss_meter, b_time=batch_time, tgt_name=tgt_name,), flush=True)
+  #end for
+
+
+def validate_targets(val_loader, models, criterion, evaluation, targets, loggers=None, metric_name="metric", cuda=False, log_interval=20):
+  """Evaluates the single-target models of train_targets on the same batches, returns the metric of each"""
+  batch_time = AverageMeter()
+  losses = [AverageMeter() for _ in models]
+  metrics = [AverageMeter() for _ in models]
+
+  # switch to evaluate mode
+  for model in models:
+    model.eval()
+  with torch.no_grad():
+    end = time.time()
+    for i, (batch_size,b,x,e_d,e_src,e_tgt,target) in enumerate(val_loader):
+      if cuda:
+        b,x,e_d,e_src,e_tgt,target = map(lambda a:a.cuda(), (b,x,e_d,e_src,e_tgt,target))
+
+      for model, (tgt_idx, _), loss_meter, metric_meter in zip(models, targets, losses, metrics):
+        output = model(
+            node_features=x,
+            edge_features=e_d,
+            Esrc=e_src,
+            Etgt=e_tgt,
+            batch=b
+            )
+        tgt = target[:,tgt_idx:tgt_idx+1]
+        loss_meter.update(criterion(output, tgt), batch_size)
+        metric_meter.update(evaluation(output, tgt), batch_size)
+      #end for
+
+      # measure elapsed time
+      batch_time.update(time.time() - end)
+      end = time.time()
+
+      if i % log_interval == 0 and i > 0:
+        print('Test: [{0}/{1}]\t'
+            'Time {batch_time.val:.3f} ({batch_time.avg:.3f})\t'
+            'Mean Loss ({loss:.4f})\t'
+            'Mean {metric_name} ({metric:.4f})'
+            .format(i, len(val_loader), batch_time=batch_time, loss=np.mean([l.avg for l in losses]),
+                metric_name=metric_name, metric=np.mean([m.avg for m in metrics])), flush=True)
+      #end if
+    #end for
+  #end torch.no_grad
+
+  for k, ((_, tgt_name), loss_meter, metric_meter) in enumerate(zip(targets, losses, metrics)):
+    print(' * {tgt_name} Average {metric_name} {metric.avg:.3f}; Average Loss {loss.avg:.3f}'
+        .format(metric_name=metric_name, metric=metric_meter, loss=loss_meter, tgt_name=tgt_name,), flush=True)
+    if loggers is not None:
+      loggers[k].log_value('test_epoch_loss', loss_meter.avg)
+      loggers[k].log_value('test_epoch_{metric}'.format(metric=metric_name), metric_meter.avg)
+  #end for
+
+  return [m.avg for m in metrics]
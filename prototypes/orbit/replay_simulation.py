@@ -40,26 +40,24 @@ DATA_FOLDER = './data/{}'.format(NUM_OF_BODIES)
 def nbody(dt, pos, vel, mass, radii=None, out_pos=None, out_vel=None,
       force_placeholder=None, distance_placeholder=None, G=39.478, epsilon=1e-3):
   """
-  Compute the physical interaction between n-bodies
+  Compute the physical interaction between n-bodies.
+  pos and vel are (n, 2) and mass (n, 1), or (S, n, 2) and (S, n, 1) to step S scenes at once.
   """
   out_pos, out_vel, force_placeholder = map(lambda x: np.empty_like(
     pos) if x is None else x, (out_pos, out_vel, force_placeholder))
 
-  n = pos.shape[0]
+  n = pos.shape[-2]
 
   if distance_placeholder is None:
-    distance_placeholder = np.zeros((n, n, 2), dtype=pos.dtype)
-  d1 = pos.view()[np.newaxis, :, :]
-  d2 = pos.view()[:, np.newaxis, :]
-  distance_placeholder = d2 - d1
-
-  force_placeholder[:] = 0
-  for i in range(n):
-    for j in range(n):
-      if i != j:
-        force_placeholder[i] -= distance_placeholder[i, j, :] * \
-          (G * mass[i] * mass[j] /
-           (epsilon + np.linalg.norm(distance_placeholder[i, j, :]) ** 2))
+    distance_placeholder = np.empty(pos.shape[:-2] + (n, n, pos.shape[-1]), dtype=pos.dtype)
+  # d[..., i, j, :] = pos[..., i, :] - pos[..., j, :]
+  d = np.subtract(pos[..., :, np.newaxis, :], pos[..., np.newaxis, :, :], out=distance_placeholder)
+
+  # G * m_i * m_j / (epsilon + |d_ij|^2), the softening keeps it finite, and d_ii = 0 cancels i = j
+  w = G * mass * np.swapaxes(mass, -1, -2) / \
+    (epsilon + np.einsum('...ijk,...ijk->...ij', d, d))
+  np.einsum('...ij,...ijk->...ik', w, d, out=force_placeholder)
+  np.negative(force_placeholder, out=force_placeholder)
 
   out_vel = np.add(vel, force_placeholder / mass * dt, out=out_vel)
   out_pos = np.add(pos, (vel + (out_vel - vel) / 2) * dt, out=out_pos)
@@ -111,42 +111,106 @@ def compute_orbit(v, p, m, r, c, orbit_type):
 def nbody(dt, pos, vel, mass, radii=None, out_pos=None, out_vel=None,
       force_placeholder=None, distance_placeholder=None, G=39.478, epsilon=1e-3):
   """
-  Compute the physical interaction between n-bodies
+  Compute the physical interaction between n-bodies.
+  pos and vel are (n, 2) and mass (n, 1), or (S, n, 2) and (S, n, 1) to step S scenes at once.
   """
   out_pos, out_vel, force_placeholder = map(lambda x: np.empty_like(
     pos) if x is None else x, (out_pos, out_vel, force_placeholder))
 
-  n = pos.shape[0]
+  n = pos.shape[-2]
 
   if distance_placeholder is None:
-    distance_placeholder = np.zeros((n, n, 2), dtype=pos.dtype)
-  d1 = pos.view()[np.newaxis, :, :]
-  d2 = pos.view()[:, np.newaxis, :]
-  distance_placeholder = d2 - d1
-
-  force_placeholder[:] = 0
-  for i in range(n):
-    for j in range(n):
-      if i != j:
-        force_placeholder[i] -= distance_placeholder[i, j, :] * \
-          (G * mass[i] * mass[j] /
-           (epsilon + np.linalg.norm(distance_placeholder[i, j, :]) ** 2))
+    distance_placeholder = np.empty(pos.shape[:-2] + (n, n, pos.shape[-1]), dtype=pos.dtype)
+  # d[..., i, j, :] = pos[..., i, :] - pos[..., j, :]
+  d = np.subtract(pos[..., :, np.newaxis, :], pos[..., np.newaxis, :, :], out=distance_placeholder)
+
+  # G * m_i * m_j / (epsilon + |d_ij|^2), the softening keeps it finite, and d_ii = 0 cancels i = j
+  w = G * mass * np.swapaxes(mass, -1, -2) / \
+    (epsilon + np.einsum('...ijk,...ijk->...ij', d, d))
+  np.einsum('...ij,...ijk->...ik', w, d, out=force_placeholder)
+  np.negative(force_placeholder, out=force_placeholder)
 
   out_vel = np.add(vel, force_placeholder / mass * dt, out=out_vel)
   out_pos = np.add(pos, (vel + (out_vel - vel) / 2) * dt, out=out_pos)
   return out_pos, out_vel, force_placeholder
 
 
-def run_simulation(draw:bool=False, save_data:bool=False, start_at:int=0, num_scenes:int=1000, max_timesteps:int=1000, num_of_bodies:int=6, orbit_type:str="elliptical"):
+def save_scene(curr_scene, all_p, all_v, all_m, all_r, all_f, all_data):
+  """
+  Save the values of every timestep of a scene
+  """
+  os.makedirs("{}/{}".format(DATA_FOLDER, curr_scene), exist_ok=True)
+  for force_type, force_var in zip(["pos", "vel", "mass", "radii", "force", "data"], [all_p, all_v, all_m, all_r, all_f, all_data]):
+    np.save("{}/{}/{}.npy".format(DATA_FOLDER,
+                    str(curr_scene), force_type), force_var)
+
+
+def simulate_scenes(num_scenes, max_timesteps, orbit_type):
+  """
+  Simulate `num_scenes` scenes at once, stepping them together as
+  (num_scenes, NUM_OF_BODIES, NUM_DIMS) arrays.
+  Returns the values of every timestep of every scene, as saved by save_scene.
+  """
+  scenes = []
+  for _ in range(num_scenes):
+    v, _, p, _, m, _, _, c, r = generate_initial_values()
+    v, p, m, r, c = compute_orbit(v, p, m, r, c, orbit_type)
+    scenes.append((v, p, m, r))
+  v, p, m, r = (np.stack(x) for x in zip(*scenes))
+
+  # Generate placeholders
+  v2, p2, f = np.empty_like(v), np.empty_like(p), np.zeros_like(p)
+  d = np.zeros((num_scenes, NUM_OF_BODIES, NUM_OF_BODIES,
+          NUM_DIMS), dtype=p.dtype)
+  all_p, all_v, all_f = (np.zeros(
+    [num_scenes, max_timesteps, NUM_OF_BODIES, NUM_DIMS]) for _ in range(3))
+
+  for curr_timestep in trange(max_timesteps, desc="Timestep"):
+    all_p[:, curr_timestep], all_v[:, curr_timestep], all_f[:, curr_timestep] = p, v, f
+
+    nbody(
+      TIME_DELTA,
+      p,
+      v,
+      m,
+      out_pos=p2,
+      out_vel=v2,
+      force_placeholder=f,
+      distance_placeholder=d,
+      G=G
+    )
+
+    # Swap position and velocities
+    p, p2 = p2, p
+    v, v2 = v2, v
+  # end for
+
+  all_m, all_r = (np.repeat(x[:, np.newaxis], max_timesteps, axis=1) for x in (m, r))
+  all_data = np.full([num_scenes, max_timesteps, 1], G)
+  return all_p, all_v, all_m, all_r, all_f, all_data
+
+
+def run_simulation(draw:bool=False, save_data:bool=False, start_at:int=0, num_scenes:int=1000, max_timesteps:int=1000, num_of_bodies:int=6, orbit_type:str="elliptical", batch_size:int=100):
   """
   Run the simulation for `num_scenes` with `num_timesteps` each scene.
   Properly resets the environment and the physical values each scene.
+  Without `draw`, `batch_size` scenes are simulated at once.
   """
 
   global NUM_OF_BODIES, DATA_FOLDER
   NUM_OF_BODIES = num_of_bodies
   DATA_FOLDER = './data/{}'.format(NUM_OF_BODIES)
 
+  if not draw and batch_size > 1:
+    end_at = start_at + int(num_scenes)
+    for first_scene in trange(start_at, end_at, batch_size, desc="Batch"):
+      scenes = simulate_scenes(min(batch_size, end_at - first_scene), max_timesteps, orbit_type)
+      if save_data:
+        for i, values in enumerate(zip(*scenes)):
+          save_scene(first_scene + i, *values)
+    # end for
+    return
+
   # Run num_scenes simulations
   for curr_scene in trange(start_at, start_at + int(num_scenes), desc="Scene"):
     # Create save_data folder
@@ -287,9 +351,7 @@ def run_simulation(draw:bool=False, save_data:bool=False, start_at:int=0, num_sc
 
     # Save values
     if save_data:
-      for force_type, force_var in zip(["pos", "vel", "mass", "radii", "force", "data"], [all_p, all_v, all_m, all_r, all_f, all_data]):
-        np.save("{}/{}/{}.npy".format(DATA_FOLDER,
-                        str(curr_scene), force_type), force_var)
+      save_scene(curr_scene, all_p, all_v, all_m, all_r, all_f, all_data)
   # end for
 
 
@@ -1,4 +1,5 @@
 import os
+import sys
 import tqdm
 
 from pprint import pprint as pp
@@ -15,6 +16,11 @@ from prepare_dataset import get_epoch, normalise, denormalise, npmse
 
 from model import IN, IN_ODE
 
+qc_folder = os.path.realpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'QC'))
+if qc_folder not in sys.path:
+  sys.path.insert(1, qc_folder)
+from checkpoint import CheckpointWriter
+
 TIMESTEP_TYPES = ["s", "e"]  # start and end
 VAR_NAMES = ["p", "v", "m", "r", "f", "d"]
 VAR_FILENAMES = ["pos", "vel", "mass", "radii", "force", "data"]
@@ -121,6 +127,9 @@ def train(
   pct = np.load(PERCENTILES_FNAME).astype(np.float32)
   vpct = pct[:,:PREDICTED_VALUES]
 
+  # Every fold's model is kept, written in the background while the next fold trains
+  checkpoints = CheckpointWriter(MODEL_FOLDER, keep_last=None, keep_best=0, latest=None, best=None)
+
   if train:
     test_log_file = open(TEST_LOG_FNAME.format(model_name=model_name),"w")
     tqdm.tqdm.write("Train procedure...")
@@ -231,8 +240,7 @@ def train(
       tqdm.tqdm.write("Test_loss: " + str(test_loss) + " Denormalised Test Loss: "+ str(test_loss_unnorm))
 
       # Save model
-      SAVE_PATH = "{}/{model_name}_{fold}_{epoch}".format(MODEL_FOLDER, model_name=model_name, fold=fold, epoch=epoch)
-      torch.save(model.state_dict(), SAVE_PATH)
+      checkpoints.save(model.state_dict(), "{model_name}_{fold}_{epoch}".format(model_name=model_name, fold=fold, epoch=epoch))
       
     # end for
     test_log_file.close()
@@ -278,8 +286,7 @@ def train(
       print("{fold},{loss:f},{unnorm_loss}".format(fold=fold,loss=test_loss,unnorm_loss=test_loss_unnorm), file=test_log_file, flush=True)
       tqdm.tqdm.write("Test_loss: " + str(test_loss) + " Denormalised Test Loss: "+ str(test_loss_unnorm))
 
-      SAVE_PATH = "{}/{model_name}_{fold}_{epoch}".format(MODEL_FOLDER, model_name=model_name, fold=fold, epoch=epoch)
-      torch.save(model.state_dict(), SAVE_PATH)
+      checkpoints.save(model.state_dict(), "{model_name}_{fold}_{epoch}".format(model_name=model_name, fold=fold, epoch=epoch))
       
     # end for
     test_log_file.close()
@@ -344,6 +351,7 @@ def train(
   else:
     print("Provide one of: --train, --test, --rollout")
   #end if
+  checkpoints.close()
 
 
 